@@ -0,0 +1,90 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from tracing import SamplingProfiler
+from logger import log
+
+class AdminServer:
+    """
+    This class serves the admin pages of the proxy on a separate port, like the metrics for Prometheus on /metrics. It should only listen on an address that can not be reached by the clients of the proxy. A page is a function in routes that is called with the query parameters and returns the content type and the body.
+    """
+    def __init__(self, proxy, host="127.0.0.1", port=9998):
+        self.proxy = proxy
+        self.routes = {"/metrics": self.metrics, "/traces": self.traces, "/profile": self.profile}
+        self.profiler = SamplingProfiler()
+        admin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlsplit(self.path)
+                route = admin.routes.get(url.path)
+                if route is None:
+                    self.send_error(404)
+                    return
+                try:
+                    content_type, body = route(parse_qs(url.query))
+                except ValueError as error:
+                    self.send_error(400, str(error))
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.host, self.port = self.server.server_address[:2]
+
+    def start(self):
+        """
+        This function starts serving the admin pages in a new thread.
+        """
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        log.info("[ADMIN STARTED] The admin server started succesfully (%s, %s)", self.host, self.port)
+        return self
+
+    def stop(self):
+        """
+        This function stops the admin server.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+
+    def metrics(self, query):
+        """
+        This function returns the metrics of the proxy in the Prometheus text format.
+        """
+        return "text/plain; version=0.0.4; charset=utf-8", self.proxy.metrics.render(self.proxy.gauges()).encode("utf-8")
+
+    def traces(self, query):
+        """
+        This function returns the traces of the last requests as JSON, the newest last. With enable=1 tracing is started first and with enable=0 it is stopped, limit is the number of traces that are returned.
+        """
+        enable = query.get("enable", [None])[0]
+        if enable == "1":
+            self.proxy.enable_tracing()
+        elif enable == "0":
+            self.proxy.disable_tracing()
+        elif enable is not None:
+            raise ValueError("enable must be 0 or 1")
+        limit = int(query.get("limit", ["100"])[0])
+        tracer = self.proxy.tracer
+        body = {"enabled": tracer is not None, "traces": tracer.recent(limit) if tracer is not None else []}
+        return "application/json", json.dumps(body).encode("utf-8")
+
+    def profile(self, query):
+        """
+        This function runs the sampling profiler for seconds seconds, taking a sample every interval seconds, and returns the folded stacks for a flame graph. The page is only returned when the profile is finished.
+        """
+        seconds = float(query.get("seconds", ["10"])[0])
+        interval = float(query.get("interval", [str(self.profiler.interval)])[0])
+        if not 0 < seconds <= 300:
+            raise ValueError("seconds must be between 0 and 300")
+        if not 0.001 <= interval <= 1:
+            raise ValueError("interval must be between 0.001 and 1")
+        return "text/plain; charset=utf-8", self.profiler.profile(seconds, interval).encode("utf-8")
@@ -0,0 +1,424 @@
+import asyncio
+import time
+from proxy import Proxy, BodyTooLarge, SERVICE_UNAVAILABLE, CONNECTION_ESTABLISHED, CONTINUE, ERROR_RESPONSES
+from request import Request
+from response import Response
+from socketreader import body_framing
+from tunnel import Tunnel
+from logger import log
+
+class AsyncProxy(Proxy):
+    """
+    This class is an asyncio based version of the proxy. Instead of starting a new thread for every connection, all connections are served on a single event loop using non-blocking streams. It is configured exactly like Proxy, the replacements, keep_alive and use_cache works the same way in both modes, including revalidation, stale-while-revalidate, stale-if-error and coalescing of concurrent requests.
+    """
+    def __init__(self, host, port, max_queue):
+        super().__init__(host, port, max_queue)
+        self.background_tasks = set()
+
+    def run(self):
+        """
+        Run this function to start listening for new connections on the event loop.
+        """
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        """
+        This coroutine starts serving connections on the listening socket created by the constructor and runs until it is cancelled.
+        """
+        server = await asyncio.start_server(self.handle_connection, sock=self.server, backlog=self.max_queue, limit=self.max_header_size)
+        log.info("[SERVER STARTED] The async server started succesfully (%s, %s)", self.host, self.port)
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, client_reader, client_writer):
+        """
+        This coroutine is called by the event loop for every new connection. If max_connections connections are already being handled the connection is rejected with 503 Service Unavailable.
+        """
+        if self.active_connections >= self.max_connections:
+            self.rejected_connections += 1
+            log.warning("[OVERLOADED] The connection from %s was rejected", client_writer.get_extra_info("peername"))
+            client_writer.write(SERVICE_UNAVAILABLE)
+            client_writer.close()
+            return
+        self.active_connections += 1
+        try:
+            await self.handle_request(client_reader, client_writer)
+        finally:
+            self.active_connections -= 1
+
+    async def handle_request(self, client_reader, client_writer):
+        """
+        This coroutine is responsible for handling the requests on a connection. It is called by the event loop for every new connection and reads requests one after another as long as the connection is persistent.
+        """
+        connection_id = next(self.connection_ids)
+        self.request_id += 1
+        client_address = client_writer.get_extra_info("peername")
+        log.debug("[CONNECTION #%s] New connection from %s", connection_id, client_address)
+        handled = 0
+        persistent = True
+        try:
+            while persistent:
+                try:
+                    # Receive data from the client
+                    data = await asyncio.wait_for(client_reader.readuntil(b"\r\n\r\n"), self.client_idle_timeout)
+                except asyncio.IncompleteReadError as error:
+                    data = error.partial
+                    if not data:
+                        break
+                except asyncio.LimitOverrunError:
+                    await self.refuse_async(client_writer, 431, connection_id)
+                    break
+                except (asyncio.TimeoutError, ConnectionError):
+                    break
+                handled += 1
+                started = time.perf_counter()
+                if self.hooks.pre_parse:
+                    self.hooks.pre_parse(f"{connection_id}.{handled}", data, None)
+
+                # Create a request instance
+                request = Request(data)
+                self.observe("parse", started, request)
+                if self.hooks.post_parse:
+                    self.hooks.post_parse(f"{connection_id}.{handled}", request, None)
+
+                if request.valid and request.method == "CONNECT":
+                    self.requests.inc()
+                    await self.tunnel_async(client_reader, client_writer, client_address, request, connection_id, started)
+                    break
+
+                # Check if request was parsed successfully
+                if request.valid:
+                    log.debug("[CONNECTION #%s] %s: %s", connection_id, client_address[0], request.line)
+                    self.requests.inc()
+                    persistent = self.client_keep_alive(request, handled)
+                    cache = "off"
+                    try:
+                        accepted = await self.read_request_body(client_reader, client_writer, request)
+                    except ValueError:
+                        # The Content-Length or a chunk size of the body can not be parsed
+                        await self.refuse_async(client_writer, 400, connection_id)
+                        break
+                    if not accepted:
+                        await self.refuse_async(client_writer, 413, connection_id)
+                        break
+                    self.observe("client_read", started, request)
+
+                    # Only manipulate if request method is "GET"
+                    if request.method == "GET":
+
+                        # Manipulate request
+                        request = self.manipulate_request(request, connection_id)
+
+                        # If requested page is in our cache, create response from cache
+                        response = False
+                        if self.use_cache:
+                            lookup = time.perf_counter()
+                            response = self.query_cache(request, connection_id)
+                            self.observe("cache_lookup", lookup, request)
+                            cache = "hit" if response else "miss"
+
+                        if not response:
+                            if self.hooks.pre_upstream:
+                                self.hooks.pre_upstream(f"{connection_id}.{handled}", request, None)
+                            response = await self.fetch(request, connection_id)
+                            if self.hooks.post_upstream:
+                                self.hooks.post_upstream(f"{connection_id}.{handled}", request, response)
+                        response = self.compress_response(request, response, connection_id)
+                    else:
+                        if self.hooks.pre_upstream:
+                            self.hooks.pre_upstream(f"{connection_id}.{handled}", request, None)
+                        response = await self.send_request(request, connection_id)
+                        if self.hooks.post_upstream:
+                            self.hooks.post_upstream(f"{connection_id}.{handled}", request, response)
+                    if request.source is not None:
+                        # The rest of the request body was not read, the next request can not be found
+                        persistent = False
+
+                    if response.wire is not None:
+                        # Frozen responses from the cache are sent without changing or encoding them
+                        data = [response.wire[persistent], response.body]
+                    elif response.valid:
+                        response.headers["Connection"] = " keep-alive" if persistent else " close"
+                        data = [response.encode()]
+                    else:
+                        self.upstream_errors.inc()
+                        persistent = False
+                        data = [b"HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"]
+
+                    # Send response to client
+                    if self.hooks.pre_send:
+                        self.hooks.pre_send(f"{connection_id}.{handled}", request, response)
+                    writing = time.perf_counter()
+                    client_writer.writelines(data)
+                    await asyncio.wait_for(client_writer.drain(), self.write_timeout)
+                    self.observe("client_write", writing, request)
+                    self.request_duration.observe(time.perf_counter() - started)
+                    if self.hooks.post_send:
+                        self.hooks.post_send(f"{connection_id}.{handled}", request, response)
+                    if log.sampled():
+                        self.log_access(connection_id, client_address, request, int(response.status_code) if response.valid else 502, started, cache)
+
+                    log.debug("[CONNECTION #%s] The response was sent to the client %s", connection_id, client_address)
+
+                else:
+                    self.bad_requests.inc()
+                    persistent = False
+                    client_writer.write(b"HTTP/1.1 400 Bad Request\r\n\r\n")
+                    await asyncio.wait_for(client_writer.drain(), self.write_timeout)
+                    if self.hooks.post_send:
+                        self.hooks.post_send(f"{connection_id}.{handled}", request, None)
+                    log.warning("[CONNECTION #%s] The request was rejected", connection_id)
+                    if log.sampled():
+                        self.log_access(connection_id, client_address, request, 400, started, "off")
+        except (ConnectionError, OSError, ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            log.warning("[CONNECTION #%s] Lost connection to %s", connection_id, client_address)
+
+        client_writer.close()
+
+    async def tunnel_async(self, client_reader, client_writer, client_address, request, connection_id, started):
+        """
+        This coroutine handles a CONNECT request like Proxy.tunnel, the bytes are relayed between the streams of the client and the server on the event loop.
+        """
+        status = 200
+        try:
+            address = self.tunnel_address(request)
+            if address is None:
+                status = 403
+            elif self.active_tunnels >= self.max_tunnels:
+                status = 503
+            else:
+                connecting = time.perf_counter()
+                sock = await asyncio.wait_for(self.resolver.connect_async(address), self.connect_timeout)
+                server_reader, server_writer = await asyncio.open_connection(sock=sock)
+                self.observe("upstream_connect", connecting, request)
+        except (OSError, ValueError, asyncio.TimeoutError):
+            status = 502
+        tunnel = Tunnel(idle_timeout=self.tunnel_idle_timeout)
+        client_writer.write(CONNECTION_ESTABLISHED if status == 200 else ERROR_RESPONSES[status])
+        try:
+            await asyncio.wait_for(client_writer.drain(), self.write_timeout)
+        except (OSError, asyncio.TimeoutError):
+            if status == 200:
+                server_writer.close()
+            return
+        if status == 200:
+            log.debug("[CONNECTION #%s] The tunnel to %s was established", connection_id, request.host)
+            self.active_tunnels += 1
+            try:
+                await tunnel.relay_streams(client_reader, client_writer, server_reader, server_writer)
+            finally:
+                self.active_tunnels -= 1
+        self.finish_tunnel(connection_id, client_address, request, status, started, tunnel)
+
+    async def fetch(self, request, connection_id):
+        """
+        This coroutine is called when a GET request could not be answered from the cache, like Proxy.fetch. Concurrent requests for the same page wait for the first one without blocking the event loop.
+        """
+        if not self.use_cache:
+            return await self.forward(request, connection_id)
+        key = self.cache.key(request.url, request.headers)
+        flight, leader = self.flights.begin(key)
+        if not leader:
+            if await self.flights.wait_async(flight, self.coalesce_timeout):
+                entry = self.cache.lookup(request)
+                if entry is not None and entry.stored >= flight.started:
+                    self.flights.count(True)
+                    log.debug("[CONNECTION #%s] Requested webpage was shared with a concurrent request", connection_id)
+                    return entry.response
+            self.flights.count(False)
+            return await self.forward(request, connection_id)
+
+        try:
+            response = await self.forward(request, connection_id)
+        except BaseException:
+            self.flights.finish(key, flight, None)
+            raise
+        self.flights.finish(key, flight, True)
+        return response
+
+    async def forward(self, request, connection_id):
+        """
+        This coroutine sends a GET request to the server, or revalidates a stale response from the cache, like Proxy.forward.
+        """
+        entry = self.cache_entry(request) if self.use_cache else None
+        if entry is None:
+            return await self.send_request(request, connection_id)
+        return await self.revalidate(request, entry, connection_id)
+
+    async def revalidate(self, request, entry, connection_id):
+        """
+        This coroutine revalidates a cached response with a conditional request, like Proxy.revalidate.
+        """
+        response = await self.send_request(self.conditional_request(request, entry.response), connection_id)
+        return self.revalidated(request, entry, response, connection_id)
+
+    def revalidate_in_background(self, request, entry, connection_id):
+        """
+        This function revalidates a cached response in a task on the event loop. Only one revalidation per cached response runs at the same time.
+        """
+        if not self.claim_revalidation(entry):
+            return
+
+        async def run():
+            try:
+                await self.revalidate(request, entry, connection_id)
+            finally:
+                with self.lock:
+                    self.revalidating.discard(entry.key)
+
+        # The event loop only keeps weak references to tasks
+        task = asyncio.get_running_loop().create_task(run())
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+    async def send_request(self, request, connection_id):
+        """
+        This coroutine sends the request to the server and returns the response. The body is read until the end given by Content-Length or the chunked encoding. The name of the server is resolved with the resolver of the proxy, which does not block the event loop. The connect_timeout, write_timeout and read_timeout of the proxy limit how long every step may take.
+        """
+        response = Response(b"")
+        destination_writer = None
+        try:
+            connecting = time.perf_counter()
+            sock = await asyncio.wait_for(self.resolver.connect_async(self.upstream_address(request)), self.connect_timeout)
+            destination_reader, destination_writer = await asyncio.open_connection(sock=sock)
+            self.observe("upstream_connect", connecting, request)
+            sending = time.perf_counter()
+            destination_writer.write(request.encode())
+            await asyncio.wait_for(destination_writer.drain(), self.write_timeout)
+            if request.source is not None:
+                async for data in request.source:
+                    destination_writer.write(data)
+                    await asyncio.wait_for(destination_writer.drain(), self.write_timeout)
+            log.debug("[CONNECTION #%s] The request was sent to the host (%s)", connection_id, request.host)
+
+            head = await asyncio.wait_for(destination_reader.readuntil(b"\r\n\r\n"), self.read_timeout)
+            # Interim responses like 100 Continue are not passed on
+            while head.startswith(b"HTTP/1.1 1") and not head.startswith(b"HTTP/1.1 101"):
+                head = await asyncio.wait_for(destination_reader.readuntil(b"\r\n\r\n"), self.read_timeout)
+            response = Response(head)
+            self.observe("upstream_ttfb", sending, request)
+            if response.valid:
+                framing, length = body_framing(response.headers, request.method, response.status_code)
+                transfer = time.perf_counter()
+                response.body = await self.read_body(destination_reader, framing, length)
+                self.observe("body_transfer", transfer, request)
+                if framing == "chunked":
+                    del response.headers["Transfer-Encoding"]
+                if framing in ("chunked", "close"):
+                    response.headers["Content-Length"] = f" {len(response.body)}"
+        except BodyTooLarge:
+            log.warning("[CONNECTION #%s] The request body is larger than %s bytes", connection_id, self.max_body_size)
+            return Response(ERROR_RESPONSES[413])
+        except (ConnectionError, OSError, ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+            # A truncated response must neither be cached nor sent, the client gets 502 Bad Gateway
+            log.error("[CONNECTION #%s] Failed to receive response from %s", connection_id, request.host)
+            return Response(b"")
+        finally:
+            if destination_writer is not None:
+                destination_writer.close()
+        return self.process_response(response, request, connection_id)
+
+    async def read_request_body(self, client_reader, client_writer, request):
+        """
+        This coroutine reads the body of a request from the client like Proxy.read_request_body. Larger bodies are relayed by an asynchronous generator in the source of the request, see stream_request_body.
+        """
+        framing, length = body_framing(request.headers, request.method)
+        if framing == "none":
+            return True
+        if framing == "length" and length > self.max_body_size:
+            return False
+        if framing == "chunked" and "Content-Length" in request.headers:
+            # Both headers together are a request smuggling attempt, the chunked encoding wins and the length is removed
+            del request.headers["Content-Length"]
+        if "100-continue" in request.headers.get("Expect", "").lower():
+            del request.headers["Expect"]
+            client_writer.write(CONTINUE)
+            await asyncio.wait_for(client_writer.drain(), self.write_timeout)
+        pieces = self.iter_body(client_reader, framing, length)
+        if framing == "length" and length > self.request_buffer_size:
+            request.source = self.stream_request_body(request, pieces, False)
+            return True
+        body = bytearray()
+        async for data in pieces:
+            body += data
+            if len(body) > self.request_buffer_size:
+                # The chunked body is too large to be kept in memory, it is streamed with chunked encoding
+                request.source = self.stream_request_body(request, pieces, True, bytes(body))
+                return True
+        request.body = bytes(body)
+        if framing == "chunked":
+            del request.headers["Transfer-Encoding"]
+            request.headers["Content-Length"] = f" {len(request.body)}"
+        return True
+
+    async def stream_request_body(self, request, pieces, chunked, first=b""):
+        """
+        This asynchronous generator relays the pieces of a request body like Proxy.stream_request_body. first is the part of the body that has already been read.
+        """
+        received = 0
+        if first:
+            received = len(first)
+            yield b"%x\r\n" % len(first) + first + b"\r\n" if chunked else first
+        async for data in pieces:
+            received += len(data)
+            if received > self.max_body_size:
+                raise BodyTooLarge(f"The request body is larger than {self.max_body_size} bytes")
+            yield b"%x\r\n" % len(data) + data + b"\r\n" if chunked else data
+        if chunked:
+            yield b"0\r\n\r\n"
+        request.source = None
+
+    async def iter_body(self, reader, framing, length):
+        """
+        This asynchronous generator yields a message body from a stream piece by piece, like SocketReader.iter_body. Every read must finish within read_timeout seconds.
+        """
+        if framing == "length":
+            async for data in self.iter_length(reader, length):
+                yield data
+        elif framing == "chunked":
+            while True:
+                size = int((await asyncio.wait_for(reader.readline(), self.read_timeout)).split(b";")[0], 16)
+                if size == 0:
+                    # Skip the trailers
+                    while (await asyncio.wait_for(reader.readline(), self.read_timeout)).strip():
+                        pass
+                    return
+                async for data in self.iter_length(reader, size):
+                    yield data
+                await asyncio.wait_for(reader.readexactly(2), self.read_timeout)
+        elif framing == "close":
+            while True:
+                data = await asyncio.wait_for(reader.read(65536), self.read_timeout)
+                if not data:
+                    return
+                yield data
+
+    async def iter_length(self, reader, length):
+        """
+        This asynchronous generator yields exactly length bytes from a stream.
+        """
+        remaining = length
+        while remaining:
+            data = await asyncio.wait_for(reader.read(min(remaining, 65536)), self.read_timeout)
+            if not data:
+                raise asyncio.IncompleteReadError(b"", remaining)
+            remaining -= len(data)
+            yield data
+
+    async def refuse_async(self, client_writer, status, connection_id):
+        """
+        This coroutine answers a request that is not accepted by the proxy with an error response, like Proxy.refuse.
+        """
+        self.bad_requests.inc()
+        log.warning("[CONNECTION #%s] The request was refused with %s", connection_id, status)
+        client_writer.write(ERROR_RESPONSES[status])
+        await asyncio.wait_for(client_writer.drain(), self.write_timeout)
+
+    async def read_body(self, reader, framing, length):
+        """
+        This coroutine reads a message body from a stream. The framing and length should come from body_framing. Like in iter_body every read must finish within read_timeout seconds, so a large body that keeps arriving is not cut off.
+        """
+        body = bytearray()
+        async for data in self.iter_body(reader, framing, length):
+            body += data
+        return bytes(body)
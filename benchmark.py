@@ -0,0 +1,429 @@
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+import timeit
+from request import Request
+from response import Response
+from rewriter import compile_rewriter
+from timeparser import Time
+from socketreader import SocketReader, body_framing
+from logger import log, WARNING
+
+MODES = ("static", "chunked", "large", "slow")
+SCENARIOS = ("uncached", "cached", "manipulated")
+PROXIES = ("thread", "async")
+
+# The body of the origin is html, so the manipulated scenario has something to replace
+PAGE = b"<html><head><title>Benchmark</title></head><body>" + b"<p>Hello World, this is a benchmark page.</p>\n" * 4096 + b"</body></html>"
+
+REQUEST = b"GET http://example.com/index.html HTTP/1.1\r\nHost: example.com\r\nUser-Agent: benchmark\r\nAccept: text/html\r\nAccept-Encoding: gzip\r\nConnection: keep-alive\r\n\r\n"
+RESPONSE_HEAD = b"HTTP/1.1 200 OK\r\nDate: Fri, 15 Jan 2021 11:35:43 GMT\r\nServer: benchmark\r\nContent-Type: text/html\r\nCache-Control: max-age=3600\r\nLast-Modified: Fri, 1 Jan 2021 00:00:00 GMT\r\nContent-Length: %d\r\n\r\n"
+REQUEST_REPLACEMENTS = {"example.org": "example.com"}
+RESPONSE_REPLACEMENTS = {b"Hello": b"Howdy", b"World": b"Earth"}
+
+class Origin:
+    """
+    This class is a local HTTP server that stands in for the servers behind the proxy, so the benchmarks run offline and always see the same responses. Every connection is served by its own thread and kept open for as many requests as the client sends. The mode decides what every response looks like:
+
+    - "static": a html page of body_size bytes with a Content-Length, cacheable for an hour
+    - "chunked": the same page with chunked encoding, in chunks of 4096 bytes
+    - "large": a page of large_size bytes with a Content-Length
+    - "slow": the static page, sent after waiting delay seconds
+    """
+    def __init__(self, mode="static", body_size=16384, large_size=1024 * 1024, delay=0.05):
+        if mode not in MODES:
+            raise ValueError(f"Unknown origin mode {mode}")
+        self.mode = mode
+        self.delay = delay if mode == "slow" else 0
+        self.response = self.build(large_size if mode == "large" else body_size)
+        self.server = socket.create_server(("127.0.0.1", 0), backlog=1024)
+        self.port = self.server.getsockname()[1]
+        self.running = True
+        self.requests = 0
+
+    def build(self, size):
+        """
+        This function encodes the response of the origin once, it is sent unchanged for every request.
+        """
+        body = (PAGE * (size // len(PAGE) + 1))[:size]
+        if self.mode != "chunked":
+            return RESPONSE_HEAD % len(body) + body
+        head = RESPONSE_HEAD.split(b"Content-Length")[0] + b"Transfer-Encoding: chunked\r\n\r\n"
+        chunks = [b"%x\r\n%s\r\n" % (len(body[start:start + 4096]), body[start:start + 4096]) for start in range(0, len(body), 4096)]
+        return head + b"".join(chunks) + b"0\r\n\r\n"
+
+    def start(self):
+        """
+        This function starts accepting connections in a background thread and returns the origin.
+        """
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+    def run(self):
+        """
+        This function accepts connections until the origin is stopped.
+        """
+        while self.running:
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.handle, args=(connection,), daemon=True).start()
+
+    def handle(self, connection):
+        """
+        This function answers the requests on a connection until the client closes it.
+        """
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        reader = SocketReader(connection)
+        try:
+            while self.running:
+                head = reader.read_head()
+                if not head:
+                    return
+                # Requests to the origin have a path instead of a url, only the headers of the parsed request are used
+                request = Request(head)
+                framing, length = body_framing(request.headers, head.split(b" ", 1)[0].decode("latin-1"))
+                for _ in reader.iter_body(framing, length):
+                    pass
+                if self.delay:
+                    time.sleep(self.delay)
+                self.requests += 1
+                connection.sendall(self.response)
+        except (OSError, ValueError):
+            pass
+        finally:
+            connection.close()
+
+    def stop(self):
+        """
+        This function stops accepting connections.
+        """
+        self.running = False
+        self.server.close()
+
+class ProxyProcess:
+    """
+    This class runs a proxy configured for one scenario in a child process, so the load generator does not share the interpreter with it and its CPU time and memory can be measured on their own. The child is this file started with --serve. CPU time and peak memory are read from /proc, so they are only available on Linux.
+    """
+    def __init__(self, scenario, proxy="thread"):
+        if scenario not in SCENARIOS:
+            raise ValueError(f"Unknown scenario {scenario}")
+        if proxy not in PROXIES:
+            raise ValueError(f"Unknown proxy {proxy}")
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", scenario, "--proxy", proxy], stdout=subprocess.PIPE, cwd=os.path.dirname(os.path.abspath(__file__)))
+        line = self.process.stdout.readline()
+        if not line:
+            self.process.wait()
+            raise RuntimeError("The proxy process did not start")
+        self.port = int(line)
+
+    def cpu_time(self):
+        """
+        This function returns the CPU time in seconds that the proxy process has used so far, in user and system mode.
+        """
+        try:
+            with open(f"/proc/{self.process.pid}/stat") as stat:
+                # The name of the process can contain spaces, the fields after it are fixed
+                fields = stat.read().rsplit(")", 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def peak_rss(self):
+        """
+        This function returns the highest resident memory of the proxy process in bytes.
+        """
+        try:
+            with open(f"/proc/{self.process.pid}/status") as status:
+                for line in status:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1]) * 1024
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def stop(self):
+        """
+        This function stops the proxy process.
+        """
+        self.process.terminate()
+        try:
+            self.process.wait(5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process.stdout.close()
+
+def serve(scenario, proxy):
+    """
+    This function runs in the child process of ProxyProcess. It configures a proxy for a scenario on a free port, writes the port to stdout and serves until it is killed.
+    """
+    from proxy import Proxy
+    from asyncproxy import AsyncProxy
+    log.level = WARNING
+    log.access_log = False
+    server = (AsyncProxy if proxy == "async" else Proxy)("127.0.0.1", 0, 1024)
+    server.use_cache = scenario == "cached"
+    if scenario == "manipulated":
+        server.response_replacements = dict(RESPONSE_REPLACEMENTS)
+    server.max_connections = 4096
+    server.max_requests_per_connection = 1000000
+    sys.stdout.write(f"{server.server.getsockname()[1]}\n")
+    sys.stdout.flush()
+    server.run()
+
+def fetch(sock, reader, request):
+    """
+    This function sends a request on a connection and reads the complete response. Returns the status code and the size of the body.
+    """
+    sock.sendall(request)
+    response = Response(reader.read_head())
+    if not response.valid:
+        raise ConnectionError("The connection was closed")
+    framing, length = body_framing(response.headers, "GET", response.status_code)
+    size = 0
+    for data in reader.iter_body(framing, length):
+        size += len(data)
+    return response.status_code, size
+
+def run_load(port, url, concurrency=16, requests=1000, timeout=30):
+    """
+    This function sends requests for url to the proxy on port from concurrency threads, every thread over its own persistent connection, until requests responses have been received. Returns the latency of every successful request in seconds, the number of failed requests and the total time in seconds.
+    """
+    request = f"GET {url} HTTP/1.1\r\nHost: {url.split('/')[2]}\r\nUser-Agent: benchmark\r\nConnection: keep-alive\r\n\r\n".encode("utf-8")
+    remaining = [requests]
+    lock = threading.Lock()
+    latencies = []
+    errors = [0]
+
+    def client():
+        sock = None
+        own = []
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    break
+                remaining[0] -= 1
+            try:
+                if sock is None:
+                    sock = socket.create_connection(("127.0.0.1", port), timeout)
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    reader = SocketReader(sock)
+                started = time.perf_counter()
+                status, _ = fetch(sock, reader, request)
+                if status != "200":
+                    raise ConnectionError(f"Unexpected status {status}")
+                own.append(time.perf_counter() - started)
+            except (OSError, ValueError):
+                with lock:
+                    errors[0] += 1
+                if sock is not None:
+                    sock.close()
+                sock = None
+        if sock is not None:
+            sock.close()
+        with lock:
+            latencies.extend(own)
+
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0], time.perf_counter() - started
+
+def percentile(values, fraction):
+    """
+    This function returns the value below which a fraction of the sorted values lie, with linear interpolation between the two nearest values.
+    """
+    if not values:
+        return None
+    position = (len(values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+def benchmark_load(mode="static", scenario="uncached", proxy="thread", concurrency=16, requests=1000, warmup=50):
+    """
+    This function measures one scenario against an origin in one mode: it starts the origin and the proxy, sends warmup requests that are not measured, which also fills the cache, and then sends requests requests. Returns a dictionary with the throughput, the latency percentiles in milliseconds, the CPU time of the proxy per request in milliseconds and the peak memory of the proxy in MiB.
+    """
+    origin = Origin(mode).start()
+    server = ProxyProcess(scenario, proxy)
+    url = f"http://127.0.0.1:{origin.port}/index.html"
+    try:
+        run_load(server.port, url, min(concurrency, warmup) or 1, warmup)
+        cpu_before = server.cpu_time()
+        latencies, errors, elapsed = run_load(server.port, url, concurrency, requests)
+        cpu_after = server.cpu_time()
+        peak_rss = server.peak_rss()
+    finally:
+        server.stop()
+        origin.stop()
+    latencies.sort()
+    result = {
+        "mode": mode,
+        "scenario": scenario,
+        "proxy": proxy,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "latency_ms": {name: round(percentile(latencies, fraction) * 1000, 3) if latencies else None for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99), ("max", 1.0))},
+        "cpu_ms_per_request": round((cpu_after - cpu_before) * 1000 / len(latencies), 4) if latencies and cpu_before is not None and cpu_after is not None else None,
+        "peak_rss_mb": round(peak_rss / 1048576, 1) if peak_rss is not None else None,
+    }
+    return result
+
+def micro_benchmarks():
+    """
+    This function returns the functions that are measured by the micro-benchmarks, by name. They cover the work the proxy does for every request, without any sockets.
+    """
+    body = PAGE[:16384]
+    response_data = RESPONSE_HEAD % len(body) + body
+    request = Request(REQUEST)
+    response = Response(response_data)
+    rewriter = compile_rewriter(tuple(RESPONSE_REPLACEMENTS.items()))
+    date = "Fri, 15 Jan 2021 11:35:43 GMT"
+    time1 = Time(date)
+    time2 = Time("Fri, 14 Jan 2021 11:32:43 GMT")
+
+    def manipulate_request():
+        request.line = "GET http://example.com/index.html HTTP/1.1"
+        request.manipulate(REQUEST_REPLACEMENTS, 0)
+
+    def manipulate_response():
+        response.body = body
+        response.manipulate(rewriter, 0)
+
+    return {
+        "request_parse": lambda: Request(REQUEST),
+        "request_encode": request.encode,
+        "request_manipulate": manipulate_request,
+        "response_parse": lambda: Response(response_data),
+        "response_encode": response.encode,
+        "response_manipulate": manipulate_response,
+        "time_parse": lambda: Time(date),
+        "time_compare": lambda: time1 > time2,
+    }
+
+def run_micro(names=None, repeat=5, min_time=0.2):
+    """
+    This function runs the micro-benchmarks. Every benchmark is timed repeat times for at least min_time seconds, and the fastest run is reported in nanoseconds per call, which is the least disturbed by other work on the machine.
+    """
+    results = {}
+    for name, function in micro_benchmarks().items():
+        if names and name not in names:
+            continue
+        timer = timeit.Timer(function)
+        number, _ = timer.autorange()
+        number = max(1, int(number * min_time / 0.2))
+        best = min(timer.repeat(repeat, number)) / number
+        results[name] = {"ns_per_op": round(best * 1e9, 1), "iterations": number}
+    return results
+
+def compare(current, baseline):
+    """
+    This function compares two reports of run and returns a list of lines with the relative change of every measurement that is in both. Positive changes are improvements: more requests per second, or less time, CPU and memory.
+    """
+    lines = []
+
+    def change(name, new, old, higher_is_better=False):
+        if new is None or not old:
+            return
+        percent = (new - old) / old * 100
+        lines.append(f"{name}: {old} -> {new} ({percent if higher_is_better else -percent:+.1f}%)")
+
+    for name, result in current.get("micro", {}).items():
+        if name in baseline.get("micro", {}):
+            change(f"micro {name} ns/op", result["ns_per_op"], baseline["micro"][name]["ns_per_op"])
+    old_loads = {(load["mode"], load["scenario"], load["proxy"], load["concurrency"]): load for load in baseline.get("load", [])}
+    for load in current.get("load", []):
+        old = old_loads.get((load["mode"], load["scenario"], load["proxy"], load["concurrency"]))
+        if old is None:
+            continue
+        name = f"load {load['mode']}/{load['scenario']}/{load['proxy']}/c{load['concurrency']}"
+        change(f"{name} req/s", load["requests_per_second"], old["requests_per_second"], True)
+        for percent in ("p50", "p99"):
+            change(f"{name} {percent} ms", load["latency_ms"][percent], old["latency_ms"][percent])
+        change(f"{name} cpu ms/req", load["cpu_ms_per_request"], old["cpu_ms_per_request"])
+        change(f"{name} peak MiB", load["peak_rss_mb"], old["peak_rss_mb"])
+    return lines
+
+def run(modes=MODES, scenarios=SCENARIOS, proxies=("thread",), concurrency=(16,), requests=1000, micro=True, load=True):
+    """
+    This function runs the micro-benchmarks and every combination of origin mode, scenario, proxy and concurrency, and returns a report that can be written as JSON.
+    """
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "commit": git_commit(),
+        },
+    }
+    if micro:
+        report["micro"] = run_micro()
+    if load:
+        report["load"] = []
+        for mode in modes:
+            for scenario in scenarios:
+                for proxy in proxies:
+                    for clients in concurrency:
+                        report["load"].append(benchmark_load(mode, scenario, proxy, clients, requests))
+    return report
+
+def git_commit():
+    """
+    This function returns the commit of the checked out code, or None if it is not a git repository.
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def main(arguments=None):
+    """
+    This function parses the command line, runs the benchmarks and writes the report.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the proxy against a local origin.")
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES), help="origin modes to benchmark")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS), help="proxy scenarios to benchmark")
+    parser.add_argument("--proxies", nargs="+", choices=PROXIES, default=["thread"], help="proxy implementations to benchmark")
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[16], help="numbers of concurrent client connections")
+    parser.add_argument("--requests", type=int, default=1000, help="measured requests for every combination")
+    parser.add_argument("--micro-only", action="store_true", help="only run the micro-benchmarks")
+    parser.add_argument("--load-only", action="store_true", help="only run the load tests")
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    parser.add_argument("--compare", help="compare the results with an earlier JSON report")
+    parser.add_argument("--serve", choices=SCENARIOS, help=argparse.SUPPRESS)
+    parser.add_argument("--proxy", choices=PROXIES, default="thread", help=argparse.SUPPRESS)
+    options = parser.parse_args(arguments)
+    if options.serve:
+        serve(options.serve, options.proxy)
+        return
+    report = run(options.modes, options.scenarios, options.proxies, options.concurrency, options.requests, not options.load_only, not options.micro_only)
+    output = json.dumps(report, indent=2)
+    if options.output:
+        with open(options.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+    if options.compare:
+        with open(options.compare) as file:
+            baseline = json.load(file)
+        for line in compare(report, baseline):
+            print(line, file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+import threading
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+
+CACHEABLE_STATUS_CODES = ("200", "203", "204", "300", "301", "404", "405", "410", "414", "501")
+
+class CacheEntry:
+    """
+    This class represents a response stored in the cache. The entry is fresh until the time expires, after that it can only be used if it is validated.
+    """
+    def __init__(self, key, response, size, expires):
+        self.key = key
+        self.response = response
+        self.size = size
+        self.expires = expires
+        self.stored = time.time()
+
+    def fresh(self):
+        """
+        This function returns True if the entry can be used without asking the server.
+        """
+        return time.time() < self.expires
+
+    def staleness(self):
+        """
+        This function returns the number of seconds since the entry stopped being fresh.
+        """
+        return time.time() - self.expires
+
+    def stale_time(self, directive, default=0):
+        """
+        This function returns for how many seconds the entry may be used after it has become stale, from the Cache-Control directive stale-while-revalidate or stale-if-error of the response. The default is used if the response does not have the directive.
+        """
+        value = parse_cache_control(self.response.headers.get("Cache-Control", "")).get(directive)
+        try:
+            return int(value) if value else default
+        except ValueError:
+            return default
+
+class Cache:
+    """
+    This class is the response cache of the proxy. It is safe to use from several threads. The total size of the stored responses is limited to max_size bytes, when it is exceeded the least recently used responses are evicted. Responses larger than max_entry_size are never stored. The names in the Vary header of the responses are kept for every url that has entries, together with the number of its entries, and are counted in the size as well. They are removed with the last entry of the url.
+
+    Stored responses are frozen, see Response.freeze, and must not be changed afterwards since they are shared by all connections that are answered from the cache. The fingerprint identifies the rules the responses are manipulated with, it is part of every key, so responses stored with other rules are not found anymore when the rules change.
+    """
+    def __init__(self, max_size=64 * 1024 * 1024, max_entry_size=8 * 1024 * 1024):
+        self.max_size = max_size
+        self.max_entry_size = max_entry_size
+        self.entries = OrderedDict()
+        self.vary = {}
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.fingerprint = ""
+
+    def key(self, url, headers):
+        """
+        This function returns the cache key of a request. The key contains the values of all request headers listed in the Vary header of the stored response and the fingerprint.
+        """
+        record = self.vary.get(url)
+        return (url, tuple(headers.get(name, "").strip() for name in record[0]) if record is not None else (), self.fingerprint)
+
+    def lookup(self, request):
+        """
+        This function returns the entry stored for a request, fresh or not, or None.
+        """
+        with self.lock:
+            entry = self.entries.get(self.key(request.url, request.headers))
+            if entry is not None:
+                self.entries.move_to_end(entry.key)
+            return entry
+
+    def record(self, hit):
+        """
+        This function counts a cache hit or miss.
+        """
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def cacheable(self, request, response):
+        """
+        This function returns True if the response may be stored in the cache. Responses are not stored if the request or response contains no-store, if the response is private or if the request was authorized and the response is not public.
+        """
+        if request.method != "GET" or response.status_code not in CACHEABLE_STATUS_CODES:
+            return False
+        request_control = parse_cache_control(request.headers.get("Cache-Control", ""))
+        response_control = parse_cache_control(response.headers.get("Cache-Control", ""))
+        if "no-store" in request_control or "no-store" in response_control or "private" in response_control:
+            return False
+        if "Authorization" in request.headers and "public" not in response_control:
+            return False
+        return response.headers.get("Vary", "").strip() != "*"
+
+    def store(self, request, response):
+        """
+        This function stores a response in the cache if it is cacheable. Returns True if the response was stored.
+        """
+        if not self.cacheable(request, response):
+            return False
+        vary = tuple(name.strip() for name in response.headers.get("Vary", "").split(",") if name.strip())
+        key = (request.url, tuple(request.headers.get(name, "").strip() for name in vary), self.fingerprint)
+        return self.insert(key, response, vary)
+
+    def insert(self, key, response, vary=None):
+        """
+        This function stores a response under a key and evicts the least recently used entries until the cache fits in max_size. vary are the names in the Vary header of the response, if it is None the names already known for the url are kept.
+        """
+        size = len(response.line) + len(response.body) + sum(len(name) + len(value) + 3 for name, value in response.headers.items())
+        if size > self.max_entry_size:
+            return False
+        entry = CacheEntry(key, response.freeze(), size, time.time() + freshness_lifetime(response))
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.forget(old)
+            self.entries[key] = entry
+            self.size += size
+            record = self.vary.get(key[0])
+            if record is None:
+                record = self.vary[key[0]] = [vary or (), 0]
+                self.size += vary_size(key[0], record[0])
+            elif vary is not None and vary != record[0]:
+                self.size += vary_size(key[0], vary) - vary_size(key[0], record[0])
+                record[0] = vary
+            record[1] += 1
+            while self.size > self.max_size and self.entries:
+                _, evicted = self.entries.popitem(last=False)
+                self.forget(evicted)
+                self.evictions += 1
+        return True
+
+    def forget(self, entry):
+        """
+        This function subtracts the size of an entry that was taken out of the cache, and removes the Vary names of its url with its last entry. The lock must be held.
+        """
+        self.size -= entry.size
+        url = entry.key[0]
+        record = self.vary[url]
+        record[1] -= 1
+        if record[1] == 0:
+            del self.vary[url]
+            self.size -= vary_size(url, record[0])
+
+    def get(self, key):
+        """
+        This function returns the response stored under a key, fresh or not, or None.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry.response
+
+    def remove(self, key):
+        """
+        This function removes an entry from the cache.
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.forget(entry)
+
+    def clear(self):
+        """
+        This function removes all entries from the cache.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.vary.clear()
+            self.size = 0
+
+    def __setitem__(self, url, response):
+        self.insert((url, (), self.fingerprint), response)
+
+    def __getitem__(self, url):
+        with self.lock:
+            return self.entries[(url, (), self.fingerprint)].response
+
+    def __contains__(self, url):
+        return (url, (), self.fingerprint) in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+def vary_size(url, names):
+    """
+    This function returns the number of bytes that the Vary names of a url are counted with.
+    """
+    return len(url) + sum(len(name) for name in names)
+
+def parse_cache_control(value):
+    """
+    This function parses a Cache-Control header into a dictionary. Directives without a value are mapped to None.
+    """
+    directives = {}
+    for directive in value.split(","):
+        name, _, argument = directive.strip().partition("=")
+        if name:
+            directives[name.lower()] = argument.strip('"') if argument else None
+    return directives
+
+def freshness_lifetime(response):
+    """
+    This function returns the number of seconds a response is fresh, from s-maxage or max-age in Cache-Control or else from the Expires header. Responses without this information are not fresh at all.
+    """
+    control = parse_cache_control(response.headers.get("Cache-Control", ""))
+    if "no-cache" in control:
+        return 0
+    for directive in ("s-maxage", "max-age"):
+        if control.get(directive):
+            try:
+                return max(0, int(control[directive]))
+            except ValueError:
+                return 0
+    if "Expires" in response.headers:
+        try:
+            expires = parsedate_to_datetime(response.headers["Expires"].strip()).timestamp()
+            date = parsedate_to_datetime(response.headers["Date"].strip()).timestamp() if "Date" in response.headers else time.time()
+            return max(0, expires - date)
+        except (TypeError, ValueError):
+            return 0
+    return 0
@@ -0,0 +1,151 @@
+import socket
+import threading
+import time
+from socketreader import SocketReader
+
+class PooledConnection:
+    """
+    This class represents a connection to a server. The reader is used to receive the responses and reused tells if the connection has been used for an earlier request.
+    """
+    def __init__(self, address, sock):
+        self.address = address
+        self.sock = sock
+        self.reader = SocketReader(sock)
+        self.reused = False
+        self.last_used = time.monotonic()
+
+    def close(self):
+        """
+        This function closes the connection.
+        """
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+class ConnectionPool:
+    """
+    This class keeps persistent connections to the servers so that later requests to the same host can reuse them instead of opening a new TCP connection. At most max_size idle connections are kept per host and at most max_idle in total, when there are more the connection that has been idle longest is closed. Connections that have been idle longer than idle_timeout seconds are closed, for all hosts, by a sweep that runs at most once a second when a connection is acquired or released. New connections are opened with the resolver if one is given, see Resolver.connect, otherwise with socket.create_connection.
+    """
+    def __init__(self, max_size=8, idle_timeout=30, resolver=None, max_idle=256):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.resolver = resolver
+        self.max_idle = max_idle
+        self.connections = {}
+        self.idle = 0
+        self.swept = time.monotonic()
+        self.lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    def acquire(self, address, timeout=None):
+        """
+        This function returns a healthy idle connection to the address if there is one, otherwise a new connection is opened. The timeout is the number of seconds to wait for a new connection to be established.
+        """
+        self.sweep()
+        with self.lock:
+            idle = self.connections.get(address, [])
+            while idle:
+                connection = idle.pop()
+                self.idle -= 1
+                if not idle:
+                    del self.connections[address]
+                if self.healthy(connection):
+                    connection.reused = True
+                    self.reused += 1
+                    return connection
+                connection.close()
+            self.created += 1
+        if self.resolver is not None:
+            sock = self.resolver.connect(address, timeout)
+        else:
+            sock = socket.create_connection(address, timeout)
+        no_delay(sock)
+        return PooledConnection(address, sock)
+
+    def release(self, connection):
+        """
+        This function gives a connection back to the pool after a complete response has been read from it.
+        """
+        connection.last_used = time.monotonic()
+        self.sweep()
+        oldest = None
+        with self.lock:
+            idle = self.connections.get(connection.address, [])
+            if len(idle) >= self.max_size or self.max_idle <= 0:
+                oldest = connection
+            else:
+                if self.idle >= self.max_idle:
+                    # The lists are in the order the connections were released, the oldest is first
+                    address = min(self.connections, key=lambda address: self.connections[address][0].last_used)
+                    oldest = self.connections[address].pop(0)
+                    self.idle -= 1
+                    if not self.connections[address]:
+                        del self.connections[address]
+                self.connections.setdefault(connection.address, []).append(connection)
+                self.idle += 1
+        if oldest is not None:
+            oldest.close()
+
+    def sweep(self, force=False):
+        """
+        This function closes the connections of all hosts that have been idle longer than idle_timeout and forgets hosts without idle connections. Unless force is True it only runs if the last sweep was more than a second ago.
+        """
+        now = time.monotonic()
+        if not force and now - self.swept < 1:
+            return
+        expired = []
+        with self.lock:
+            self.swept = now
+            for address, idle in list(self.connections.items()):
+                keep = [connection for connection in idle if now - connection.last_used <= self.idle_timeout]
+                expired += [connection for connection in idle if now - connection.last_used > self.idle_timeout]
+                if keep:
+                    self.connections[address] = keep
+                else:
+                    del self.connections[address]
+            self.idle -= len(expired)
+        for connection in expired:
+            connection.close()
+
+    def healthy(self, connection):
+        """
+        This function checks that an idle connection can be used again. It must not have been idle too long and the server must not have closed it or sent unexpected data.
+        """
+        if time.monotonic() - connection.last_used > self.idle_timeout or connection.reader.buffer:
+            return False
+        timeout = connection.sock.gettimeout()
+        try:
+            connection.sock.settimeout(0)
+            connection.sock.recv(1, socket.MSG_PEEK)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        finally:
+            try:
+                connection.sock.settimeout(timeout)
+            except OSError:
+                pass
+        return False
+
+    def close(self):
+        """
+        This function closes all idle connections.
+        """
+        with self.lock:
+            for idle in self.connections.values():
+                for connection in idle:
+                    connection.close()
+            self.connections.clear()
+            self.idle = 0
+
+def no_delay(sock):
+    """
+    This function turns off Nagle's algorithm on a TCP socket, so small writes like the head of a message are sent at once instead of waiting for the acknowledgement of the previous write. Other sockets are not changed.
+    """
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        pass
@@ -0,0 +1,312 @@
+import mmap
+import os
+import queue
+import re
+import struct
+import threading
+import time
+import zlib
+from cache import CacheEntry, freshness_lifetime
+from response import Response
+from logger import log
+
+# Every record starts with: magic, checksum, metadata length, head length, body length and expiry time. The checksum covers the metadata, the head and the body.
+RECORD = struct.Struct(">4sIIIQd")
+MAGIC = b"PXC2"
+SEGMENT_NAME = re.compile(r"^segment-(\d+)\.dat$")
+
+class DiskRecord:
+    """
+    This class tells where a stored response can be found on disk.
+    """
+    def __init__(self, segment, head_offset, head_length, body_length, expires, size):
+        self.segment = segment
+        self.head_offset = head_offset
+        self.head_length = head_length
+        self.body_length = body_length
+        self.expires = expires
+        self.size = size
+
+class DiskCache:
+    """
+    This class is a persistent cache tier that stores responses on local disk, so the cache survives restarts of the proxy. Like in Cache, responses are only found with the fingerprint they were stored with. Responses are appended to segment files and an index in memory tells where every response is stored. The index is rebuilt at startup by reading the segments, every complete record is checked against its checksum and anything from the first record that was not completely written because of a crash, or that is damaged, is cut off. When the total size of the segments is larger than max_size the oldest segment is deleted. The bodies of stored responses are returned as memoryviews of memory-mapped segments, so they are never copied into Python memory.
+
+    The space for a record is reserved while the lock is held, but the record is written after the lock has been released, so lookups never wait for the disk. The proxy stores responses with store_later, which leaves the writing to a background thread.
+    """
+    def __init__(self, directory, max_size=1024 * 1024 * 1024, segment_size=64 * 1024 * 1024, max_entry_size=64 * 1024 * 1024, sync=False, queue_size=256, max_queued_size=64 * 1024 * 1024):
+        """
+        If sync is True every record is flushed to the disk with fsync after it has been written. At most queue_size responses with bodies of at most max_queued_size bytes together wait for the background thread, see store_later.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_size = max_size
+        self.segment_size = segment_size
+        self.max_entry_size = max_entry_size
+        self.sync = sync
+        self.index = {}
+        self.segments = {}
+        self.maps = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.evictions = 0
+        self.fingerprint = ""
+        self.writing = 0
+        self.retired = []
+        self.queue = queue.Queue(queue_size)
+        self.max_queued_size = max_queued_size
+        self.queued = 0
+        self.writer = None
+
+        for name in sorted(os.listdir(directory)):
+            match = SEGMENT_NAME.match(name)
+            if match:
+                self.load_segment(int(match.group(1)))
+        self.active = max(self.segments, default=0)
+        if not self.segments:
+            self.active = 1
+            self.segments[1] = 0
+        self.fd = os.open(self.path(self.active), os.O_WRONLY | os.O_CREAT, 0o644)
+
+    def path(self, segment):
+        """
+        This function returns the path of a segment file.
+        """
+        return os.path.join(self.directory, f"segment-{segment:06d}.dat")
+
+    def load_segment(self, segment):
+        """
+        This function adds all complete records in a segment to the index. Anything after the last complete record is removed from the file.
+        """
+        with open(self.path(segment), "r+b") as file:
+            size = os.fstat(file.fileno()).st_size
+            offset = 0
+            if size:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data, memoryview(data) as view:
+                    while offset + RECORD.size <= size:
+                        magic, checksum, meta_length, head_length, body_length, expires = RECORD.unpack_from(data, offset)
+                        meta_offset = offset + RECORD.size
+                        end = meta_offset + meta_length + head_length + body_length
+                        if magic != MAGIC or end > size or zlib.crc32(view[meta_offset:end]) != checksum:
+                            break
+                        url, vary = decode_meta(data[meta_offset:meta_offset + meta_length])
+                        self.add(url, vary, DiskRecord(segment, meta_offset + meta_length, head_length, body_length, expires, end - offset))
+                        offset = end
+            if offset < size:
+                file.truncate(offset)
+        self.segments[segment] = offset
+
+    def add(self, url, vary, record):
+        """
+        This function adds a record to the index, replacing an older record for the same request.
+        """
+        self.index.setdefault(url, {})[vary] = record
+
+    def store(self, request, response):
+        """
+        This function appends a response to the active segment. The response should be cacheable. Returns True if the response was stored.
+        """
+        record = self.prepare(request, response)
+        return record is not None and self.write(*record)
+
+    def store_later(self, request, response, reserved=0):
+        """
+        This function queues a response to be stored by a background thread, so the thread that handles the request does not wait for the disk. The thread is started with the first queued response. reserved is the number of bytes of the body that were already reserved for it, see reserve. Returns False if the response is not stored because the queue is full or the response is too large.
+        """
+        record = self.prepare(request, response)
+        if record is None or not self.reserve(len(response.body) - reserved):
+            self.release(reserved)
+            return False
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.release(len(response.body))
+            return False
+        with self.lock:
+            if self.writer is None:
+                self.writer = threading.Thread(target=self.write_queued, name="DiskCache", daemon=True)
+                self.writer.start()
+        return True
+
+    def write_queued(self):
+        """
+        This function is the loop of the background thread that stores the queued responses.
+        """
+        while True:
+            record = self.queue.get()
+            try:
+                self.write(*record)
+            except OSError as error:
+                log.error("[DISK CACHE] Could not store %s: %r", record[0], error)
+            finally:
+                self.release(len(record[3]))
+                self.queue.task_done()
+
+    def reserve(self, size):
+        """
+        This function reserves size bytes of the memory that bodies waiting for the background thread may use. Returns False if that would be more than max_queued_size bytes.
+        """
+        with self.lock:
+            if self.queued + size > self.max_queued_size:
+                return False
+            self.queued += size
+            return True
+
+    def release(self, size):
+        """
+        This function gives back bytes that were reserved with reserve.
+        """
+        with self.lock:
+            self.queued -= size
+
+    def flush(self):
+        """
+        This function waits until all queued responses are stored.
+        """
+        self.queue.join()
+
+    def prepare(self, request, response):
+        """
+        This function returns the URL, the Vary values, the encoded head, the body and the expiry time that are stored for a response, or None if the body is larger than max_entry_size. The head is encoded right away since the response may be changed after it has been queued.
+        """
+        if len(response.body) > self.max_entry_size:
+            return None
+        names = [name.strip() for name in response.headers.get("Vary", "").split(",") if name.strip()]
+        vary = tuple((name, request.headers.get(name, "").strip()) for name in names)
+        if self.fingerprint:
+            # Stored like a Vary value with an empty name, which is never a header
+            vary += (("", self.fingerprint),)
+        return request.url, vary, response.encode_head(), response.body, time.time() + freshness_lifetime(response)
+
+    def write(self, url, vary, head, body, expires):
+        """
+        This function writes a record to the space reserved for it in the active segment and adds it to the index when it is complete. Returns True if the response was stored.
+        """
+        meta = encode_meta(url, vary)
+        size = RECORD.size + len(meta) + len(head) + len(body)
+        checksum = zlib.crc32(body, zlib.crc32(head, zlib.crc32(meta)))
+        with self.lock:
+            if self.segments[self.active] and self.segments[self.active] + size > self.segment_size:
+                self.rotate()
+            segment, fd, offset = self.active, self.fd, self.segments[self.active]
+            self.segments[segment] = offset + size
+            self.writing += 1
+
+        stored = False
+        try:
+            write_all(fd, (RECORD.pack(MAGIC, checksum, len(meta), len(head), len(body), expires), meta, head, body), offset)
+            if self.sync:
+                os.fsync(fd)
+            stored = True
+        finally:
+            with self.lock:
+                self.writing -= 1
+                if not self.writing:
+                    for retired in self.retired:
+                        os.close(retired)
+                    self.retired.clear()
+                # The segment may have been evicted while the record was written
+                if stored and segment in self.segments:
+                    self.add(url, vary, DiskRecord(segment, offset + RECORD.size + len(meta), len(head), len(body), expires, size))
+                while sum(self.segments.values()) > self.max_size and len(self.segments) > 1:
+                    self.evict(min(self.segments))
+        return stored
+
+    def rotate(self):
+        """
+        This function starts a new active segment. The file of the old segment is closed when no record is being written to it anymore.
+        """
+        self.retired.append(self.fd)
+        self.active += 1
+        self.segments[self.active] = 0
+        self.fd = os.open(self.path(self.active), os.O_WRONLY | os.O_CREAT, 0o644)
+
+    def evict(self, segment):
+        """
+        This function deletes a segment and removes all its records from the index.
+        """
+        for url in list(self.index):
+            variants = self.index[url]
+            for vary in [vary for vary, record in variants.items() if record.segment == segment]:
+                del variants[vary]
+                self.evictions += 1
+            if not variants:
+                del self.index[url]
+        del self.segments[segment]
+        # The memory map is not closed since responses that are being sent can still use it
+        self.maps.pop(segment, None)
+        try:
+            os.remove(self.path(segment))
+        except OSError:
+            pass
+
+    def map(self, segment, end):
+        """
+        This function returns a memory map of a segment that is at least end bytes long.
+        """
+        data = self.maps.get(segment)
+        if data is None or len(data) < end:
+            with open(self.path(segment), "rb") as file:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[segment] = data
+        return data
+
+    def lookup(self, request):
+        """
+        This function returns a cache entry for a request or None. The body of the response is a memoryview of the segment.
+        """
+        with self.lock:
+            variants = self.index.get(request.url, {})
+            for vary, record in variants.items():
+                if dict(vary).get("", "") == self.fingerprint and all(request.headers.get(name, "").strip() == value for name, value in vary if name):
+                    break
+            else:
+                return None
+            data = self.map(record.segment, record.head_offset + record.head_length + record.body_length)
+            self.hits += 1
+        view = memoryview(data)
+        response = Response(bytes(view[record.head_offset:record.head_offset + record.head_length]))
+        body_offset = record.head_offset + record.head_length
+        response.body = view[body_offset:body_offset + record.body_length]
+        # A record is never changed, where it is stored identifies its content
+        response.version = ("disk", record.segment, record.head_offset)
+        return CacheEntry((request.url, vary), response, record.size, record.expires)
+
+    def __len__(self):
+        return sum(len(variants) for variants in self.index.values())
+
+    def close(self):
+        """
+        This function stores the queued responses and closes the segment files.
+        """
+        self.flush()
+        with self.lock:
+            for fd in self.retired + [self.fd]:
+                os.close(fd)
+            self.retired.clear()
+
+def write_all(fd, buffers, offset):
+    """
+    This function writes buffers to a file at an offset with a single system call, continuing after a partial write.
+    """
+    buffers = [memoryview(data).cast("B") for data in buffers if len(data)]
+    while buffers:
+        written = os.pwritev(fd, buffers, offset)
+        offset += written
+        while buffers and written >= len(buffers[0]):
+            written -= len(buffers[0])
+            buffers.pop(0)
+        if buffers:
+            buffers[0] = buffers[0][written:]
+
+def encode_meta(url, vary):
+    """
+    This function encodes the URL and the Vary values of a request to the metadata of a record.
+    """
+    return "\n".join([url] + [f"{name}:{value}" for name, value in vary]).encode("utf-8")
+
+def decode_meta(data):
+    """
+    This function decodes the metadata of a record to the URL and the Vary values.
+    """
+    url, *vary = bytes(data).decode("utf-8").split("\n")
+    return url, tuple(tuple(item.split(":", 1)) for item in vary)
@@ -0,0 +1,167 @@
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Content types that are worth compressing, besides text/*
+COMPRESSIBLE_TYPES = ("json", "javascript", "xml", "svg", "wasm")
+
+class ZlibEncoder:
+    """
+    This class compresses a body piece by piece with gzip or deflate.
+    """
+    def __init__(self, encoding, level=6):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16 if encoding in ("gzip", "x-gzip") else zlib.MAX_WBITS)
+
+    def compress(self, data):
+        """
+        This function compresses a piece of the body. The result can be empty, the compressor may keep data until the next piece.
+        """
+        return self.compressor.compress(data)
+
+    def flush(self):
+        """
+        This function returns the rest of the output after the last piece.
+        """
+        return self.compressor.flush()
+
+class ZlibDecoder:
+    """
+    This class decompresses a gzip or deflate body piece by piece. Deflate bodies without the zlib header, which some servers send, are also accepted.
+    """
+    def __init__(self, encoding):
+        self.gzip = encoding in ("gzip", "x-gzip")
+        self.decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16 if self.gzip else zlib.MAX_WBITS)
+        self.started = False
+
+    def decompress(self, data):
+        """
+        This function decompresses a piece of the body.
+        """
+        if not self.started and data and not self.gzip:
+            self.started = True
+            try:
+                return self.decompressor.decompress(data)
+            except zlib.error:
+                self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self.decompressor.decompress(data)
+
+    def flush(self):
+        """
+        This function returns the rest of the output after the last piece.
+        """
+        return self.decompressor.flush()
+
+class BrotliEncoder:
+    """
+    This class compresses a body piece by piece with brotli.
+    """
+    def __init__(self, encoding, level=6):
+        self.compressor = brotli.Compressor(quality=min(level, 11))
+
+    def compress(self, data):
+        """
+        This function compresses a piece of the body. The result can be empty, the compressor may keep data until the next piece.
+        """
+        return self.compressor.process(bytes(data))
+
+    def flush(self):
+        """
+        This function returns the rest of the output after the last piece.
+        """
+        return self.compressor.finish()
+
+class BrotliDecoder:
+    """
+    This class decompresses a brotli body piece by piece.
+    """
+    def __init__(self, encoding):
+        self.decompressor = brotli.Decompressor()
+
+    def decompress(self, data):
+        """
+        This function decompresses a piece of the body.
+        """
+        return self.decompressor.process(bytes(data))
+
+    def flush(self):
+        """
+        This function returns the rest of the output after the last piece.
+        """
+        return b""
+
+def supported(encoding):
+    """
+    This function returns True if the proxy can decompress and compress a content coding. Brotli is only supported if the brotli module is installed.
+    """
+    return encoding in ("gzip", "x-gzip", "deflate") or (encoding == "br" and brotli is not None)
+
+def encoder(encoding, level=6):
+    """
+    This function returns an object that compresses data with a content coding.
+    """
+    if encoding == "br" and brotli is not None:
+        return BrotliEncoder(encoding, level)
+    if encoding in ("gzip", "x-gzip", "deflate"):
+        return ZlibEncoder(encoding, level)
+    raise ValueError(f"Unsupported content coding {encoding}")
+
+def decoder(encoding):
+    """
+    This function returns an object that decompresses data with a content coding.
+    """
+    if encoding == "br" and brotli is not None:
+        return BrotliDecoder(encoding)
+    if encoding in ("gzip", "x-gzip", "deflate"):
+        return ZlibDecoder(encoding)
+    raise ValueError(f"Unsupported content coding {encoding}")
+
+def compress(encoding, data, level=6):
+    """
+    This function compresses a complete body.
+    """
+    compressor = encoder(encoding, level)
+    return compressor.compress(data) + compressor.flush()
+
+def decompress(encoding, data):
+    """
+    This function decompresses a complete body.
+    """
+    decompressor = decoder(encoding)
+    return decompressor.decompress(data) + decompressor.flush()
+
+def content_encoding(headers):
+    """
+    This function returns the content coding of a message, or an empty string if it is not encoded.
+    """
+    encoding = headers.get("Content-Encoding", "").strip().lower()
+    return "" if encoding == "identity" else encoding
+
+def negotiate(accept_encoding, encodings=("br", "gzip")):
+    """
+    This function chooses the first of the encodings that the client accepts according to its Accept-Encoding header and the proxy supports. Returns None if there is none.
+    """
+    accepted = {}
+    for item in accept_encoding.lower().split(","):
+        name, _, parameters = item.strip().partition(";")
+        quality = 1.0
+        if parameters.strip().startswith("q="):
+            try:
+                quality = float(parameters.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            accepted[name.strip()] = quality
+    for encoding in encodings:
+        if supported(encoding) and accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return None
+
+def compressible(content_type):
+    """
+    This function returns True if a content type is worth compressing.
+    """
+    content_type = content_type.lower()
+    return "text" in content_type or any(name in content_type for name in COMPRESSIBLE_TYPES)
@@ -0,0 +1,78 @@
+import re
+from collections.abc import MutableMapping
+
+HEAD_END = re.compile(rb"\r\n\r\n")
+
+class Headers(MutableMapping):
+    """
+    This class stores the headers of a HTTP message. Names are case-insensitive and a header can have several values, the normal dictionary methods work on the first value of every header. The original names and values are kept so the message can be encoded exactly as it was received.
+    """
+    def __init__(self, items=()):
+        self.fields = {}
+        for name, value in items:
+            self.add(name, value)
+
+    def add(self, name, value):
+        """
+        This function adds a value to a header without removing the values it already has.
+        """
+        self.fields.setdefault(name.lower(), []).append((name, value))
+
+    def get_all(self, name):
+        """
+        This function returns a list with all values of a header.
+        """
+        return [value for _, value in self.fields.get(name.lower(), ())]
+
+    def raw_items(self):
+        """
+        This function returns all (name, value) pairs, including every value of headers that occur several times.
+        """
+        return [field for values in self.fields.values() for field in values]
+
+    def copy(self):
+        """
+        This function returns a copy of the headers.
+        """
+        return Headers(self.raw_items())
+
+    def __getitem__(self, name):
+        return self.fields[name.lower()][0][1]
+
+    def __setitem__(self, name, value):
+        self.fields[name.lower()] = [(name, value)]
+
+    def __delitem__(self, name):
+        del self.fields[name.lower()]
+
+    def __contains__(self, name):
+        return isinstance(name, str) and name.lower() in self.fields
+
+    def __iter__(self):
+        for values in self.fields.values():
+            yield values[0][0]
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __repr__(self):
+        return f"Headers({self.raw_items()!r})"
+
+def find_head_end(data, start=0):
+    """
+    This function returns the position right after the empty line that ends the header block, or -1 if the header block is not complete. The data can be bytes, a bytearray or a memoryview and is not copied. Use start to continue a search after more data has arrived.
+    """
+    match = HEAD_END.search(data, max(0, start - 3))
+    return match.end() if match else -1
+
+def parse_head(data, end):
+    """
+    This function parses the header block in data[:end]. Returns the start line and the headers. A UnicodeDecodeError is raised if the header block is not valid UTF-8.
+    """
+    lines = bytes(data[:end]).decode("utf-8").split("\r\n")
+    headers = Headers()
+    for line in lines[1:]:
+        name, separator, value = line.partition(":")
+        if separator:
+            headers.add(name, value)
+    return lines[0], headers
@@ -0,0 +1,175 @@
+import atexit
+import json
+import os
+import random
+import sys
+import threading
+import time
+import weakref
+from collections import deque
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVEL_NAMES = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR"}
+COLORS = {DEBUG: "\033[92m", INFO: "\033[95m", WARNING: "\033[93m", ERROR: "\033[91m"}
+
+class Logger:
+    """
+    This class writes log messages and access log lines without slowing down the threads that handle requests. Records are put in a queue and a background thread formats them and writes them in batches, so the handling threads never wait for the output. Messages below the level are dropped before anything is formatted, the arguments of a message are only formatted by the background thread. If the queue is full new records are dropped and counted in dropped.
+
+    The records are written to stream, or to sys.stdout if it is None. Every handled request can be written as one access log line in JSON. sample_rate is the part of the requests that is written, for example 0.01 for one in a hundred.
+    """
+    def __init__(self, stream=None, level=INFO, access_log=True, sample_rate=1.0, queue_size=10000, batch_size=256, flush_interval=0.2, colors=None):
+        self.stream = stream
+        self.level = level
+        self.access_log = access_log
+        self.sample_rate = sample_rate
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.colors = colors
+        self.records = deque()
+        self.wakeup = threading.Event()
+        self.writer = None
+        self.lock = threading.Lock()
+        self.dropped = 0
+        reference = weakref.ref(self)
+        atexit.register(lambda: reference() is not None and reference().flush())
+        if hasattr(os, "register_at_fork"):
+            # The writer thread does not exist in a forked process, a new one is started when it is needed
+            os.register_at_fork(after_in_child=lambda: reference() is not None and reference().forked())
+
+    def enabled(self, level):
+        """
+        This function returns True if messages of a level are written. Use it to skip work that is only needed for a message.
+        """
+        return level >= self.level
+
+    def log(self, level, message, *args):
+        """
+        This function writes a message if its level is high enough. The message is formatted with the % operator and args by the background thread.
+        """
+        if level >= self.level:
+            self.put((level, time.time(), message, args))
+
+    def debug(self, message, *args):
+        """
+        This function writes a message with the level DEBUG.
+        """
+        if DEBUG >= self.level:
+            self.put((DEBUG, time.time(), message, args))
+
+    def info(self, message, *args):
+        """
+        This function writes a message with the level INFO.
+        """
+        if INFO >= self.level:
+            self.put((INFO, time.time(), message, args))
+
+    def warning(self, message, *args):
+        """
+        This function writes a message with the level WARNING.
+        """
+        if WARNING >= self.level:
+            self.put((WARNING, time.time(), message, args))
+
+    def error(self, message, *args):
+        """
+        This function writes a message with the level ERROR.
+        """
+        if ERROR >= self.level:
+            self.put((ERROR, time.time(), message, args))
+
+    def sampled(self):
+        """
+        This function decides if the current request should be written to the access log. Call it before the fields of the access log line are collected.
+        """
+        return self.access_log and (self.sample_rate >= 1 or random.random() < self.sample_rate)
+
+    def access(self, fields):
+        """
+        This function writes an access log line with the fields of a request. The fields must be serializable to JSON.
+        """
+        self.put((None, time.time(), None, fields))
+
+    def put(self, record):
+        """
+        This function adds a record to the queue and wakes up the background thread.
+        """
+        if len(self.records) >= self.queue_size:
+            self.dropped += 1
+            return
+        self.records.append(record)
+        if self.writer is None:
+            self.start()
+        if len(self.records) >= self.batch_size:
+            self.wakeup.set()
+
+    def start(self):
+        """
+        This function starts the background thread.
+        """
+        with self.lock:
+            if self.writer is None:
+                self.writer = threading.Thread(target=self.write, daemon=True)
+                self.writer.start()
+
+    def write(self):
+        """
+        This function is run by the background thread. It writes the queued records every flush_interval seconds, or earlier when batch_size records are waiting.
+        """
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """
+        This function writes all queued records to the stream.
+        """
+        with self.lock:
+            stream = self.stream if self.stream is not None else sys.stdout
+            try:
+                colors = self.colors if self.colors is not None else stream.isatty()
+            except (AttributeError, OSError, ValueError):
+                colors = False
+            while self.records:
+                lines = []
+                while self.records and len(lines) < self.batch_size:
+                    lines.append(self.format(self.records.popleft(), colors))
+                try:
+                    stream.write("".join(lines))
+                    stream.flush()
+                except (OSError, ValueError):
+                    pass
+
+    def format(self, record, colors=False):
+        """
+        This function formats a record to a line. Messages are colored by their level if colors is True.
+        """
+        level, created, message, args = record
+        timestamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(created)) + f".{int(created % 1 * 1000):03d}"
+        if level is None:
+            return json.dumps(dict(time=timestamp, **args), separators=(",", ":")) + "\n"
+        try:
+            text = message % args if args else message
+        except (TypeError, ValueError):
+            text = f"{message} {args!r}"
+        line = f"{timestamp} {LEVEL_NAMES.get(level, level)} {text}"
+        if colors:
+            line = COLORS.get(level, "") + line + "\033[0m"
+        return line + "\n"
+
+    def forked(self):
+        """
+        This function is called in the child after a fork. The records of the parent are not written twice and a new background thread is started for the child.
+        """
+        self.records = deque()
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.writer = None
+
+# The logger used by all parts of the proxy
+log = Logger()
@@ -0,0 +1,144 @@
+import threading
+from bisect import bisect_left
+
+# Upper bounds in seconds of the buckets of latency histograms
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Counter:
+    """
+    This class is a value that only goes up, like the number of handled requests.
+    """
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        """
+        This function increases the counter.
+        """
+        with self.lock:
+            self.value += amount
+
+class Histogram:
+    """
+    This class counts observed values, like latencies, in buckets. The count of a bucket is the number of values that are less than or equal to its upper bound and larger than the bound of the bucket before it.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        """
+        This function adds a value to the histogram.
+        """
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q):
+        """
+        This function estimates a quantile, for example 0.99, from the buckets. Returns the upper bound of the bucket that contains the quantile, or None if nothing has been observed.
+        """
+        with self.lock:
+            counts = list(self.counts)
+            count = self.count
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for bound, bucket in zip(self.buckets + (float("inf"),), counts):
+            seen += bucket
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+class Metrics:
+    """
+    This class collects the metrics of the proxy and renders them in the Prometheus text format. Counters and histograms are updated by the proxy while it handles requests. Values that are only read when the metrics are rendered, like the number of active connections, are passed to render as gauges. Metrics can have labels, every combination of label values is a separate series.
+    """
+    def __init__(self):
+        self.families = {}
+        self.lock = threading.Lock()
+
+    def family(self, name, kind, description):
+        """
+        This function returns the series of a metric by their labels, the metric is created if it does not exist.
+        """
+        with self.lock:
+            family = self.families.get(name)
+            if family is None:
+                family = self.families[name] = (kind, description, {})
+            elif family[0] != kind:
+                raise ValueError(f"Metric {name} is already registered as a {family[0]}")
+            return family[2]
+
+    def counter(self, name, description, **labels):
+        """
+        This function returns the counter with a name and labels.
+        """
+        series = self.family(name, "counter", description)
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            return series.setdefault(key, Counter())
+
+    def histogram(self, name, description, buckets=LATENCY_BUCKETS, **labels):
+        """
+        This function returns the histogram with a name and labels.
+        """
+        series = self.family(name, "histogram", description)
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            if key not in series:
+                series[key] = Histogram(buckets)
+            return series[key]
+
+    def render(self, gauges=()):
+        """
+        This function returns all metrics in the Prometheus text format. The gauges are (name, description, kind, value) tuples with the current values of metrics that are counted somewhere else, the kind is "gauge" or "counter".
+        """
+        with self.lock:
+            families = [(name, kind, description, list(series.items())) for name, (kind, description, series) in sorted(self.families.items())]
+        families += [(name, kind, description, [((), value)]) for name, description, kind, value in gauges]
+        lines = []
+        for name, kind, description, series in families:
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, metric in series:
+                if isinstance(metric, Histogram):
+                    with metric.lock:
+                        counts = list(metric.counts)
+                        total = metric.sum
+                        count = metric.count
+                    seen = 0
+                    for bound, bucket in zip(metric.buckets + (float("inf"),), counts):
+                        seen += bucket
+                        lines.append(f"{name}_bucket{format_labels(labels + (('le', format_value(bound)),))} {seen}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {format_value(total)}")
+                    lines.append(f"{name}_count{format_labels(labels)} {count}")
+                elif isinstance(metric, Counter):
+                    lines.append(f"{name}{format_labels(labels)} {format_value(metric.value)}")
+                else:
+                    lines.append(f"{name}{format_labels(labels)} {format_value(metric)}")
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+    """
+    This function formats labels for the Prometheus text format.
+    """
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+def format_value(value):
+    """
+    This function formats a value for the Prometheus text format.
+    """
+    if value == float("inf"):
+        return "+Inf"
+    return str(value)
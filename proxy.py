@@ -1,39 +1,259 @@
+import copy
+import itertools
 import socket
 import threading
+import time
 import re
 from request import Request
 from response import Response
 from timeparser import Time
+from connectionpool import ConnectionPool, no_delay
+from resolver import Resolver, split_host
+from tunnel import Tunnel, TunnelRelay
+from socketreader import SocketReader, body_framing
+from rewriter import compile_rewriter
+from rules import RuleFile, compile_rules
+from cache import Cache, parse_cache_control
+from singleflight import SingleFlight
+from workerpool import WorkerPool
+from metrics import Metrics
+from admin import AdminServer
+from tracing import Hooks, Tracer
+from logger import log
+from encoding import compress, compressible, content_encoding, decoder, encoder, negotiate, supported
+
+SERVICE_UNAVAILABLE = b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nRetry-After: 1\r\nConnection: close\r\n\r\n"
+CONNECTION_ESTABLISHED = b"HTTP/1.1 200 Connection Established\r\n\r\n"
+CONTINUE = b"HTTP/1.1 100 Continue\r\n\r\n"
+
+# The responses to requests that are refused by the proxy itself
+ERROR_RESPONSES = {
+    400: b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n",
+    403: b"HTTP/1.1 403 Forbidden\r\nContent-Length: 0\r\nConnection: close\r\n\r\n",
+    413: b"HTTP/1.1 413 Content Too Large\r\nContent-Length: 0\r\nConnection: close\r\n\r\n",
+    431: b"HTTP/1.1 431 Request Header Fields Too Large\r\nContent-Length: 0\r\nConnection: close\r\n\r\n",
+    502: b"HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\nConnection: close\r\n\r\n",
+    503: SERVICE_UNAVAILABLE,
+}
+
+class BodyTooLarge(ValueError):
+    """
+    This exception is raised while a request body is streamed to the server when it turns out to be larger than max_body_size.
+    """
+
+# The phases of handling a request that are measured in proxy_phase_duration_seconds
+PHASES = ("accept", "client_read", "parse", "cache_lookup", "upstream_connect", "upstream_ttfb", "body_transfer", "manipulation", "compression", "client_write")
 
 class Proxy:
     """
     Initializing the proxy. 
     """
     def __init__(self, host, port, max_queue):
-        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server.bind((host, port))
-        self.server.listen(max_queue)
-
         self.host = host
         self.port = port
         self.max_queue = max_queue
+        self.server = self.listen()
+        self.running = True
         self.request_replacements = {}
+        self.request_rules = None
         self.response_replacements = {}
         self.keep_alive = True
         self.use_cache = False
         self.request_id = 0
-        self.cache = {}
+        # next is atomic, so every connection gets its own id, request_id only counts connections for the metrics
+        self.connection_ids = itertools.count(1)
+        self.cache = Cache()
+        self.disk_cache = None
+        self.stale_while_revalidate = 0
+        self.stale_if_error = 0
+        self.revalidating = set()
+        self.flights = SingleFlight()
+        self.coalesce_timeout = 30
+        self.lock = threading.Lock()
+        self.resolver = Resolver()
+        self.pool = ConnectionPool(resolver=self.resolver)
+        self.client_idle_timeout = 15
+        self.max_requests_per_connection = 100
+        self.workers = WorkerPool()
+        self.max_connections = 256
+        self.active_connections = 0
+        self.rejected_connections = 0
+        self.connect_timeout = 10
+        self.read_timeout = 30
+        self.write_timeout = 30
+        self.max_header_size = 65536
+        self.max_body_size = 1024 * 1024 * 1024
+        self.request_buffer_size = 65536
+        self.compression = False
+        self.compression_level = 6
+        self.compression_min_size = 1024
+        self.compression_encodings = ("br", "gzip")
+        self.tunnel_ports = (443,)
+        self.tunnel_idle_timeout = 60
+        self.max_tunnels = 1024
+        self.active_tunnels = 0
+        self.tunnel_relay = TunnelRelay()
+        self.metrics = Metrics()
+        self.admin = None
+        self.hooks = Hooks()
+        self.tracer = None
+        self.register_metrics()
 
     def run(self):
         """
-        Run this function to start listening for new connections.
+        Run this function to start listening for new connections. The connections are handled by the threads of the worker pool. When the proxy is stopped, this function returns after the connections that are being handled are finished.
+        """
+        log.info("[SERVER STARTED] The server started succesfully (%s, %s)", self.host, self.port)
+        while self.running:
+            try:
+                client_socket, client_address = self.server.accept()
+            except OSError:
+                if not self.running:
+                    break
+                raise
+            self.admit(client_socket, client_address)
+        self.workers.shutdown()
+
+    def admit(self, client_socket, client_address):
+        """
+        This function gives a new connection to the worker pool. If max_connections connections are already being handled or waiting, or if the queue of the worker pool is full, the connection is rejected with 503 Service Unavailable right away instead.
+        """
+        accepted = time.perf_counter()
+        with self.lock:
+            admitted = self.active_connections < self.max_connections
+            if admitted:
+                self.active_connections += 1
+        if admitted and self.workers.submit(self.handle_connection, client_socket, client_address, accepted):
+            return True
+        with self.lock:
+            if admitted:
+                self.active_connections -= 1
+            self.rejected_connections += 1
+        log.warning("[OVERLOADED] The connection from %s was rejected", client_address)
+        try:
+            # The accepting thread must never wait for a slow client
+            client_socket.setblocking(False)
+            client_socket.send(SERVICE_UNAVAILABLE)
+        except OSError:
+            pass
+        client_socket.close()
+        return False
+
+    def handle_connection(self, client_socket, client_address, accepted=None):
+        """
+        This function is run by the worker pool for every admitted connection. The time the connection waited for a thread is measured as the accept phase.
+        """
+        no_delay(client_socket)
+        if accepted is not None:
+            self.observe("accept", accepted)
+        try:
+            self.handle_request(client_socket, client_address)
+        finally:
+            with self.lock:
+                self.active_connections -= 1
+
+    def register_metrics(self):
+        """
+        This function creates the counters and histograms that are updated while requests are handled.
+        """
+        self.phases = {phase: self.metrics.histogram("proxy_phase_duration_seconds", "Time spent in each phase of handling a request.", phase=phase) for phase in PHASES}
+        self.request_duration = self.metrics.histogram("proxy_request_duration_seconds", "Time from the first byte of a request until the response has been sent.")
+        self.requests = self.metrics.counter("proxy_requests_total", "Valid requests received from clients.")
+        self.bad_requests = self.metrics.counter("proxy_bad_requests_total", "Requests that could not be parsed.")
+        self.upstream_errors = self.metrics.counter("proxy_upstream_errors_total", "Requests answered with 502 Bad Gateway because the server failed.")
+        self.tunnels = self.metrics.counter("proxy_tunnels_total", "CONNECT tunnels that were established.")
+        self.tunnel_bytes = {direction: self.metrics.counter("proxy_tunnel_bytes_total", "Bytes relayed through CONNECT tunnels.", direction=direction) for direction in ("upstream", "downstream")}
+
+    def gauges(self):
+        """
+        This function returns the current values of the metrics that are counted by the proxy, the cache, the worker pool and the connection pool, for Metrics.render.
         """
-        print("\033[95m" + f"[SERVER STARTED] The server started succesfully ({self.host}, {self.port})" + "\033[0m")
-        while True: 
-            client_socket, client_address = self.server.accept()
-            new_thread = threading.Thread(target=self.handle_request, args=(client_socket, client_address))
-            new_thread.start()
+        return [
+            ("proxy_connections_total", "Client connections that were handled.", "counter", self.request_id),
+            ("proxy_rejected_connections_total", "Client connections rejected with 503 Service Unavailable.", "counter", self.rejected_connections),
+            ("proxy_active_connections", "Client connections that are being handled or wait for a thread.", "gauge", self.active_connections),
+            ("proxy_active_tunnels", "CONNECT tunnels that are open.", "gauge", self.active_tunnels),
+            ("proxy_worker_queue_length", "Client connections that wait for a thread of the worker pool.", "gauge", self.workers.waiting()),
+            ("proxy_cache_hits_total", "Requests answered from the cache.", "counter", self.cache.hits),
+            ("proxy_cache_misses_total", "Requests that could not be answered from the cache.", "counter", self.cache.misses),
+            ("proxy_cache_hit_ratio", "Part of the cache lookups that were hits.", "gauge", self.cache.hits / max(1, self.cache.hits + self.cache.misses)),
+            ("proxy_cache_evictions_total", "Responses evicted from the memory cache.", "counter", self.cache.evictions),
+            ("proxy_cache_entries", "Responses in the memory cache.", "gauge", len(self.cache)),
+            ("proxy_cache_size_bytes", "Size of the responses in the memory cache.", "gauge", self.cache.size),
+            ("proxy_coalesced_requests_total", "Requests that shared the response of a concurrent request.", "counter", self.flights.collapsed),
+            ("proxy_upstream_connections_created_total", "Connections opened to servers.", "counter", self.pool.created),
+            ("proxy_upstream_connections_reused_total", "Requests sent on a pooled connection.", "counter", self.pool.reused),
+            ("proxy_dns_cache_hits_total", "Server names resolved from the resolver cache.", "counter", self.resolver.hits),
+            ("proxy_dns_cache_misses_total", "Server names that had to be looked up.", "counter", self.resolver.misses),
+            ("proxy_dns_failures_total", "Lookups of server names that failed.", "counter", self.resolver.failures),
+        ]
+
+    def observe(self, phase, started, request=None):
+        """
+        This function records the time since started, a value from time.perf_counter, as the duration of a phase. If a request is given the duration is also added to its timings for the access log.
+        """
+        elapsed = time.perf_counter() - started
+        self.phases[phase].observe(elapsed)
+        if request is not None:
+            request.timings[phase] = request.timings.get(phase, 0) + elapsed
+
+    def log_access(self, connection_id, client_address, request, status, started, cache):
+        """
+        This function writes the access log line of a request with its status, the total duration and the duration of every phase in milliseconds.
+        """
+        fields = {"connection": connection_id, "client": client_address[0] if client_address else None, "method": request.method, "url": request.url, "status": status, "cache": cache, "duration_ms": round((time.perf_counter() - started) * 1000, 3)}
+        for phase, elapsed in request.timings.items():
+            fields[phase + "_ms"] = round(elapsed * 1000, 3)
+        log.access(fields)
+
+    def enable_tracing(self, max_traces=1000, min_duration=0):
+        """
+        This function starts recording a trace of every request with a Tracer on the hooks, see the admin page /traces. Returns the tracer, the running tracer is kept if tracing is enabled already.
+        """
+        with self.lock:
+            if self.tracer is None:
+                self.tracer = Tracer(max_traces, min_duration)
+                self.tracer.install(self.hooks)
+            return self.tracer
+
+    def disable_tracing(self):
+        """
+        This function stops recording traces and removes the tracer from the hooks, so the hook points cost nothing again.
+        """
+        with self.lock:
+            if self.tracer is not None:
+                self.tracer.uninstall(self.hooks)
+                self.tracer = None
+
+    def start_admin(self, port=9998, host="127.0.0.1"):
+        """
+        This function starts the admin server in a new thread. The metrics can then be scraped from http://host:port/metrics.
+        """
+        self.admin = AdminServer(self, host, port).start()
+        return self.admin
+
+    def listen(self, port=None, reuse_port=False):
+        """
+        This function creates the listening socket of the proxy. If reuse_port is True the socket is created with SO_REUSEPORT, so several processes can listen on the same port and the kernel spreads the connections between them.
+        """
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        server.bind((self.host, self.port if port is None else port))
+        server.listen(self.max_queue)
+        return server
+
+    def stop(self):
+        """
+        This function stops accepting new connections. Requests that are already being handled are finished.
+        """
+        self.running = False
+        try:
+            self.server.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.server.close()
 
     def add_request_replacement(self, match, replacement):
         """
@@ -41,6 +261,20 @@ class Proxy:
         """
         self.request_replacements[match] = replacement
             
+    def load_request_rules(self, path, interval=1.0):
+        """
+        This function loads request rules from a JSON file, see RuleFile for the format. The file is loaded again when it changes, at most every interval seconds, so the rules can be changed while the proxy is running. The replacements added with add_request_replacement are applied after the rules from the file.
+        """
+        self.request_rules = RuleFile(path, interval)
+        return self.request_rules
+
+    def request_ruleset(self):
+        """
+        This function returns the compiled RuleSet for the current request rules. The patterns are only compiled again when the replacements or the rule file have changed.
+        """
+        base = self.request_rules.current() if self.request_rules is not None else None
+        return compile_rules(tuple(self.request_replacements.items()), base)
+
     def add_response_replacement(self, match, replacement):
         """
         This function can be used to add strings or regexs that should be replaced in the responses. The data sent to this function is stored in a dictionary called request_replacements.
@@ -49,106 +283,807 @@ class Proxy:
         
     def manipulate_request(self, request, connection_id):
         """
-        This function manipulates a request-object. If the member variable keep_alive is set to false the header Connection will be set to close. Otherwise it will be set to keep-alive. This function also calls the manipulate member-method of Request. We pass request_replacements as a parameter to decide how the request should be manipulated.
+        This function manipulates a request-object. If the member variable keep_alive is set to false the header Connection will be set to close. Otherwise it will be set to keep-alive. This function also calls the manipulate member-method of Request with the compiled request rules, see request_ruleset.
         """
+        started = time.perf_counter()
         if self.keep_alive:
             request.headers["Connection"] = " keep-alive"
         else:
             request.headers["Connection"] = " close"
             
-        request.manipulate(self.request_replacements, connection_id)
+        request.manipulate(self.request_ruleset(), connection_id)
+        self.observe("manipulation", started, request)
         return request
 
-    def manipulate_response(self, response, connection_id):
+    def manipulate_response(self, response, connection_id, request=None):
         """
-        This function manipulates a response-object. If the response-object contains text we call the Response member-method manipulate. We pass response_replacements as a parameter to decide how the response should be manipulated.
+        This function manipulates a response-object. If the response-object contains text we call the Response member-method manipulate. We pass response_replacements as a parameter to decide how the response should be manipulated. Responses without a body, like the responses to HEAD requests, are not changed, and neither are any responses if there are no replacements.
         """
+        if not self.response_replacements:
+            return response
+        if body_framing(response.headers, request.method if request is not None else "GET", response.status_code)[0] == "none":
+            return response
         if "Content-Type" in response.headers.keys() and "text" in response.headers["Content-Type"]:
-            response.manipulate(self.response_replacements, connection_id)
+            started = time.perf_counter()
+            response.manipulate(self.response_rewriter(), connection_id)
+            self.observe("manipulation", started)
         return response
 
+    def response_rewriter(self):
+        """
+        This function returns a Rewriter for the current response_replacements. The patterns are only compiled again when the replacements have changed.
+        """
+        return compile_rewriter(tuple(self.response_replacements.items()))
+
+    def manipulates(self, response):
+        """
+        This function returns True if manipulate_response would change the response. Only these responses have to be read completely before they are sent to the client.
+        """
+        encoding = content_encoding(response.headers)
+        return bool(self.response_replacements) and "text" in response.headers.get("Content-Type", "") and (not encoding or supported(encoding))
+
+    def client_encoding(self, request, response, length=None):
+        """
+        This function returns the content coding that a response should be compressed with before it is sent to the client, or None. Only successful responses to GET requests with a compressible content type are compressed, if compression is True, the client accepts one of compression_encodings and the response is not encoded already. Responses with Cache-Control no-transform and bodies smaller than compression_min_size are not compressed. length is the size of the body if it is known.
+        """
+        if not self.compression or request.method != "GET" or response.status_code != "200":
+            return None
+        if "Content-Encoding" in response.headers or not compressible(response.headers.get("Content-Type", "")):
+            return None
+        if "no-transform" in parse_cache_control(response.headers.get("Cache-Control", "")):
+            return None
+        if length is not None and length < self.compression_min_size:
+            return None
+        return negotiate(request.headers.get("Accept-Encoding", ""), self.compression_encodings)
+
+    def compress_response(self, request, response, connection_id):
+        """
+        This function returns a compressed copy of a complete response if the client accepts it, see client_encoding, otherwise the response itself. Responses from the cache are shared between connections, so they are never changed. If the cache is used the compressed copy of a stored response is cached too, under a key that contains the coding and the version of the uncompressed response, so a body is only compressed once and finding the copy does not depend on the size of the body. A response that was refreshed by a 304 Not Modified is a new version with new headers, so a new copy is made with them instead of sending the old Date, Expires and Cache-Control.
+        """
+        if not response.valid or response.source is not None:
+            return response
+        encoding = self.client_encoding(request, response, len(response.body))
+        if encoding is None:
+            return response
+        started = time.perf_counter()
+        key = None
+        if self.use_cache and response.version is not None:
+            key = self.cache.key(request.url, request.headers) + (encoding, response.version)
+            compressed = self.cache.get(key)
+            if compressed is not None:
+                self.observe("compression", started, request)
+                return compressed
+        compressed = Response(response.encode_head())
+        compressed.body = compress(encoding, response.body, self.compression_level)
+        mark_compressed(compressed, encoding)
+        compressed.headers["Content-Length"] = f" {len(compressed.body)}"
+        if key is not None and self.cache.cacheable(request, response):
+            self.cache.insert(key, compressed)
+        self.observe("compression", started, request)
+        log.debug("[CONNECTION #%s] The response was compressed with %s", connection_id, encoding)
+        return compressed
+
     def handle_request(self, client_socket, client_address):
         """
-        This function is responsible for handling a request.
+        This function is responsible for handling the requests on a connection. Requests are read one after another from the same socket as long as the connection is persistent, so pipelined requests are answered in order.
         """
+        connection_id = next(self.connection_ids)
         self.request_id += 1
-        connection_id = self.request_id
-        print('\033[94m'+ f"[CONNECTION #{connection_id}] New connection from {client_address}" + '\033[0m')
+        log.debug("[CONNECTION #%s] New connection from %s", connection_id, client_address)
+        reader = SocketReader(client_socket)
+        handled = 0
+        persistent = True
         try:
-            # Receive data from the client
-            request = client_socket.recv(4096) 
-        except:
-            print("\033[91m" + f"[CONNECTION #{connection_id} Error: could not recieve data from {client_address}" + "\033[0m")
+            while persistent:
+                try:
+                    # Receive data from the client
+                    try:
+                        data = reader.read_head(self.max_header_size, self.client_idle_timeout)
+                    except ValueError:
+                        self.refuse(client_socket, 431, connection_id)
+                        break
+                    if not data:
+                        break
+                    handled += 1
+                    started = reader.head_started or time.perf_counter()
+                    if self.hooks.pre_parse:
+                        self.hooks.pre_parse(f"{connection_id}.{handled}", data, None)
 
-        # Create a request instance
-        request = Request(request)
+                    # Create a request instance
+                    parsing = time.perf_counter()
+                    request = Request(data)
+                    self.observe("parse", parsing, request)
+                    if self.hooks.post_parse:
+                        self.hooks.post_parse(f"{connection_id}.{handled}", request, None)
+                    client_socket.settimeout(self.read_timeout)
+                    if request.valid and request.method != "CONNECT":
+                        try:
+                            accepted = self.read_request_body(client_socket, reader, request)
+                        except ValueError:
+                            # The Content-Length or a chunk size of the body can not be parsed
+                            self.refuse(client_socket, 400, connection_id)
+                            break
+                        if not accepted:
+                            self.refuse(client_socket, 413, connection_id)
+                            break
+                        self.observe("client_read", started, request)
+                except (OSError, ValueError):
+                    log.warning("[CONNECTION #%s] Error: could not recieve data from %s", connection_id, client_address)
+                    break
 
-        # Check if request was parsed successfully
-        if request.valid:
-            print("\033[92m" + f"[CONNECTION #{connection_id}] {client_address[0]}: {request.line}" + "\033[0m")
-            
-            # Only manipulate if request method is "GET"
-            if request.method == "GET":
-
-                # Manipulate request
-                request = self.manipulate_request(request, connection_id)
-                
-                # If requested page is in our cache, create response from cache
-                response = self.query_cache(request, connection_id) if self.use_cache else False
-                
-                if not response:
-                    response = self.send_request(request, connection_id)
+                if request.valid and request.method == "CONNECT":
+                    self.requests.inc()
+                    if self.tunnel(client_socket, reader, client_address, request, connection_id, started):
+                        # The socket belongs to the tunnel relay now
+                        client_socket = None
+                    break
+
+                # Check if request was parsed successfully
+                if request.valid:
+                    log.debug("[CONNECTION #%s] %s: %s", connection_id, client_address[0], request.line)
+                    self.requests.inc()
+                    persistent = self.client_keep_alive(request, handled)
+                    cache = "off"
+
+                    try:
+                        # Only manipulate if request method is "GET"
+                        if request.method == "GET":
+
+                            # Manipulate request
+                            request = self.manipulate_request(request, connection_id)
+
+                            # If requested page is in our cache, create response from cache
+                            response = False
+                            if self.use_cache:
+                                lookup = time.perf_counter()
+                                response = self.query_cache(request, connection_id)
+                                self.observe("cache_lookup", lookup, request)
+                                cache = "hit" if response else "miss"
+
+                            if not response:
+                                if self.hooks.pre_upstream:
+                                    self.hooks.pre_upstream(f"{connection_id}.{handled}", request, None)
+                                response = self.fetch(request, connection_id)
+                                if self.hooks.post_upstream:
+                                    self.hooks.post_upstream(f"{connection_id}.{handled}", request, response)
+                            response = self.compress_response(request, response, connection_id)
+                        else:
+                            if self.hooks.pre_upstream:
+                                self.hooks.pre_upstream(f"{connection_id}.{handled}", request, None)
+                            response = self.send_request(request, connection_id, True)
+                            if self.hooks.post_upstream:
+                                self.hooks.post_upstream(f"{connection_id}.{handled}", request, response)
+                    except BodyTooLarge:
+                        log.warning("[CONNECTION #%s] The request body is larger than %s bytes", connection_id, self.max_body_size)
+                        response = Response(ERROR_RESPONSES[413])
+                    except (OSError, ValueError):
+                        log.error("[CONNECTION #%s] Could not connect to %s", connection_id, request.host)
+                        response = Response(b"")
+                    if request.source is not None:
+                        # The rest of the request body was not read, the next request can not be found
+                        persistent = False
+
+                    # Send response to client
+                    if self.hooks.pre_send:
+                        self.hooks.pre_send(f"{connection_id}.{handled}", request, response)
+                    try:
+                        writing = time.perf_counter()
+                        client_socket.settimeout(self.write_timeout)
+                        if response.valid:
+                            persistent = self.send_response(client_socket, response, persistent)
+                        else:
+                            self.upstream_errors.inc()
+                            persistent = False
+                            client_socket.sendall(b"HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                    except ValueError:
+                        # The server sent a broken body while it was streamed, the client can only tell from the closed connection
+                        log.error("[CONNECTION #%s] Failed to receive response from %s", connection_id, request.host)
+                        break
+                    except OSError:
+                        break
+                    self.observe("client_write", writing, request)
+                    self.request_duration.observe(time.perf_counter() - started)
+                    if self.hooks.post_send:
+                        self.hooks.post_send(f"{connection_id}.{handled}", request, response)
+                    if log.sampled():
+                        self.log_access(connection_id, client_address, request, int(response.status_code) if response.valid else 502, started, cache)
+
+                    log.debug("[CONNECTION #%s] The response was sent to the client %s", connection_id, client_address)
+
+                else:
+                    self.bad_requests.inc()
+                    persistent = False
+                    try:
+                        client_socket.settimeout(self.write_timeout)
+                        client_socket.sendall(b"HTTP/1.1 400 Bad Request\r\n\r\n")
+                    except OSError:
+                        pass
+                    if self.hooks.post_send:
+                        self.hooks.post_send(f"{connection_id}.{handled}", request, None)
+                    log.warning("[CONNECTION #%s] The request was rejected", connection_id)
+                    if log.sampled():
+                        self.log_access(connection_id, client_address, request, 400, started, "off")
+
+        finally:
+            if client_socket is not None:
+                client_socket.close()
+
+    def tunnel(self, client_socket, reader, client_address, request, connection_id, started):
+        """
+        This function handles a CONNECT request. A connection to the host and port of the request is opened and the client is told that the tunnel is established, after that the sockets are handed over to tunnel_relay, which relays the bytes in both directions without looking at them until both sides have closed the connection. The worker thread is free again right away, so open tunnels do not count against the workers. Only the ports in tunnel_ports can be used, other ports are answered with 403 Forbidden. If max_tunnels tunnels are already open the client gets 503 Service Unavailable, and if the server can not be reached 502 Bad Gateway. Returns True if the client socket was handed over.
+        """
+        status = 200
+        try:
+            address = self.tunnel_address(request)
+            if address is None:
+                status = 403
+            elif self.active_tunnels >= self.max_tunnels:
+                status = 503
+            else:
+                connecting = time.perf_counter()
+                server = self.resolver.connect(address, self.connect_timeout)
+                self.observe("upstream_connect", connecting, request)
+        except (OSError, ValueError):
+            status = 502
+        tunnel = Tunnel(idle_timeout=self.tunnel_idle_timeout)
+        try:
+            client_socket.settimeout(self.write_timeout)
+            if status != 200:
+                client_socket.sendall(ERROR_RESPONSES[status])
             else:
-                response = self.send_request(request, connection_id)
+                client_socket.sendall(CONNECTION_ESTABLISHED)
+                if reader.buffer:
+                    # The client may send the start of the TLS handshake right after the request
+                    server.settimeout(self.write_timeout)
+                    server.sendall(reader.buffer)
+                    tunnel.count(len(reader.buffer), True)
+                    reader.buffer.clear()
+        except OSError:
+            if status == 200:
+                server.close()
+            return False
+        if status != 200:
+            self.finish_tunnel(connection_id, client_address, request, status, started, tunnel)
+            return False
+        log.debug("[CONNECTION #%s] The tunnel to %s was established", connection_id, request.host)
+        with self.lock:
+            self.active_tunnels += 1
 
-            # Send request to server
-            client_socket.sendall(response.encode())
-            
-            print("\033[92m" + f"[CONNECTION #{connection_id}] The response was sent to the client {client_address}" + "\033[0m")
-                
+        def finished(tunnel):
+            with self.lock:
+                self.active_tunnels -= 1
+            self.finish_tunnel(connection_id, client_address, request, status, started, tunnel)
+
+        self.tunnel_relay.add(tunnel, client_socket, server, finished)
+        return True
+
+    def tunnel_address(self, request):
+        """
+        This function returns the address that a CONNECT request should be tunneled to, or None if its port is not in tunnel_ports. Raises ValueError if the port is invalid.
+        """
+        address = split_host(request.host, 443)
+        if self.tunnel_ports is not None and address[1] not in self.tunnel_ports:
+            return None
+        return address
+
+    def finish_tunnel(self, connection_id, client_address, request, status, started, tunnel):
+        """
+        This function counts a finished CONNECT request and writes it to the access log.
+        """
+        if status == 200:
+            self.tunnels.inc()
+            self.tunnel_bytes["upstream"].inc(tunnel.upstream_bytes)
+            self.tunnel_bytes["downstream"].inc(tunnel.downstream_bytes)
+            log.debug("[CONNECTION #%s] The tunnel to %s was closed after %s bytes", connection_id, request.host, tunnel.upstream_bytes + tunnel.downstream_bytes)
         else:
-            client_socket.sendall(b"HTTP/1.1 400 Bad Request\r\n\r\n")
-            print("\033[93m" + f"[CONNECTION #{connection_id}] The request was rejected" + "\033[0m")
+            if status == 502:
+                self.upstream_errors.inc()
+            log.warning("[CONNECTION #%s] The tunnel to %s was refused with %s", connection_id, request.host, status)
+        if log.sampled():
+            self.log_access(connection_id, client_address, request, status, started, "off")
+
+    def read_request_body(self, client_socket, reader, request):
+        """
+        This function reads the body of a request from the client. Bodies of at most request_buffer_size bytes are read completely, chunked bodies are then decoded and forwarded with a Content-Length instead. Larger bodies are not read here, instead the source of the request is set to a generator that relays the body while it is sent to the server, see stream_request_body. Returns False if the Content-Length is larger than max_body_size, a ValueError is raised if the framing of the body is invalid.
+
+        If the client waits for 100 Continue before it sends the body, the proxy answers it and removes the Expect header from the request.
+        """
+        framing, length = body_framing(request.headers, request.method)
+        if framing == "none":
+            return True
+        if framing == "length" and length > self.max_body_size:
+            return False
+        if framing == "chunked" and "Content-Length" in request.headers:
+            # Both headers together are a request smuggling attempt, the chunked encoding wins and the length is removed
+            del request.headers["Content-Length"]
+        if "100-continue" in request.headers.get("Expect", "").lower():
+            del request.headers["Expect"]
+            client_socket.sendall(CONTINUE)
+        pieces = reader.iter_body(framing, length)
+        if framing == "length" and length > self.request_buffer_size:
+            request.source = self.stream_request_body(request, pieces, False)
+            return True
+        body = bytearray()
+        for data in pieces:
+            body += data
+            if len(body) > self.request_buffer_size:
+                # The chunked body is too large to be kept in memory, it is streamed with chunked encoding
+                request.source = self.stream_request_body(request, itertools.chain((bytes(body),), pieces), True)
+                return True
+        request.body = bytes(body)
+        if framing == "chunked":
+            del request.headers["Transfer-Encoding"]
+            request.headers["Content-Length"] = f" {len(request.body)}"
+        return True
+
+    def stream_request_body(self, request, pieces, chunked):
+        """
+        This generator relays the pieces of a request body from the client, so large uploads are never kept in memory. Every piece is sent to the server before the next one is read from the client, which makes a slow server slow down the client. If chunked is True the pieces are sent with chunked encoding. A BodyTooLarge is raised if the body gets larger than max_body_size. The source of the request is set to None when the complete body has been read.
+        """
+        received = 0
+        for data in pieces:
+            received += len(data)
+            if received > self.max_body_size:
+                raise BodyTooLarge(f"The request body is larger than {self.max_body_size} bytes")
+            if chunked:
+                yield b"%x\r\n" % len(data)
+                yield data
+                yield b"\r\n"
+            else:
+                yield data
+        if chunked:
+            yield b"0\r\n\r\n"
+        request.source = None
+
+    def refuse(self, client_socket, status, connection_id):
+        """
+        This function answers a request that is not accepted by the proxy with an error response, like 431 Request Header Fields Too Large. The connection is closed afterwards.
+        """
+        self.bad_requests.inc()
+        log.warning("[CONNECTION #%s] The request was refused with %s", connection_id, status)
+        try:
+            client_socket.settimeout(self.write_timeout)
+            client_socket.sendall(ERROR_RESPONSES[status])
+        except OSError:
+            pass
+
+    def client_keep_alive(self, request, handled):
+        """
+        This function decides if the connection to the client should be kept open after the response. HTTP/1.1 connections are persistent unless the client asks to close them, HTTP/1.0 connections only if the client asks for keep-alive. The connection is always closed if keep_alive is False or if max_requests_per_connection requests have been handled.
+        """
+        if not self.keep_alive or handled >= self.max_requests_per_connection:
+            return False
+        connection = (request.headers.get("Connection", "") + request.headers.get("Proxy-Connection", "")).lower()
+        if request.line.endswith("HTTP/1.1"):
+            return "close" not in connection
+        return "keep-alive" in connection
 
-        client_socket.close()
-       
     def query_cache(self, request, connection_id):
         """
-        This function is called from handle_request is the variable use_cache is set to true. Returns a cached response or false.
+        This function is called from handle_request is the variable use_cache is set to true. Returns a cached response or false. A cached response is returned if it is still fresh, or if the client sent If-Modified-Since and the page has not been modified since then. A stale response is also returned if it is within its stale-while-revalidate time, it is then revalidated in the background.
         """
-        if "If-Modified-Since" in request.headers.keys() and request.url in self.cache.keys() and "Last-Modified" in self.cache[request.url].headers.keys():
-            if Time(request.headers["If-Modified-Since"]) <= Time(self.cache[request.url].headers["Last-Modified"]):
-                print("\033[92m" + f"[CONNECTION #{connection_id}] Requested webpage was retrieved from cache" + "\033[0m")
-                return self.cache[request.url]
+        self.cache_fingerprint()
+        entry = self.cache_entry(request)
+        if entry is not None and "no-cache" not in parse_cache_control(request.headers.get("Cache-Control", "")):
+            cached = entry.response
+            fresh = entry.fresh()
+            if not fresh and "If-Modified-Since" in request.headers.keys() and "Last-Modified" in cached.headers.keys():
+                fresh = Time(request.headers["If-Modified-Since"]) <= Time(cached.headers["Last-Modified"])
+            if not fresh and entry.staleness() <= entry.stale_time("stale-while-revalidate", self.stale_while_revalidate):
+                self.revalidate_in_background(request, entry, connection_id)
+                fresh = True
+            if fresh:
+                self.cache.record(True)
+                log.debug("[CONNECTION #%s] Requested webpage was retrieved from cache", connection_id)
+                return cached
+        self.cache.record(False)
         return False
 
-    def send_request(self, request, connection_id):
+    def cache_fingerprint(self):
+        """
+        This function tells the caches the fingerprint of the current response replacements and request rules. The cached responses are stored already manipulated, so responses that were manipulated with other replacements are not used anymore when they change. Request rules can send a request to another URL than the one it is cached under, so responses that were fetched with other request rules are not used anymore either, also when a rule file is loaded again.
+        """
+        fingerprint = self.response_rewriter().fingerprint
+        rules = self.request_ruleset().fingerprint
+        if rules:
+            fingerprint += "." + rules
+        self.cache.fingerprint = fingerprint
+        if self.disk_cache is not None:
+            self.disk_cache.fingerprint = fingerprint
+
+    def cache_entry(self, request):
+        """
+        This function returns the cache entry for a request from the memory cache or the disk cache, or None.
+        """
+        entry = self.cache.lookup(request)
+        if entry is None and self.disk_cache is not None:
+            entry = self.disk_cache.lookup(request)
+        return entry
+
+    def fetch(self, request, connection_id):
+        """
+        This function is called when a GET request could not be answered from the cache. If the cache is used, concurrent requests for the same page are coalesced: the first request is forwarded and the others wait for it and are answered from the cache when its response has been stored. If the first request fails, takes longer than coalesce_timeout seconds or gets a response that can not be cached, the waiting requests are forwarded themselves.
+        """
+        if not self.use_cache:
+            return self.forward(request, connection_id)
+        key = self.cache.key(request.url, request.headers)
+        flight, leader = self.flights.begin(key)
+        if not leader:
+            if self.flights.wait(flight, self.coalesce_timeout):
+                entry = self.cache.lookup(request)
+                if entry is not None and entry.stored >= flight.started:
+                    self.flights.count(True)
+                    log.debug("[CONNECTION #%s] Requested webpage was shared with a concurrent request", connection_id)
+                    return entry.response
+            self.flights.count(False)
+            return self.forward(request, connection_id)
+
+        try:
+            response = self.forward(request, connection_id)
+        except BaseException:
+            self.flights.finish(key, flight, None)
+            raise
+        if response.source is None:
+            self.flights.finish(key, flight, True)
+        elif not response.caching:
+            # Nothing will be stored, the waiting requests do not have to wait for the body
+            self.flights.finish(key, flight, None)
+        else:
+            response.source = self.land(response.source, response, key, flight)
+        return response
+
+    def land(self, source, response, key, flight):
+        """
+        This generator relays a streamed response and finishes the flight when the whole response has been sent, which is when it has been stored in the cache. If the body turns out to be too large for the cache, the flight is finished as soon as that is known.
+        """
+        try:
+            for data in source:
+                if not response.caching:
+                    self.flights.finish(key, flight, None)
+                yield data
+        finally:
+            source.close()
+            self.flights.finish(key, flight, True)
+
+    def forward(self, request, connection_id):
+        """
+        This function sends a GET request to the server. If there is a stale response in the cache it is revalidated with the server instead.
+        """
+        entry = self.cache_entry(request) if self.use_cache else None
+        if entry is None:
+            return self.send_request(request, connection_id, True)
+        return self.revalidate(request, entry, connection_id, True)
+
+    def revalidate(self, request, entry, connection_id, stream=False):
+        """
+        This function asks the server if a cached response is still valid by sending a conditional request with If-None-Match and If-Modified-Since built from its ETag and Last-Modified. If the server answers 304 Not Modified the cached response is refreshed and returned. If the server can not be reached or answers with an error, the stale response is returned as long as it is within its stale-if-error time. Otherwise the new response from the server is returned.
+        """
+        try:
+            response = self.send_request(self.conditional_request(request, entry.response), connection_id, stream)
+        except OSError:
+            response = Response(b"")
+        return self.revalidated(request, entry, response, connection_id)
+
+    def conditional_request(self, request, cached):
         """
-        This function sends the request to the server and returns the response.
+        This function returns a copy of a request with If-None-Match and If-Modified-Since built from the ETag and Last-Modified of a cached response.
         """
-        destination_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        destination_socket.connect((request.host, 80))
-        destination_socket.sendall(request.encode())
-        print("\033[92m" + f"[CONNECTION #{connection_id}] The request was sent to the host ({request.host})" + "\033[0m")
-        response = self.handle_response(destination_socket, request, connection_id)
+        conditional = copy.copy(request)
+        conditional.headers = request.headers.copy()
+        if "ETag" in cached.headers:
+            conditional.headers["If-None-Match"] = cached.headers["ETag"]
+        if "Last-Modified" in cached.headers:
+            conditional.headers["If-Modified-Since"] = cached.headers["Last-Modified"]
+        return conditional
+
+    def revalidated(self, request, entry, response, connection_id):
+        """
+        This function decides which response answers a revalidated request, given the response of the server to the conditional request, see revalidate.
+        """
+        cached = entry.response
+        if response.valid and response.status_code == "304":
+            cached = self.refresh(request, cached, response)
+            log.debug("[CONNECTION #%s] The cached webpage was revalidated", connection_id)
+            return cached
+        if (not response.valid or response.status_code.startswith("5")) and entry.staleness() <= entry.stale_time("stale-if-error", self.stale_if_error):
+            if response.source is not None:
+                response.source.close()
+            log.warning("[CONNECTION #%s] The server failed, a stale webpage was retrieved from cache", connection_id)
+            return cached
         return response
 
-    def handle_response(self, destination_socket, request, connection_id):
+    def revalidate_in_background(self, request, entry, connection_id):
+        """
+        This function revalidates a cached response in a new thread. Only one revalidation per cached response runs at the same time.
+        """
+        if not self.claim_revalidation(entry):
+            return
+
+        def run():
+            try:
+                self.revalidate(request, entry, connection_id)
+            finally:
+                with self.lock:
+                    self.revalidating.discard(entry.key)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def claim_revalidation(self, entry):
+        """
+        This function marks a cached response as being revalidated. Returns False if it is revalidated already.
+        """
+        with self.lock:
+            if entry.key in self.revalidating:
+                return False
+            self.revalidating.add(entry.key)
+            return True
+
+    def refresh(self, request, cached, not_modified):
+        """
+        This function stores a copy of a cached response with the headers of a 304 Not Modified response, which makes it fresh, and returns the copy. The cached response itself can not be changed since it may be sent by other connections at the same time.
+        """
+        refreshed = Response(cached.encode_head())
+        refreshed.body = cached.body
+        for name in ("Cache-Control", "Date", "Expires", "ETag", "Last-Modified"):
+            if name in not_modified.headers:
+                refreshed.headers[name] = not_modified.headers[name]
+        self.store_response(request, refreshed)
+        return refreshed
+
+    def send_request(self, request, connection_id, stream=False):
+        """
+        This function sends the request to the server and returns the response. The connection is taken from the connection pool, if a reused connection turns out to be closed by the server the request is sent again on a new connection. If stream is True the body of responses that will not be manipulated is not read here, see handle_response. A socket.timeout is raised if the server can not be reached within connect_timeout seconds or does not answer within read_timeout seconds.
+        """
+        address = self.upstream_address(request)
+        while True:
+            connecting = time.perf_counter()
+            connection = self.pool.acquire(address, self.connect_timeout)
+            self.observe("upstream_connect", connecting, request)
+            try:
+                sending = time.perf_counter()
+                connection.sock.settimeout(self.write_timeout)
+                connection.sock.sendall(request.encode())
+                streamed = request.source is not None
+                if streamed:
+                    for data in request.source:
+                        connection.sock.sendall(data)
+                log.debug("[CONNECTION #%s] The request was sent to the host (%s)", connection_id, request.host)
+                connection.sock.settimeout(self.read_timeout)
+                head = connection.reader.read_head()
+                # Interim responses like 100 Continue are not passed on
+                while head.startswith(b"HTTP/1.1 1") and not head.startswith(b"HTTP/1.1 101"):
+                    head = connection.reader.read_head()
+                self.observe("upstream_ttfb", sending, request)
+            except (socket.timeout, BodyTooLarge):
+                # A slow server is not retried, it would only double the waiting time
+                connection.close()
+                raise
+            except OSError:
+                head = b""
+            if head or not connection.reused or streamed:
+                break
+            connection.close()
+        return self.handle_response(connection, head, request, connection_id, stream)
+
+    def handle_response(self, connection, head, request, connection_id, stream=False):
+        """
+        This function handles the response. The body is read until the end given by Content-Length or the chunked encoding, so the connection can be given back to the pool afterwards. Chunked bodies and bodies that end when the connection is closed are sent to the client with a Content-Length instead.
+
+        If stream is True and the response will not be manipulated, the body is not read here. Instead the source of the response is set to a generator that relays the body piece by piece while it is sent to the client.
+        """
+        response = Response(head)
+        keep = False
+        if response.valid:
+            framing, length = body_framing(response.headers, request.method, response.status_code)
+            if stream and framing != "none":
+                # Decided before the headers are changed for the client
+                keep = self.keep_connection(request, response, framing)
+                rewriter = self.response_rewriter().stream() if self.manipulates(response) else None
+                encoding = content_encoding(response.headers) if rewriter is not None else ""
+                compression = self.client_encoding(request, response, length if framing == "length" else None)
+                # The cache keeps the uncompressed response
+                cache_head = response.encode_head()
+                if compression is not None:
+                    mark_compressed(response, compression)
+                if (rewriter is not None or compression is not None) and "Content-Length" in response.headers:
+                    # The length of the body changes when it is rewritten or compressed
+                    del response.headers["Content-Length"]
+                if framing != "length" or rewriter is not None or compression is not None:
+                    if request.line.endswith("HTTP/1.1"):
+                        response.headers["Transfer-Encoding"] = " chunked"
+                    elif "Transfer-Encoding" in response.headers:
+                        del response.headers["Transfer-Encoding"]
+                response.caching = self.use_cache and self.cache.cacheable(request, response)
+                response.source = self.stream_body(connection, request, response, framing, length, connection_id, rewriter, encoding, compression, cache_head, keep)
+                response.buffered = rewriter is None and compression is None and bool(connection.reader.buffer)
+                return response
+            body = bytearray()
+            transfer = time.perf_counter()
+            try:
+                for data in connection.reader.iter_body(framing, length):
+                    body += data
+                keep = self.keep_connection(request, response, framing)
+                self.observe("body_transfer", transfer, request)
+            except (OSError, ValueError):
+                # A truncated response must neither be cached nor sent, the client gets 502 Bad Gateway
+                log.error("[CONNECTION #%s] Failed to receive response from %s", connection_id, request.host)
+                connection.close()
+                return Response(b"")
+            response.body = bytes(body)
+            if framing == "chunked":
+                del response.headers["Transfer-Encoding"]
+            if framing in ("chunked", "close"):
+                response.headers["Content-Length"] = f" {len(response.body)}"
+        if keep:
+            self.pool.release(connection)
+        else:
+            connection.close()
+        return self.process_response(response, request, connection_id)
+
+    def stream_body(self, connection, request, response, framing, length, connection_id, rewriter=None, encoding="", compression=None, cache_head=None, keep=False):
+        """
+        This generator relays the body of a response from the server. Bodies with a Content-Length are passed on exactly as they are received, without copying. Other bodies are sent with chunked encoding if the response has the header Transfer-Encoding set to chunked, otherwise the client connection has to be closed to end the body. If a rewriter is given the body is manipulated chunk by chunk on the way, bodies with the content coding encoding are decompressed before and compressed again after the rewriter. If compression is given the body is compressed with it for the client. If the cache is used the uncompressed body is collected and the complete response is stored in the cache at the end, a body that is larger than the entries of the memory cache is only collected while the disk cache has room for it in its queue, with cache_head as its status line and headers if it is given. The connection is given back to the pool at the end if keep is True, see keep_connection.
+        """
+        chunked = "Transfer-Encoding" in response.headers
+        cached = bytearray() if response.caching else None
+        compressor = encoder(compression, self.compression_level) if compression is not None else None
+        # Bytes of the collected body that the disk cache reserved for it
+        reserved = 0
+        complete = False
+        transfer = time.perf_counter()
+        try:
+            pieces = connection.reader.iter_body(framing, length)
+            if rewriter is not None:
+                pieces = self.rewrite_body(pieces, rewriter, encoding)
+            for data in pieces:
+                if cached is not None:
+                    cached += data
+                    if len(cached) > self.cache.max_entry_size:
+                        # Only the disk cache can store the body, it limits how much memory the bodies waiting for it may use
+                        if self.disk_cache is not None and len(cached) <= self.disk_cache.max_entry_size and self.disk_cache.reserve(len(cached) - reserved):
+                            reserved = len(cached)
+                        else:
+                            cached = None
+                            response.caching = False
+                            if reserved:
+                                self.disk_cache.release(reserved)
+                                reserved = 0
+                if compressor is not None:
+                    # The compressor may keep the data until the next piece
+                    data = compressor.compress(data)
+                if not data:
+                    continue
+                if chunked:
+                    yield b"%x\r\n" % len(data) + data + b"\r\n"
+                else:
+                    yield data
+            if compressor is not None:
+                data = compressor.flush()
+                yield b"%x\r\n" % len(data) + data + b"\r\n" if chunked else data
+            if chunked:
+                yield b"0\r\n\r\n"
+            complete = True
+            self.observe("body_transfer", transfer, request)
+            if rewriter is not None:
+                log.debug("[CONNECTION #%s] The response was manipulated succesfully", connection_id)
+        finally:
+            if complete and keep:
+                self.pool.release(connection)
+            else:
+                connection.close()
+            if not complete and reserved:
+                self.disk_cache.release(reserved)
+        if cached is not None:
+            copy = Response(cache_head if cache_head is not None else response.encode_head())
+            copy.body = bytes(cached)
+            if "Transfer-Encoding" in copy.headers:
+                del copy.headers["Transfer-Encoding"]
+            copy.headers["Content-Length"] = f" {len(copy.body)}"
+            self.store_response(request, copy, reserved)
+
+    def rewrite_body(self, pieces, rewriter, encoding=""):
         """
-        This function handles the response
+        This generator passes the pieces of a body through a rewriter. If the body has a content coding, every piece is decompressed before it is rewritten and compressed again afterwards.
         """
-        response = b""
+        if not encoding:
+            for data in pieces:
+                yield rewriter.feed(data)
+            yield rewriter.feed(b"", True)
+            return
+        decompressor = decoder(encoding)
+        compressor = encoder(encoding, self.compression_level)
+        for data in pieces:
+            yield compressor.compress(rewriter.feed(decompressor.decompress(data)))
+        yield compressor.compress(rewriter.feed(decompressor.flush(), True)) + compressor.flush()
+
+    def send_response(self, client_socket, response, persistent):
+        """
+        This function sends a response to the client. Responses with a source are streamed to the client, the head is sent right away and only together with the first piece of the body if that piece is already there. Frozen responses from the cache are sent with their encoded head and body in a single call, without changing or encoding them. Returns True if the connection to the client can be used for more requests.
+        """
+        if response.wire is not None:
+            send_buffers(client_socket, (response.wire[persistent], response.body))
+            return persistent
+        if response.source is not None and "Content-Length" not in response.headers and "Transfer-Encoding" not in response.headers:
+            persistent = False
+        response.headers["Connection"] = " keep-alive" if persistent else " close"
+        # Bodies from the disk cache are sent directly from the memory map
+        buffers = [response.encode_head(), response.body]
+        if response.source is None:
+            send_buffers(client_socket, buffers)
+            return persistent
         try:
-            data = destination_socket.recv(4096)
-            while data:
-                response += data
-                data = destination_socket.recv(4096)
-            destination_socket.close()
-        except:
-            print("\033[91m" + f"[CONNECTION #{connection_id}] Failed to receive response from {request.host}" + "\033[0m")
-        response = Response(response)
+            if response.buffered:
+                # The first piece of the body has already been received, it goes out together with the head
+                buffers.append(next(response.source, b""))
+            send_buffers(client_socket, buffers)
+            for data in response.source:
+                client_socket.sendall(data)
+        finally:
+            response.source.close()
+        return persistent
+
+    def keep_connection(self, request, response, framing):
+        """
+        This function decides if the connection to the server can be reused after the response has been read.
+        """
+        if framing == "close":
+            return False
+        for headers in (request.headers, response.headers):
+            if "close" in headers.get("Connection", "").lower():
+                return False
+        return response.line.startswith("HTTP/1.1") or "keep-alive" in response.headers.get("Connection", "").lower()
+
+    def process_response(self, response, request, connection_id):
+        """
+        This function is called with every response received from a server. Valid responses are manipulated and then stored in the cache if use_cache is True, so a cached response is ready to be sent.
+        """
         if response.valid:
-            self.cache[request.url] = response 
-            response = self.manipulate_response(response, connection_id)
+            response = self.manipulate_response(response, connection_id, request)
+            if self.use_cache:
+                self.store_response(request, response)
         return response
-        
+
+    def store_response(self, request, response, reserved=0):
+        """
+        This function stores a response in the memory cache and queues it for the disk cache, if there is one, so the response is written to disk after it has been sent. reserved is the number of bytes the disk cache already reserved for the body, see DiskCache.reserve. The response is frozen by the memory cache, see Response.freeze.
+        """
+        self.cache_fingerprint()
+        self.cache.store(request, response)
+        if self.disk_cache is not None and self.cache.cacheable(request, response):
+            self.disk_cache.store_later(request, response, reserved)
+        elif reserved:
+            self.disk_cache.release(reserved)
+
+    def upstream_address(self, request):
+        """
+        This function returns the address of the server that the request should be sent to. The port is taken from the host of the request, 80 is used if it has none. Raises ValueError if the port is invalid.
+        """
+        return split_host(request.host, 80)
+
+def mark_compressed(response, encoding):
+    """
+    This function sets the headers of a response whose body is compressed with a content coding for the client. The ETag is made weak because the bytes of the body are not the ones of the server.
+    """
+    response.headers["Content-Encoding"] = f" {encoding}"
+    vary = response.headers.get("Vary", "").strip()
+    if "accept-encoding" not in vary.lower():
+        response.headers["Vary"] = f" {vary}, Accept-Encoding" if vary else " Accept-Encoding"
+    etag = response.headers.get("ETag", "").strip()
+    if etag and not etag.startswith("W/"):
+        response.headers["ETag"] = f" W/{etag}"
+
+def send_buffers(sock, buffers):
+    """
+    This function sends several buffers like sendall would send them joined together, but without copying them into one. As many buffers as possible are sent with a single call of sendmsg.
+    """
+    buffers = [memoryview(buffer).cast("B") for buffer in buffers if len(buffer)]
+    if not hasattr(sock, "sendmsg"):
+        for buffer in buffers:
+            sock.sendall(buffer)
+        return
+    while buffers:
+        sent = sock.sendmsg(buffers)
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers.pop(0))
+        if sent:
+            buffers[0] = buffers[0][sent:]
@@ -1,4 +1,9 @@
 import re
+from httpparser import Headers, find_head_end, parse_head
+from logger import log
+from rules import RuleSet, compile_rules, request_path
+
+HOST_PATTERN = re.compile(r"[.*\.]*.*/")
 
 class Request:
     """
@@ -6,64 +11,69 @@ class Request:
     """
     def __init__(self, content):
         """
-        The constructor will take an HTTP request byte string as parameter and parse the data.
+        The constructor will take an HTTP request byte string as parameter and parse the data. If the data does not contain the empty line that ends the headers, all of it is parsed as headers. Anything after the headers is kept as the body.
         """
         self.content = content
         self.line = ""
         self.method = ""
-        self.headers = {}
-        self.body = ""
+        self.headers = Headers()
+        self.body = b""
+        self.source = None
         self.host = ""
         self.url = ""
         self.valid = False
-        self.regex = re.compile("[.*\.]*.*/")
+        self.regex = HOST_PATTERN
+        self.timings = {}
 
         try:
-            temp_headers = content.split(b"\r\n\r\n")[0]
-            temp_headers = temp_headers.decode("utf-8")
-            self.parse_host(temp_headers, True)
-            self.method = temp_headers.split()[0]
-        
-            for index, current_line in enumerate(temp_headers.split("\r\n")):
-                if index < 1:
-                    self.line = current_line
-                elif ":" in current_line:
-                    key, value = current_line.split(":", 1)
-                    self.headers[key] = value
-        except:             
+            end = find_head_end(content)
+            if end < 0:
+                end = len(content)
+            else:
+                self.body = content[end:]
+            self.line, self.headers = parse_head(content, end)
+            self.parse_host(self.line, True)
+            self.method = self.line.split()[0]
+        except:
             pass
 
         
     def encode(self):
         """
-        This function will encode all the data in the request back to a byte-string. This function needs to be called before the request is sent to the server.
+        This function will encode all the data in the request back to a byte-string. This function needs to be called before the request is sent to the server. If the request has a source, the body is not included and has to be sent from the source afterwards.
         """
         if not self.valid:
             return self.content
         request = self.line + "\r\n"
-        for key, value in self.headers.items():
+        for key, value in self.headers.raw_items():
             request += ":".join((key, value)) + "\r\n"
-        request = (request[0:-2] + "\r\n\r\n").encode("utf-8")
+        request = (request[0:-2] + "\r\n\r\n").encode("utf-8") + self.body
         return request
 
     def manipulate(self, replacements, connection_id):
         """
-        This function manipulates the request, the parameter replacement must be a dictionary where the keys are the values we want to substitute and the values are the new values. It will only replace characters in the line.
+        This function manipulates the request, the parameter replacement must be a dictionary where the keys are the values we want to substitute and the values are the new values, or a RuleSet. It will only replace characters in the line. Only the rules for the host and path of the request are tried, and the host is only parsed again if the line was changed.
         """
         try:
-            for match, replacement in replacements.items():
-                self.line = re.sub(match, replacement, self.line)
-            self.parse_host(self.line, False)
-            print("\033[92m" + f"[CONNECTION #{connection_id}] The request was manipulated succesfully" + "\033[0m")
+            if not isinstance(replacements, RuleSet):
+                replacements = compile_rules(tuple(replacements.items()))
+            self.line, changed = replacements.apply(self.line, self.host, request_path(self.url))
+            if changed:
+                self.parse_host(self.line, False)
+            log.debug("[CONNECTION #%s] The request was manipulated succesfully", connection_id)
         except:
-            print("\033[91m" + f"[CONNECTION #{connection_id}] Failed to manipulate the request" + "\033[0m")
+            log.error("[CONNECTION #%s] Failed to manipulate the request", connection_id)
 
     def parse_host(self, data, update_url):
         """
-        This function parses the host. It will also parse the url if update_url i set to true.
+        This function parses the host. It will also parse the url if update_url i set to true. The target of a CONNECT request is only a host and a port, like "example.com:443", which is kept as the host and the url.
         """
         try:
-            if self.regex.match(data):
+            if data.startswith("CONNECT "):
+                self.host = data.split(" ")[1]
+                if not self.host or "/" in self.host:
+                    raise ValueError(f"Invalid CONNECT target {self.host}")
+            elif self.regex.match(data):
                 self.host = data.split("//")[1].split("/")[0]
             else:
                 self.host = data.split(" ")[1].split(":")[0]
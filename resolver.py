@@ -0,0 +1,249 @@
+import asyncio
+import errno
+import selectors
+import socket
+import threading
+import time
+from singleflight import SingleFlight
+from logger import log
+
+class ResolverEntry:
+    """
+    This class represents the result of a lookup. Successful lookups have a list of (family, address) pairs, failed lookups keep the error so it can be raised again until the entry expires.
+    """
+    def __init__(self, addresses, error, ttl):
+        self.addresses = addresses
+        self.error = error
+        self.expires = time.monotonic() + ttl
+
+class Resolver:
+    """
+    This class resolves the names of the servers and opens connections to them. The results of getaddrinfo are cached for ttl seconds and failed lookups for negative_ttl seconds, so a name is not looked up again for every request. Concurrent lookups of the same name are collapsed into one. A result that expired less than stale_ttl seconds ago is still used while it is looked up again in the background, so requests only wait for the resolver the first time a name is used.
+
+    getaddrinfo does not tell the TTL of the DNS records, so the same ttl is used for all names.
+    """
+    def __init__(self, ttl=60, negative_ttl=5, stale_ttl=30, max_entries=4096, happy_eyeballs_delay=0.25):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.happy_eyeballs_delay = happy_eyeballs_delay
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.flights = SingleFlight()
+        self.refreshing = set()
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+
+    def resolve(self, host, port):
+        """
+        This function returns the addresses of a host as a list of (family, address) pairs, ordered so that the address families alternate. Raises socket.gaierror if the name can not be resolved.
+        """
+        key = (host.lower(), port)
+        entry = self.entries.get(key)
+        now = time.monotonic()
+        if entry is not None and now < entry.expires:
+            self.hits += 1
+        elif entry is not None and entry.error is None and now < entry.expires + self.stale_ttl:
+            self.hits += 1
+            self.refresh_in_background(key)
+        else:
+            self.misses += 1
+            entry = self.flights.do(key, lambda: self.lookup(key))
+        if entry.error is not None:
+            raise socket.gaierror(*entry.error.args)
+        return entry.addresses
+
+    async def resolve_async(self, host, port):
+        """
+        This coroutine returns the addresses of a host like resolve. Lookups that are not cached run in a thread, so the event loop is never blocked.
+        """
+        entry = self.entries.get((host.lower(), port))
+        if entry is not None and entry.error is None and time.monotonic() < entry.expires:
+            self.hits += 1
+            return entry.addresses
+        return await asyncio.get_running_loop().run_in_executor(None, self.resolve, host, port)
+
+    def lookup(self, key):
+        """
+        This function looks up a name with getaddrinfo and stores the result in the cache.
+        """
+        host, port = key
+        try:
+            infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+            entry = ResolverEntry(interleave([(family, address) for family, _, _, _, address in infos]), None, self.ttl)
+        except (socket.gaierror, UnicodeError) as error:
+            self.failures += 1
+            log.warning("[RESOLVER] Could not resolve %s: %s", host, error)
+            entry = ResolverEntry([], socket.gaierror(*error.args), self.negative_ttl)
+        with self.lock:
+            if len(self.entries) >= self.max_entries and key not in self.entries:
+                now = time.monotonic()
+                self.entries = {name: old for name, old in self.entries.items() if now < old.expires + self.stale_ttl}
+                if len(self.entries) >= self.max_entries:
+                    self.entries.clear()
+            self.entries[key] = entry
+        return entry
+
+    def refresh_in_background(self, key):
+        """
+        This function looks up a name again in a new thread. Only one refresh per name runs at the same time.
+        """
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+
+        def run():
+            try:
+                previous = self.entries.get(key)
+                entry = self.lookup(key)
+                if entry.error is not None and previous is not None and previous.error is None:
+                    # Keep the stale addresses rather than failing requests that could still connect
+                    with self.lock:
+                        self.entries[key] = previous
+            finally:
+                with self.lock:
+                    self.refreshing.discard(key)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def connect(self, address, timeout=None):
+        """
+        This function opens a connection to a (host, port) address and returns the socket with the timeout set. If the host has several addresses they are tried in the style of Happy Eyeballs: when an attempt has not succeeded after happy_eyeballs_delay seconds the next address is tried in parallel, and the first connection that is established is used. A socket.timeout is raised if no connection is established within timeout seconds.
+        """
+        addresses = self.resolve(*address)
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        selector = selectors.DefaultSelector()
+        pending = []
+        error = None
+        index = 0
+        started = 0
+        try:
+            while True:
+                now = time.monotonic()
+                if index < len(addresses) and (not pending or now - started >= self.happy_eyeballs_delay):
+                    family, sockaddr = addresses[index]
+                    index += 1
+                    sock = socket.socket(family, socket.SOCK_STREAM)
+                    sock.setblocking(False)
+                    code = sock.connect_ex(sockaddr)
+                    if code == 0:
+                        sock.settimeout(timeout)
+                        return sock
+                    if code not in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                        sock.close()
+                        error = OSError(code, f"Could not connect to {sockaddr}")
+                        continue
+                    selector.register(sock, selectors.EVENT_WRITE, sockaddr)
+                    pending.append(sock)
+                    started = now
+                    continue
+                if not pending:
+                    raise error or OSError(f"Could not connect to {address[0]}")
+                wait = self.happy_eyeballs_delay - (now - started) if index < len(addresses) else None
+                if deadline is not None:
+                    if now >= deadline:
+                        raise socket.timeout(f"Could not connect to {address[0]} within {timeout} seconds")
+                    wait = deadline - now if wait is None else min(wait, deadline - now)
+                for key, _ in selector.select(wait):
+                    sock = key.fileobj
+                    selector.unregister(sock)
+                    pending.remove(sock)
+                    code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if code == 0:
+                        sock.settimeout(timeout)
+                        return sock
+                    sock.close()
+                    error = OSError(code, f"Could not connect to {key.data}")
+                    # Start the next attempt right away
+                    started = 0
+        finally:
+            for sock in pending:
+                sock.close()
+            selector.close()
+
+    async def connect_async(self, address):
+        """
+        This coroutine opens a connection to a (host, port) address like connect and returns the non-blocking socket. The caller should limit how long it may take with asyncio.wait_for.
+        """
+        addresses = await self.resolve_async(*address)
+        loop = asyncio.get_running_loop()
+
+        async def attempt(family, sockaddr):
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            try:
+                await loop.sock_connect(sock, sockaddr)
+            except BaseException:
+                sock.close()
+                raise
+            return sock
+
+        pending = set()
+        winner = None
+        error = None
+        index = 0
+        try:
+            while winner is None:
+                if index < len(addresses):
+                    pending.add(asyncio.ensure_future(attempt(*addresses[index])))
+                    index += 1
+                elif not pending:
+                    raise error or OSError(f"Could not connect to {address[0]}")
+                done, pending = await asyncio.wait(pending, timeout=self.happy_eyeballs_delay if index < len(addresses) else None, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif winner is None:
+                        winner = task.result()
+                    else:
+                        task.result().close()
+        finally:
+            for task in pending:
+                task.cancel()
+        return winner
+
+    def clear(self):
+        """
+        This function removes all cached results.
+        """
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+def interleave(addresses):
+    """
+    This function orders a list of (family, address) pairs so that the address families alternate, starting with the family of the first address, and removes duplicates.
+    """
+    families = {}
+    for item in addresses:
+        if item not in families.setdefault(item[0], []):
+            families[item[0]].append(item)
+    ordered = []
+    queues = list(families.values())
+    while queues:
+        for queue in queues:
+            ordered.append(queue.pop(0))
+        queues = [queue for queue in queues if queue]
+    return ordered
+
+def split_host(host, default_port=80):
+    """
+    This function splits a host like "example.com:8080" or "[::1]:8080" into the name and the port. The default_port is used if the host has no port. Raises ValueError if the port is not a number.
+    """
+    if host.startswith("["):
+        name, _, rest = host[1:].partition("]")
+        port = rest[1:] if rest.startswith(":") else ""
+    elif host.count(":") == 1:
+        name, _, port = host.partition(":")
+    else:
+        name, port = host, ""
+    if not port:
+        return name, default_port
+    if not port.isdigit() or not 0 < int(port) < 65536:
+        raise ValueError(f"Invalid port in {host}")
+    return name, int(port)
@@ -1,8 +1,16 @@
-import re
+import itertools
+from rewriter import Rewriter, compile_rewriter
+from socketreader import body_framing, decode_chunked
+from httpparser import Headers, find_head_end, parse_head
+from logger import log
+from encoding import compress, content_encoding, decompress, supported
+
+# Frozen responses are numbered so that copies made from them can be found again
+VERSIONS = itertools.count(1)
 
 class Response:
     """
-    This class represents a HTTP request.
+    This class represents a HTTP response.
     """
     def __init__(self, content):
         """
@@ -11,22 +19,27 @@ class Response:
         self.content = content
         self.line = ""
         self.status_code = ""
-        self.headers = {}
-        self.body = ""
+        self.headers = Headers()
+        self.body = b""
+        self.source = None
+        # True if the first piece of the body in source can be produced without waiting for the server
+        self.buffered = False
+        # True as long as the body in source is collected to be stored in the cache
+        self.caching = False
+        self.wire = None
+        # Identifies the content of a frozen or stored response, see freeze
+        self.version = None
         self.valid = False
 
         try:
-            temp_headers, self.body = content.split(b"\r\n\r\n", 1)
-            temp_headers = temp_headers.decode()
-            self.status_code = temp_headers.split(" ", 2)[1]
-            for index, current_line in enumerate(temp_headers.split("\r\n")):
-                if index < 1:
-                    self.line = current_line
-                elif ":" in current_line:
-                    key, value = current_line.split(":", 1)
-                    self.headers[key] = value
-            self.valid = True
-            
+            end = find_head_end(content)
+            if end >= 0:
+                self.line, self.headers = parse_head(content, end)
+                self.status_code = self.line.split(" ", 2)[1]
+                if len(self.status_code) != 3 or not self.status_code.isdigit():
+                    raise ValueError("Invalid status code")
+                self.body = content[end:]
+                self.valid = True
         except:
             self.valid = False
 
@@ -36,20 +49,55 @@ class Response:
         """
         if not self.valid:
             return self.content
+        return self.encode_head() + self.body
+
+    def encode_head(self):
+        """
+        This function will encode the status line and the headers of the response to a byte-string, including the empty line that ends them.
+        """
         response = self.line + "\r\n"
-        for key, value in self.headers.items():
+        for key, value in self.headers.raw_items():
             response += ":".join((key, value)) + "\r\n"
-        response = (response[0:-2] + "\r\n\r\n").encode("utf-8") + self.body
-        return response
+        return (response[0:-2] + "\r\n\r\n").encode("utf-8")
+
+    def freeze(self):
+        """
+        This function encodes the head of the response once for a persistent connection and once for a connection that is closed afterwards, and stores them in wire. The response can then be sent any number of times without encoding it again, see Proxy.send_response. The response must not be changed after it has been frozen, it gets a version number that identifies its content.
+        """
+        if self.wire is None and self.valid:
+            wire = {}
+            for persistent in (True, False):
+                self.headers["Connection"] = " keep-alive" if persistent else " close"
+                wire[persistent] = self.encode_head()
+            self.wire = wire
+            if self.version is None:
+                self.version = next(VERSIONS)
+        return self
 
     def manipulate(self, replacements, connection_id):
         """
-        This function manipulates the response, the parameter replacement must be a dictionary where the keys are the values we want to substitute and the values are the new values. It will replace all contents in the body of the response.
+        This function manipulates the response, the parameter replacement must be a dictionary where the keys are the values we want to substitute and the values are the new values, or a Rewriter. It will replace all contents in the body of the response in a single pass. Bodies with chunked encoding are decoded first and the Content-Length is updated to match the new body. Compressed bodies are decompressed before the replacements and compressed again with the same coding afterwards, bodies with a coding the proxy does not support are not changed. Responses whose status does not allow a body, like 304 Not Modified, are not changed either, their Content-Length describes the body of another response.
         """
         try:
-            for match, replacement in replacements.items():
-                self.body = re.sub(match, replacement, self.body)
-                
-            print("\033[92m" + f"[CONNECTION #{connection_id}] The response was manipulated succesfully" + "\033[0m")
+            if body_framing(self.headers, "GET", self.status_code)[0] == "none":
+                return
+            if not isinstance(replacements, Rewriter):
+                replacements = compile_rewriter(tuple(replacements.items()))
+            encoding = content_encoding(self.headers)
+            if encoding and not supported(encoding):
+                log.debug("[CONNECTION #%s] The response was not manipulated, %s is not supported", connection_id, encoding)
+                return
+            if "chunked" in self.headers.get("Transfer-Encoding", ""):
+                self.body = decode_chunked(self.body)
+                del self.headers["Transfer-Encoding"]
+                self.headers["Content-Length"] = ""
+            if encoding:
+                self.body = compress(encoding, replacements.sub(decompress(encoding, self.body)))
+            else:
+                self.body = replacements.sub(self.body)
+            if "Content-Length" in self.headers:
+                self.headers["Content-Length"] = f" {len(self.body)}"
+
+            log.debug("[CONNECTION #%s] The response was manipulated succesfully", connection_id)
         except:
-            print("\033[91m" + f"[CONNECTION #{connection_id}] Failed to manipulate the response" + "\033[0m")
+            log.error("[CONNECTION #%s] Failed to manipulate the response", connection_id)
@@ -0,0 +1,101 @@
+import copy
+import hashlib
+import re
+from functools import lru_cache
+
+BACKREFERENCE = re.compile(rb"\\[1-9]|\(\?P=")
+
+class Rewriter:
+    """
+    This class replaces all matches of a set of patterns in a single pass. The patterns are compiled into one combined regex, so the body is only scanned once no matter how many replacements there are. It can also rewrite a body that arrives in chunks, see feed.
+    """
+    def __init__(self, replacements, window=4096):
+        """
+        The parameter replacements must be a dictionary where the keys are the byte patterns we want to substitute and the values are the new values. Matches are never longer than window bytes when the body is rewritten in chunks.
+        """
+        self.window = window
+        self.patterns = [re.compile(match) for match in replacements.keys()]
+        self.replacements = list(replacements.values())
+        self.literal = [b"\\" not in replacement for replacement in self.replacements]
+        self.history = b""
+        self.pending = b""
+        self.combined = None
+        self.rules = {}
+        # Identifies the replacements across processes and restarts, empty if there are none
+        self.fingerprint = hashlib.sha1(repr(list(replacements.items())).encode("utf-8")).hexdigest()[:16] if replacements else ""
+
+        # Patterns with backreferences can not be combined since the group numbers change
+        if self.patterns and not any(BACKREFERENCE.search(pattern.pattern) for pattern in self.patterns):
+            try:
+                self.combined = re.compile(b"|".join(b"(?P<_rule%d>%s)" % (index, pattern.pattern) for index, pattern in enumerate(self.patterns)))
+                self.rules = {self.combined.groupindex[f"_rule{index}"]: index for index in range(len(self.patterns))}
+            except re.error:
+                self.combined = None
+
+    def stream(self):
+        """
+        This function returns a rewriter with the same compiled patterns but without any state, it should be used for every new body that is rewritten with feed.
+        """
+        rewriter = copy.copy(self)
+        rewriter.history = b""
+        rewriter.pending = b""
+        return rewriter
+
+    def replace(self, match):
+        """
+        This function returns the replacement for a match of the combined regex.
+        """
+        index = self.rules[match.lastindex]
+        if self.literal[index]:
+            return self.replacements[index]
+        own = self.patterns[index].match(match.string, match.start())
+        return own.expand(self.replacements[index]) if own else match.group()
+
+    def sub(self, data):
+        """
+        This function rewrites a complete body and returns the result.
+        """
+        if self.combined is not None:
+            return self.combined.sub(self.replace, data)
+        for pattern, replacement in zip(self.patterns, self.replacements):
+            data = pattern.sub(replacement, data)
+        return data
+
+    def feed(self, data, final=False):
+        """
+        This function rewrites the next chunk of a body and returns the output that is ready to be sent. The last window bytes are kept until more data arrives, so matches that cross the border between two chunks are still found. Set final to True for the last chunk to get the rest of the output.
+        """
+        if self.combined is None:
+            # Patterns that could not be combined are applied to the whole body at the end
+            self.pending += data
+            if not final:
+                return b""
+            output, self.pending = self.sub(self.pending), b""
+            return output
+
+        text = self.history + self.pending + data
+        start = len(self.history)
+        safe = len(text) if final else max(start, len(text) - self.window)
+        output = []
+        position = start
+        limit = safe
+        for match in self.combined.finditer(text, start):
+            if not final and (match.end() > safe or match.start() == safe):
+                # The match could continue in the next chunk, an empty match at the border is found again there
+                limit = max(position, min(safe, match.start()))
+                break
+            output.append(text[position:match.start()])
+            output.append(self.replace(match))
+            position = match.end()
+        limit = max(position, limit)
+        output.append(text[position:limit])
+        self.pending = text[limit:]
+        self.history = text[max(0, limit - self.window):limit]
+        return b"".join(output)
+
+@lru_cache(maxsize=32)
+def compile_rewriter(replacements):
+    """
+    This function returns a rewriter for a tuple of (match, replacement) pairs. The rewriters are cached, so the patterns are only compiled once.
+    """
+    return Rewriter(dict(replacements))
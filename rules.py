@@ -0,0 +1,176 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from functools import lru_cache
+from logger import log
+
+# Characters that end the literal prefix of a pattern
+SPECIAL = set(".^$*+?{}[]\\|()")
+
+class Rule:
+    """
+    This class is a compiled replacement rule for the start line of a request. A rule can be limited to a host and to a path prefix. The host is either a name like "example.com" or a wildcard like "*.example.com" that matches all subdomains. Rules with a lower priority are applied first, rules with the same priority in the order they were added.
+    """
+    def __init__(self, match, replacement, host=None, path=None, priority=0):
+        self.match = match
+        self.pattern = re.compile(match)
+        self.replacement = replacement
+        self.host = host.lower() if host else None
+        self.path = path or None
+        self.priority = priority
+        self.literal = literal_prefix(match)
+
+    def apply(self, line):
+        """
+        This function applies the rule to a line. Returns the new line and the number of replacements.
+        """
+        if self.literal and self.literal not in line:
+            return line, 0
+        return self.pattern.subn(self.replacement, line)
+
+class RuleSet:
+    """
+    This class applies a list of rules to requests. The rules are compiled once and indexed by host, so only the rules for the host of a request and the rules without a host are tried. Rules with a path prefix are skipped for other paths, and rules whose pattern starts with literal text are skipped when the line does not contain it. If first_match is True only the first rule that changes the line is applied, otherwise all rules are applied one after another.
+    """
+    def __init__(self, rules=(), first_match=False):
+        self.rules = sorted(rules, key=lambda rule: rule.priority)
+        self.first_match = first_match
+        self.hosts = {}
+        self.wildcards = []
+        self.any_host = []
+        for position, rule in enumerate(self.rules):
+            if rule.host is None:
+                self.any_host.append((position, rule))
+            elif rule.host.startswith("*."):
+                self.wildcards.append((rule.host[1:], position, rule))
+            else:
+                self.hosts.setdefault(rule.host, []).append((position, rule))
+        self.candidates_cache = {}
+        # Identifies the rules across processes and restarts, empty if there are none
+        self.fingerprint = hashlib.sha1(repr([(rule.match, rule.replacement, rule.host, rule.path, rule.priority) for rule in self.rules] + [first_match]).encode("utf-8")).hexdigest()[:16] if self.rules else ""
+
+    def candidates(self, host):
+        """
+        This function returns the rules that can apply to a host, in the order they are applied.
+        """
+        host = host.split(":")[0].lower()
+        rules = self.candidates_cache.get(host)
+        if rules is None:
+            found = self.any_host + self.hosts.get(host, [])
+            found += [(position, rule) for suffix, position, rule in self.wildcards if host.endswith(suffix)]
+            rules = [rule for _, rule in sorted(found, key=lambda item: item[0])]
+            if len(self.candidates_cache) > 4096:
+                self.candidates_cache.clear()
+            self.candidates_cache[host] = rules
+        return rules
+
+    def apply(self, line, host, path):
+        """
+        This function applies the rules to the start line of a request for a host and a path. Returns the new line and True if it was changed.
+        """
+        changed = False
+        for rule in self.candidates(host):
+            if rule.path is not None and not path.startswith(rule.path):
+                continue
+            line, count = rule.apply(line)
+            if count:
+                changed = True
+                if self.first_match:
+                    break
+        return line, changed
+
+    def __len__(self):
+        return len(self.rules)
+
+class RuleFile:
+    """
+    This class loads a ruleset from a JSON file and loads it again when the file changes, so the rules can be changed without restarting the proxy. The file is checked at most every interval seconds. If the new file can not be loaded the previous rules are kept.
+
+    The file contains an object like {"first_match": false, "rules": [{"match": "...", "replacement": "...", "host": "example.com", "path": "/images/", "priority": 0}]}, only match and replacement are required.
+    """
+    def __init__(self, path, interval=1.0):
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.checked = time.monotonic()
+        self.modified = os.stat(path).st_mtime_ns
+        self.ruleset = load_rules(path)
+        self.reloads = 0
+
+    def current(self):
+        """
+        This function returns the current ruleset, after loading the file again if it has changed.
+        """
+        now = time.monotonic()
+        if now - self.checked >= self.interval and self.lock.acquire(blocking=False):
+            try:
+                self.checked = now
+                self.reload()
+            finally:
+                self.lock.release()
+        return self.ruleset
+
+    def reload(self, force=False):
+        """
+        This function loads the file again if it has been modified since it was loaded. Returns True if new rules were loaded.
+        """
+        try:
+            modified = os.stat(self.path).st_mtime_ns
+            if modified == self.modified and not force:
+                return False
+            ruleset = load_rules(self.path)
+        except (OSError, ValueError, KeyError, TypeError, re.error) as error:
+            log.error("[RULES] Could not load %s, keeping the previous rules: %s", self.path, error)
+            return False
+        self.modified = modified
+        self.ruleset = ruleset
+        self.reloads += 1
+        log.info("[RULES] Loaded %s rules from %s", len(ruleset), self.path)
+        return True
+
+def load_rules(path):
+    """
+    This function reads a ruleset from a JSON file.
+    """
+    with open(path, encoding="utf-8") as file:
+        data = json.load(file)
+    rules = [Rule(item["match"], item["replacement"], item.get("host"), item.get("path"), item.get("priority", 0)) for item in data.get("rules", [])]
+    return RuleSet(rules, bool(data.get("first_match", False)))
+
+@lru_cache(maxsize=32)
+def compile_rules(replacements, base=None):
+    """
+    This function returns a RuleSet for a tuple of (match, replacement) pairs, added after the rules of the base ruleset if one is given. The result is cached, so the patterns are only compiled once for the same replacements.
+    """
+    rules = list(base.rules) if base is not None else []
+    rules += [Rule(match, replacement, priority=rules[-1].priority if rules else 0) for match, replacement in replacements]
+    return RuleSet(rules, base.first_match if base is not None else False)
+
+def literal_prefix(pattern):
+    """
+    This function returns the literal text at the start of a pattern that every match must contain, or an empty string. Patterns with alternatives have no literal prefix.
+    """
+    if "|" in pattern:
+        return ""
+    prefix = ""
+    for character in pattern:
+        if character in SPECIAL:
+            if character in "*?{" and prefix:
+                # The last character is optional or repeated
+                prefix = prefix[:-1]
+            break
+        prefix += character
+    return prefix
+
+def request_path(url):
+    """
+    This function returns the path of a request URL, which can be absolute like "http://example.com/path" or only the path.
+    """
+    if "//" in url:
+        url = url.split("//", 1)[1]
+        index = url.find("/")
+        return url[index:] if index >= 0 else "/"
+    return url
@@ -0,0 +1,108 @@
+import asyncio
+import threading
+import time
+
+class Flight:
+    """
+    This class represents a call that is in progress. Other threads that want the same result wait for the event.
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.waiters = []
+        self.started = time.time()
+
+class SingleFlight:
+    """
+    This class makes sure that only one thread at a time does the work for a key. The first thread becomes the leader and does the work, threads that arrive while it is in progress wait for the result of the leader instead of doing the same work again. If the leader fails or takes longer than the timeout, the waiting threads do the work themselves.
+    """
+    def __init__(self):
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.leaders = 0
+        self.collapsed = 0
+        self.fallbacks = 0
+
+    def begin(self, key):
+        """
+        This function joins the flight for a key, a new flight is started if there is none. Returns the flight and True if the caller is the leader.
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self.flights[key] = Flight()
+            self.leaders += 1
+            return flight, True
+
+    def finish(self, key, flight, result):
+        """
+        This function is called by the leader when the work is done. A result of None tells the waiting threads that the leader failed. Only the first call counts.
+        """
+        with self.lock:
+            if flight.event.is_set():
+                return
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+            flight.result = result
+            flight.event.set()
+            waiters, flight.waiters = flight.waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(wake, future)
+
+    def wait(self, flight, timeout=None):
+        """
+        This function waits for the leader of a flight and returns its result, or None if the leader failed or the timeout expired.
+        """
+        if not flight.event.wait(timeout):
+            return None
+        return flight.result
+
+    async def wait_async(self, flight, timeout=None):
+        """
+        This coroutine waits for the leader of a flight like wait, without blocking the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self.lock:
+            if flight.event.is_set():
+                return flight.result
+            flight.waiters.append((loop, future))
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        return flight.result
+
+    def count(self, collapsed):
+        """
+        This function counts a waiting thread that could use the result of the leader, or that had to fall back to doing the work itself.
+        """
+        with self.lock:
+            if collapsed:
+                self.collapsed += 1
+            else:
+                self.fallbacks += 1
+
+    def do(self, key, function, timeout=None):
+        """
+        This function calls function once for all threads that ask for the same key at the same time and returns its result to all of them.
+        """
+        flight, leader = self.begin(key)
+        if leader:
+            result = None
+            try:
+                result = function()
+            finally:
+                self.finish(key, flight, result)
+            return result
+        result = self.wait(flight, timeout)
+        self.count(result is not None)
+        return result if result is not None else function()
+
+def wake(future):
+    """
+    This function wakes up a coroutine that waits for a flight, unless it stopped waiting already.
+    """
+    if not future.done():
+        future.set_result(None)
@@ -0,0 +1,144 @@
+import socket
+import time
+from httpparser import find_head_end
+
+class SocketReader:
+    """
+    This class reads HTTP messages from a socket through a buffer. It knows where a message ends, which makes it possible to keep connections open and read several messages from the same socket.
+    """
+    def __init__(self, sock, buffer_size=65536):
+        self.sock = sock
+        self.buffer = bytearray()
+        self.chunk = bytearray(buffer_size)
+        self.view = memoryview(self.chunk)
+        self.head_started = None
+
+    def fill(self):
+        """
+        This function receives more data from the socket into the buffer. Returns the number of bytes received, 0 means that the connection was closed.
+        """
+        size = self.sock.recv_into(self.view)
+        if size:
+            self.buffer += self.view[:size]
+        return size
+
+    def read_head(self, max_size=65536, timeout=None):
+        """
+        This function reads the start line and headers of a message, including the empty line that ends them. If the connection is closed before the header block is complete, the data received so far is returned. A ValueError is raised if the header block is larger than max_size. If a timeout is given the complete header block must arrive within that many seconds, otherwise a socket.timeout is raised. This stops clients that send the headers very slowly. The time when the first byte of the message was available is stored in head_started, so waiting for a message on an idle connection is not counted as reading it.
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        self.head_started = time.perf_counter() if self.buffer else None
+        start = 0
+        while True:
+            end = find_head_end(self.buffer, start)
+            if end > max_size:
+                raise ValueError("Header block is too large")
+            if end >= 0:
+                head = bytes(self.buffer[:end])
+                del self.buffer[:end]
+                return head
+            if len(self.buffer) > max_size:
+                raise ValueError("Header block is too large")
+            start = len(self.buffer)
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise socket.timeout("The header block did not arrive in time")
+                self.sock.settimeout(remaining)
+            if not self.fill():
+                head = bytes(self.buffer)
+                self.buffer.clear()
+                return head
+            if self.head_started is None:
+                self.head_started = time.perf_counter()
+
+    def read(self, size):
+        """
+        This function returns at most size bytes, an empty result means that the connection was closed. Data that is read directly from the socket is returned as a memoryview that is only valid until the next read.
+        """
+        if self.buffer:
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+            return data
+        received = self.sock.recv_into(self.view, min(size, len(self.chunk)))
+        return self.view[:received]
+
+    def read_line(self, max_size=8192):
+        """
+        This function reads a single line ending with CRLF and returns it without the line break.
+        """
+        while True:
+            index = self.buffer.find(b"\r\n")
+            if index >= 0:
+                line = bytes(self.buffer[:index])
+                del self.buffer[:index + 2]
+                return line
+            if len(self.buffer) > max_size:
+                raise ValueError("Line is too long")
+            if not self.fill():
+                raise ConnectionError("Connection closed in the middle of a line")
+
+    def iter_body(self, framing, length=None):
+        """
+        This function yields the body of a message piece by piece. The framing and length should come from body_framing. Chunked bodies are decoded, so only the payload is yielded.
+        """
+        if framing == "length":
+            yield from self.iter_length(length)
+        elif framing == "chunked":
+            while True:
+                size = int(self.read_line().split(b";")[0], 16)
+                if size == 0:
+                    # Skip the trailers
+                    while self.read_line():
+                        pass
+                    return
+                yield from self.iter_length(size)
+                self.read_line()
+        elif framing == "close":
+            data = self.read(len(self.chunk))
+            while data:
+                yield data
+                data = self.read(len(self.chunk))
+
+    def iter_length(self, length):
+        """
+        This function yields exactly length bytes. A ConnectionError is raised if the connection is closed before that.
+        """
+        remaining = length
+        while remaining:
+            data = self.read(min(remaining, len(self.chunk)))
+            if not data:
+                raise ConnectionError("Connection closed in the middle of a body")
+            remaining -= len(data)
+            yield data
+
+def body_framing(headers, method, status_code=None):
+    """
+    This function decides how the end of a message body is found. Returns a tuple with one of "none", "length", "chunked" or "close" and the length of the body if it is known. The status_code should be None for requests. A ValueError is raised if the Content-Length is not a number of bytes.
+    """
+    if method == "HEAD" or status_code in ("204", "304") or (status_code or "").startswith("1"):
+        return ("none", 0)
+    if "chunked" in headers.get("Transfer-Encoding", "").lower():
+        return ("chunked", None)
+    if "Content-Length" in headers:
+        length = headers["Content-Length"].strip()
+        if not length.isdigit():
+            raise ValueError("Invalid Content-Length")
+        return ("length", int(length))
+    if status_code is None:
+        return ("none", 0)
+    return ("close", None)
+
+def decode_chunked(data):
+    """
+    This function decodes a complete body with chunked encoding and returns the payload.
+    """
+    body = bytearray()
+    position = 0
+    while True:
+        end = data.index(b"\r\n", position)
+        size = int(data[position:end].split(b";")[0], 16)
+        if size == 0:
+            return bytes(body)
+        body += data[end + 2:end + 2 + size]
+        position = end + 4 + size
@@ -0,0 +1,131 @@
+import os
+import signal
+import threading
+import time
+from multiprocessing.sharedctypes import RawArray
+from logger import log
+
+class Supervisor:
+    """
+    This class runs a configured proxy in several worker processes, so it can use all cores of the machine. The workers are forked from the supervisor and therefore share the configuration of the proxy, including the replacements. By default all workers accept connections on the listening socket of the proxy. If reuse_port is True every worker instead opens its own socket on the same port with SO_REUSEPORT and the kernel spreads the connections between them. Workers that crash are restarted. This class requires a system with fork, like Linux or macOS.
+    """
+    def __init__(self, proxy, workers=None, reuse_port=False, shutdown_timeout=10):
+        self.proxy = proxy
+        self.workers = workers or os.cpu_count() or 1
+        self.reuse_port = reuse_port
+        self.shutdown_timeout = shutdown_timeout
+        self.pids = {}
+        self.connections = RawArray("q", self.workers)
+        self.restarts = [0] * self.workers
+        self.running = False
+
+    def run(self):
+        """
+        Run this function to start the workers. It returns when the supervisor has been stopped with SIGTERM, SIGINT or stop and all workers have exited. Send SIGUSR1 to print the statistics of the workers.
+        """
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+            signal.signal(signal.SIGINT, lambda signum, frame: self.stop())
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.print_stats())
+
+        if self.reuse_port:
+            # The workers open their own sockets, the port must be free for them
+            self.port = self.proxy.server.getsockname()[1]
+            self.proxy.server.close()
+
+        self.running = True
+        for worker in range(self.workers):
+            self.spawn(worker)
+        log.info("[SUPERVISOR STARTED] Started %s workers (%s, %s)", self.workers, self.proxy.host, self.proxy.port)
+
+        while self.running or self.pids:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            worker = self.pids.pop(pid, None)
+            if worker is not None and self.running:
+                self.restarts[worker] += 1
+                log.error("[SUPERVISOR] Worker %s (pid %s) exited with status %s, restarting it", worker, pid, status)
+                self.spawn(worker)
+
+    def spawn(self, worker):
+        """
+        This function forks a new process for a worker.
+        """
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                self.work(worker)
+                code = 0
+            finally:
+                log.flush()
+                os._exit(code)
+        self.pids[pid] = worker
+
+    def work(self, worker):
+        """
+        This function is run in the worker processes. It serves connections until the worker gets SIGTERM, then it waits for the requests that are being handled before it exits.
+        """
+        def stop(signum, frame):
+            # The listening socket may be shared with the other workers, so it is only closed and not shut down
+            self.proxy.running = False
+            self.proxy.server.close()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+        if self.reuse_port:
+            self.proxy.server = self.proxy.listen(self.port, True)
+
+        def report():
+            while True:
+                self.connections[worker] = self.proxy.request_id
+                time.sleep(1)
+
+        threading.Thread(target=report, daemon=True).start()
+        self.proxy.run()
+        deadline = time.monotonic() + self.shutdown_timeout
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread() and not thread.daemon:
+                thread.join(max(0, deadline - time.monotonic()))
+
+    def stop(self):
+        """
+        This function stops the supervisor. The workers get SIGTERM and finish the requests they are handling, workers that are still running after shutdown_timeout seconds are killed.
+        """
+        if not self.running:
+            return
+        self.running = False
+        for pid in list(self.pids):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+        def kill():
+            time.sleep(self.shutdown_timeout)
+            for pid in list(self.pids):
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+        threading.Thread(target=kill, daemon=True).start()
+
+    def stats(self):
+        """
+        This function returns a list with the pid, the number of handled connections and the number of restarts of every worker.
+        """
+        pids = {worker: pid for pid, worker in self.pids.items()}
+        return [{"worker": worker, "pid": pids.get(worker), "connections": self.connections[worker], "restarts": self.restarts[worker]} for worker in range(self.workers)]
+
+    def print_stats(self):
+        """
+        This function prints the statistics of the workers.
+        """
+        for stats in self.stats():
+            log.info("[WORKER %s] pid %s, %s connections, %s restarts", stats['worker'], stats['pid'], stats['connections'], stats['restarts'])
@@ -0,0 +1,189 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from logger import log
+
+# The points in handling a request where hooks are called, in order
+HOOK_POINTS = ("pre_parse", "post_parse", "pre_upstream", "post_upstream", "pre_send", "post_send")
+
+class Hooks:
+    """
+    This class holds the functions that the proxy calls at the hook points while it handles a request. Every point in HOOK_POINTS is an attribute that is None as long as no function is registered for it, so the proxy only has to check the attribute when nobody is listening. When functions are registered the attribute is a function that calls all of them in the order they were added.
+
+    Hooks are called with the id of the request, the request and the response. The id is the number of the connection and the number of the request on the connection, like "12.3". At pre_parse the request is still the raw bytes of the head, and the response is None before post_upstream. Requests answered from the cache skip pre_upstream and post_upstream. Exceptions raised by a hook are logged and do not affect the request.
+    """
+    def __init__(self):
+        self.registered = {point: [] for point in HOOK_POINTS}
+        self.lock = threading.Lock()
+        for point in HOOK_POINTS:
+            setattr(self, point, None)
+
+    def add(self, point, hook):
+        """
+        This function registers a function for a hook point. Raises ValueError if the point does not exist.
+        """
+        if point not in HOOK_POINTS:
+            raise ValueError(f"Unknown hook point {point}")
+        with self.lock:
+            self.registered[point].append(hook)
+            self.compile(point)
+
+    def remove(self, point, hook):
+        """
+        This function removes a function from a hook point. Raises ValueError if it is not registered.
+        """
+        if point not in HOOK_POINTS:
+            raise ValueError(f"Unknown hook point {point}")
+        with self.lock:
+            self.registered[point].remove(hook)
+            self.compile(point)
+
+    def compile(self, point):
+        """
+        This function replaces the attribute of a hook point with a function that calls the registered functions, or None if there are none. The attribute is replaced at once, so requests that are being handled see either the old or the new functions.
+        """
+        hooks = tuple(self.registered[point])
+        if not hooks:
+            setattr(self, point, None)
+            return
+
+        def dispatch(request_id, request, response):
+            for hook in hooks:
+                try:
+                    hook(request_id, request, response)
+                except Exception as error:
+                    log.error("[TRACING] The %s hook %r failed: %r", point, hook, error)
+
+        setattr(self, point, dispatch)
+
+class Tracer:
+    """
+    This class records when every request passes the hook points and keeps a trace of the last max_traces requests that took at least min_duration seconds. A trace has the id, the method, the url and the status of the request, the total duration, the time of every hook point since pre_parse and the duration of the phases measured by Proxy.observe, all in milliseconds. Requests that are never finished, like tunnels and lost connections, are forgotten when more than max_traces requests are open.
+    """
+    def __init__(self, max_traces=1000, min_duration=0):
+        self.traces = deque(maxlen=max_traces)
+        self.min_duration = min_duration
+        self.open = {}
+        self.markers = {}
+        self.lock = threading.Lock()
+
+    def install(self, hooks):
+        """
+        This function registers the tracer on all hook points.
+        """
+        for point in HOOK_POINTS:
+            self.markers[point] = self.marker(point)
+            hooks.add(point, self.markers[point])
+
+    def uninstall(self, hooks):
+        """
+        This function removes the tracer from all hook points.
+        """
+        for point, marker in self.markers.items():
+            hooks.remove(point, marker)
+        self.markers = {}
+
+    def marker(self, point):
+        """
+        This function returns the hook that marks a point.
+        """
+        def mark(request_id, request, response):
+            self.mark(point, request_id, request, response)
+        return mark
+
+    def mark(self, point, request_id, request, response):
+        """
+        This function records that a request passed a hook point. The trace is finished at post_send.
+        """
+        now = time.perf_counter()
+        if point == "pre_parse":
+            with self.lock:
+                self.open[request_id] = (now, {})
+                if len(self.open) > self.traces.maxlen:
+                    del self.open[next(iter(self.open))]
+            return
+        entry = self.open.get(request_id)
+        if entry is None:
+            # The tracer was installed while the request was handled
+            return
+        entry[1][point] = now - entry[0]
+        if point == "post_send":
+            with self.lock:
+                self.open.pop(request_id, None)
+            self.finish(request_id, entry[1], request, response)
+
+    def finish(self, request_id, marks, request, response):
+        """
+        This function stores the trace of a finished request.
+        """
+        duration = marks["post_send"]
+        if duration < self.min_duration:
+            return
+        if response is not None and response.valid:
+            status = int(response.status_code)
+        else:
+            status = 502 if request.valid else 400
+        self.traces.append({
+            "id": request_id,
+            "method": request.method,
+            "url": request.url,
+            "status": status,
+            "duration_ms": round(duration * 1000, 3),
+            "points_ms": {point: round(elapsed * 1000, 3) for point, elapsed in marks.items()},
+            "phases_ms": {phase: round(elapsed * 1000, 3) for phase, elapsed in request.timings.items()},
+        })
+
+    def recent(self, limit=None):
+        """
+        This function returns the last limit traces, the newest last.
+        """
+        traces = list(self.traces)
+        return traces[-limit:] if limit else traces
+
+class SamplingProfiler:
+    """
+    This class finds out where the proxy spends its time while it is running. It takes the stacks of all threads of the process every interval seconds and counts how often every stack was seen. The result is in the folded format that flamegraph.pl and speedscope read: one line per stack with the frames from the outermost to the innermost separated by semicolons, followed by the number of samples. Threads that are waiting show up as well, in their waiting function. Nothing is sampled while no profile is running, and only one profile can run at the same time.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.lock = threading.Lock()
+
+    def profile(self, seconds, interval=None):
+        """
+        This function samples the stacks for a number of seconds in the calling thread and returns the folded stacks. The calling thread itself is not sampled. Raises ValueError if a profile is already running.
+        """
+        if not self.lock.acquire(blocking=False):
+            raise ValueError("A profile is already running")
+        try:
+            interval = interval or self.interval
+            stacks = Counter()
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                self.sample(stacks)
+                time.sleep(interval)
+            return fold(stacks)
+        finally:
+            self.lock.release()
+
+    def sample(self, stacks):
+        """
+        This function adds the current stack of every other thread to the counts.
+        """
+        own = threading.get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stacks[";".join(reversed(frames))] += 1
+
+def fold(stacks):
+    """
+    This function writes counted stacks in the folded format, the most frequent stacks first.
+    """
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
@@ -0,0 +1,263 @@
+import asyncio
+import os
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+from logger import log
+
+# os.splice moves data between sockets through a pipe inside the kernel, without copying it to Python
+SPLICE = hasattr(os, "splice") and hasattr(os, "SPLICE_F_NONBLOCK")
+
+class Tunnel:
+    """
+    This class holds the state of a CONNECT tunnel that relays bytes between the client and the server in both directions, until both sides have closed their half of the connection. The proxy does not look at the bytes, which are usually TLS. The sockets of a tunnel are relayed by a TunnelRelay, the asyncio streams by relay_streams. When one side closes its half of the connection, the other side is told and the other direction keeps working. The tunnel is closed if no data has been relayed in either direction for idle_timeout seconds.
+
+    upstream_bytes and downstream_bytes count the bytes sent from the client to the server and from the server to the client.
+    """
+    def __init__(self, buffer_size=65536, idle_timeout=60, splice=SPLICE):
+        self.buffer_size = buffer_size
+        self.idle_timeout = idle_timeout
+        self.splice = splice
+        self.upstream_bytes = 0
+        self.downstream_bytes = 0
+        self.last_activity = time.monotonic()
+        self.closed = False
+        self.finished = None
+
+    def count(self, size, upstream):
+        """
+        This function counts relayed bytes.
+        """
+        self.last_activity = time.monotonic()
+        if upstream:
+            self.upstream_bytes += size
+        else:
+            self.downstream_bytes += size
+
+    async def relay_streams(self, client_reader, client_writer, server_reader, server_writer):
+        """
+        This coroutine relays the data between the asyncio streams of the client and the server, like TunnelRelay does for sockets. Both writers are closed afterwards.
+        """
+        try:
+            await asyncio.gather(self.forward_stream(client_reader, server_writer, True), self.forward_stream(server_reader, client_writer, False))
+        finally:
+            client_writer.close()
+            server_writer.close()
+
+    async def forward_stream(self, reader, writer, upstream):
+        """
+        This coroutine relays the data in one direction between asyncio streams. The write buffer is drained before the next piece is read, so a slow receiver slows down the sender.
+        """
+        try:
+            while not self.closed:
+                remaining = self.last_activity + self.idle_timeout - time.monotonic()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                try:
+                    data = await asyncio.wait_for(reader.read(self.buffer_size), min(remaining, 1.0))
+                except asyncio.TimeoutError:
+                    continue
+                if not data:
+                    if writer.can_write_eof():
+                        writer.write_eof()
+                    return
+                writer.write(data)
+                await writer.drain()
+                self.count(len(data), upstream)
+        except (OSError, asyncio.TimeoutError):
+            self.closed = True
+            writer.close()
+
+class Direction:
+    """
+    This class holds one direction of a tunnel in a TunnelRelay: the data that was received from the source but could not be sent to the destination yet, and whether the source has closed its half of the connection. With os.splice the data waits in a pipe instead.
+    """
+    def __init__(self, source, destination, upstream, splice):
+        self.source = source
+        self.destination = destination
+        self.upstream = upstream
+        self.pending = b""
+        self.pipe = os.pipe() if splice else None
+        self.piped = 0
+        self.done = False
+
+    def blocked(self):
+        """
+        This function returns True if received data is waiting for the destination.
+        """
+        return bool(self.pending) or self.piped > 0
+
+class TunnelRelay:
+    """
+    This class relays the sockets of many tunnels in a single thread, so an open tunnel does not hold a thread while it waits for data. The thread waits with a selector until a socket is ready and moves as much data as it can without blocking. On Linux the data is moved with os.splice and never copied into Python, otherwise it is received into a buffer that is shared by all tunnels and only copied when the destination can not take all of it at once. A source is not read again before its data has been sent, so a slow receiver slows down the sender. The thread is started when the first tunnel is added.
+    """
+    def __init__(self, buffer_size=65536):
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.selector = selectors.DefaultSelector()
+        self.wakeup, self.waker = socket.socketpair()
+        self.wakeup.setblocking(False)
+        self.waker.setblocking(False)
+        self.selector.register(self.wakeup, selectors.EVENT_READ)
+        self.added = deque()
+        self.tunnels = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def add(self, tunnel, client, server, finished=None):
+        """
+        This function hands the sockets of an established tunnel over to the relay thread and returns right away. Both sockets are closed when the tunnel is finished, after that finished is called with the tunnel in the relay thread.
+        """
+        client.setblocking(False)
+        server.setblocking(False)
+        upstream = Direction(client, server, True, tunnel.splice)
+        downstream = Direction(server, client, False, tunnel.splice)
+        with self.lock:
+            self.added.append((tunnel, upstream, downstream, finished))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="TunnelRelay", daemon=True)
+                self.thread.start()
+        self.wake()
+
+    def wake(self):
+        """
+        This function interrupts the selector of the relay thread.
+        """
+        try:
+            self.waker.send(b"\0")
+        except OSError:
+            pass
+
+    def run(self):
+        """
+        This function is the loop of the relay thread. Tunnels that have been idle for too long are closed about once a second.
+        """
+        checked = time.monotonic()
+        while True:
+            for key, events in self.selector.select(1.0):
+                if key.fileobj is self.wakeup:
+                    self.register()
+                    continue
+                tunnel, reading, writing = key.data
+                try:
+                    if events & selectors.EVENT_WRITE:
+                        self.flush(tunnel, writing)
+                    if events & selectors.EVENT_READ:
+                        self.receive(tunnel, reading)
+                except OSError:
+                    self.finish(tunnel)
+                    continue
+                self.update(tunnel)
+            now = time.monotonic()
+            if now - checked >= 1.0:
+                checked = now
+                for tunnel in [tunnel for tunnel in self.tunnels if tunnel.last_activity + tunnel.idle_timeout <= now]:
+                    self.finish(tunnel)
+
+    def register(self):
+        """
+        This function drains the wakeup socket and starts relaying the tunnels that have been added.
+        """
+        try:
+            while self.wakeup.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self.lock:
+            added = list(self.added)
+            self.added.clear()
+        for tunnel, upstream, downstream, finished in added:
+            tunnel.finished = finished
+            self.tunnels[tunnel] = (upstream, downstream)
+            self.selector.register(upstream.source, selectors.EVENT_READ, (tunnel, upstream, downstream))
+            self.selector.register(downstream.source, selectors.EVENT_READ, (tunnel, downstream, upstream))
+
+    def receive(self, tunnel, direction):
+        """
+        This function reads once from the source of a direction and sends as much of the data as the destination takes. When the source has closed its half of the connection, the destination is shut down for writing.
+        """
+        if direction.done or direction.blocked():
+            return
+        try:
+            if direction.pipe is None:
+                size = direction.source.recv_into(self.view[:tunnel.buffer_size])
+                direction.pending = self.view[:size]
+            else:
+                size = os.splice(direction.source.fileno(), direction.pipe[1], tunnel.buffer_size, flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+                direction.piped = size
+        except BlockingIOError:
+            return
+        if size == 0:
+            direction.done = True
+            direction.destination.shutdown(socket.SHUT_WR)
+            return
+        self.flush(tunnel, direction)
+        if direction.pending:
+            # The shared buffer is used by the next receive
+            direction.pending = memoryview(bytes(direction.pending))
+
+    def flush(self, tunnel, direction):
+        """
+        This function sends the data of a direction that is waiting for the destination, until it would block.
+        """
+        try:
+            while direction.pending:
+                sent = direction.destination.send(direction.pending)
+                direction.pending = direction.pending[sent:]
+                tunnel.count(sent, direction.upstream)
+            while direction.piped:
+                sent = os.splice(direction.pipe[0], direction.destination.fileno(), direction.piped, flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+                direction.piped -= sent
+                tunnel.count(sent, direction.upstream)
+        except BlockingIOError:
+            pass
+
+    def update(self, tunnel):
+        """
+        This function selects the events that the sockets of a tunnel wait for, or finishes the tunnel when both directions are done.
+        """
+        directions = self.tunnels.get(tunnel)
+        if directions is None:
+            return
+        upstream, downstream = directions
+        if upstream.done and downstream.done:
+            self.finish(tunnel)
+            return
+        for reading, writing in ((upstream, downstream), (downstream, upstream)):
+            events = 0
+            if not reading.done and not reading.blocked():
+                events |= selectors.EVENT_READ
+            if writing.blocked():
+                events |= selectors.EVENT_WRITE
+            registered = reading.source in self.selector.get_map()
+            if events and registered:
+                self.selector.modify(reading.source, events, (tunnel, reading, writing))
+            elif events:
+                self.selector.register(reading.source, events, (tunnel, reading, writing))
+            elif registered:
+                self.selector.unregister(reading.source)
+
+    def finish(self, tunnel):
+        """
+        This function closes the sockets of a tunnel and calls its finished function.
+        """
+        directions = self.tunnels.pop(tunnel, None)
+        if directions is None:
+            return
+        tunnel.closed = True
+        for direction in directions:
+            try:
+                self.selector.unregister(direction.source)
+            except KeyError:
+                pass
+            direction.source.close()
+            if direction.pipe is not None:
+                os.close(direction.pipe[0])
+                os.close(direction.pipe[1])
+        if tunnel.finished is not None:
+            try:
+                tunnel.finished(tunnel)
+            except Exception as error:
+                log.error("[TUNNEL] Could not finish a tunnel: %r", error)
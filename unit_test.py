@@ -1,8 +1,189 @@
 import unittest
+import asyncio
+import io
+import json
+import os
+import signal
+import socket
+import tempfile
+import threading
+import time
+import gzip
+import urllib.error
+import urllib.request
+from unittest import mock
 from request import Request
 from response import Response
 from timeparser import Time
-from proxy import Proxy
+from proxy import Proxy, send_buffers
+from asyncproxy import AsyncProxy
+from socketreader import SocketReader, body_framing
+from connectionpool import ConnectionPool
+from rewriter import Rewriter
+from cache import Cache, freshness_lifetime
+from diskcache import DiskCache
+from singleflight import SingleFlight
+from httpparser import Headers, find_head_end
+from supervisor import Supervisor
+from workerpool import WorkerPool
+from metrics import Metrics, Histogram
+from logger import Logger, log, INFO, WARNING
+from rules import Rule, RuleSet, literal_prefix, request_path
+from encoding import compress, decompress, negotiate, compressible
+from resolver import Resolver, ResolverEntry, interleave, split_host
+from tunnel import Tunnel, TunnelRelay, SPLICE
+from tracing import Hooks, Tracer, SamplingProfiler, HOOK_POINTS
+from benchmark import Origin, fetch, percentile, run_micro, benchmark_load, compare
+
+def start_origin(response, connections=1):
+    """
+    Start a local server that answers every connection with the same response and then closes it. Returns the port and a list with the received requests.
+    """
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(connections)
+    received = []
+
+    def serve():
+        for _ in range(connections):
+            connection, _ = server.accept()
+            received.append(connection.recv(65536))
+            connection.sendall(response)
+            connection.close()
+        server.close()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return server.getsockname()[1], received
+
+def start_keep_alive_origin(response):
+    """
+    Start a local server that keeps connections open and answers every request on them with the same response. Returns the port and a list with the number of requests received on each connection.
+    """
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(10)
+    connections = []
+
+    def handle(connection, index):
+        reader = SocketReader(connection)
+        while reader.read_head():
+            connections[index] += 1
+            connection.sendall(response)
+        connection.close()
+
+    def serve():
+        while True:
+            connection, _ = server.accept()
+            connections.append(0)
+            threading.Thread(target=handle, args=(connection, len(connections) - 1), daemon=True).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return server.getsockname()[1], connections
+
+def start_scripted_origin(responses, delay=0):
+    """
+    Start a local server that keeps connections open and answers the requests with the responses in the given order, after waiting delay seconds. Returns the port and a list with the received request heads.
+    """
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(10)
+    received = []
+
+    def handle(connection):
+        reader = SocketReader(connection)
+        head = reader.read_head()
+        while head:
+            received.append(head)
+            threading.Event().wait(delay)
+            connection.sendall(responses[min(len(received), len(responses)) - 1])
+            head = reader.read_head()
+        connection.close()
+
+    def serve():
+        while True:
+            connection, _ = server.accept()
+            threading.Thread(target=handle, args=(connection,), daemon=True).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return server.getsockname()[1], received
+
+def start_echo_server():
+    """
+    Start a local server that sends back everything it receives on a connection and closes it when the client has closed its half. Returns the port.
+    """
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+
+    def serve():
+        connection, _ = server.accept()
+        data = connection.recv(65536)
+        while data:
+            connection.sendall(data)
+            data = connection.recv(65536)
+        connection.close()
+        server.close()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return server.getsockname()[1]
+
+def start_upload_origin(connections=1):
+    """
+    Start a local server that reads the complete request body on every connection and answers with its size. Returns the port and a list with the received heads and bodies.
+    """
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(connections)
+    received = []
+
+    def serve():
+        for _ in range(connections):
+            connection, _ = server.accept()
+            reader = SocketReader(connection)
+            head = reader.read_head()
+            request = Request(head)
+            try:
+                body = b"".join(bytes(data) for data in reader.iter_body(*body_framing(request.headers, request.method)))
+            except ConnectionError:
+                # The proxy stopped sending the body
+                connection.close()
+                continue
+            received.append((head, body))
+            connection.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\nConnection: close\r\n\r\n%d" % (len(str(len(body))), len(body)))
+            connection.close()
+        server.close()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return server.getsockname()[1], received
+
+def handle_client(proxy, data):
+    """
+    Let the proxy handle a client connection that sends the data, and return all responses read from the connection.
+    """
+    client, server = socket.socketpair()
+    thread = threading.Thread(target=proxy.handle_request, args=(server, ("127.0.0.1", 0)))
+    thread.start()
+    client.sendall(data)
+    client.shutdown(socket.SHUT_WR)
+    reader = SocketReader(client)
+    responses = []
+    head = reader.read_head()
+    while head:
+        response = Response(head)
+        response.body = b"".join(bytes(data) for data in reader.iter_body(*body_framing(response.headers, "GET", response.status_code)))
+        responses.append(response)
+        head = reader.read_head()
+    thread.join(5)
+    client.close()
+    return responses
+
+def local_proxy(proxy_class, origin_port):
+    """
+    Create a proxy on a free local port that sends all requests to the local origin.
+    """
+    proxy = proxy_class("127.0.0.1", 0, 10)
+    proxy.upstream_address = lambda request: ("127.0.0.1", origin_port)
+    return proxy
 
 class TestRequestMethods(unittest.TestCase):
 
@@ -92,6 +273,7 @@ class TestResponseMethods(unittest.TestCase):
 
         response3 = Response(b"bad data")
         self.assertEqual(response3.valid, False)
+        self.assertEqual(Response(b"HTTP/1.1 OK\r\n\r\n").valid, False)
 
         
 
@@ -119,6 +301,185 @@ class TestResponseMethods(unittest.TestCase):
         response1.manipulate(manipulations2, connection_id)
         self.assertEqual(response1.body, b"new sentence")
 
+    def test_manipulate_chunked(self):
+        """
+        Test that chunked bodies are decoded before they are manipulated.
+        """
+        response1 = Response(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n4\r\nThis\r\na\r\n is smiley\r\n0\r\n\r\n")
+        response1.manipulate({b"smiley": b"trolly"}, 1)
+        self.assertEqual(response1.body, b"This is trolly")
+        self.assertEqual(response1.headers["Content-Length"], " 14")
+        self.assertNotIn("Transfer-Encoding", response1.headers)
+
+class TestParserMethods(unittest.TestCase):
+
+    def test_headers(self):
+        """
+        Test that header names are case-insensitive and that headers with several values are kept.
+        """
+        response1 = Response(b"HTTP/1.1 200 OK\r\ncontent-length: 5\r\nSet-Cookie: a=1\r\nSet-Cookie: b=2\r\n\r\nHello")
+        self.assertEqual(response1.headers["Content-Length"], " 5")
+        self.assertIn("CONTENT-LENGTH", response1.headers)
+        self.assertEqual(response1.headers.get_all("set-cookie"), [" a=1", " b=2"])
+        self.assertEqual(response1.encode(), b"HTTP/1.1 200 OK\r\ncontent-length: 5\r\nSet-Cookie: a=1\r\nSet-Cookie: b=2\r\n\r\nHello")
+        response1.headers["Content-Length"] = " 6"
+        self.assertEqual(list(response1.headers), ["Content-Length", "Set-Cookie"])
+        del response1.headers["set-cookie"]
+        self.assertEqual(response1.headers, {"Content-Length": " 6"})
+
+        headers = Headers([("Host", " a")])
+        copy = headers.copy()
+        copy["Host"] = " b"
+        self.assertEqual(headers["host"], " a")
+
+    def test_request_body(self):
+        """
+        Test that the body of a request is kept after the headers.
+        """
+        request1 = Request(b"POST http://google.com/ HTTP/1.1\r\nContent-Length: 4\r\n\r\nbody")
+        self.assertEqual(request1.body, b"body")
+        self.assertEqual(request1.encode(), b"POST http://google.com/ HTTP/1.1\r\nContent-Length: 4\r\n\r\nbody")
+
+    def test_incremental(self):
+        """
+        Test that a header block that arrives in several parts is found, also when the empty line is split between the parts, and that the data after it is kept for the body.
+        """
+        data = b"GET http://google.com/ HTTP/1.1\r\nHost: google.com\r\n\r\nrest"
+        buffer = bytearray()
+        ends = []
+        for index in range(len(data)):
+            start = len(buffer)
+            buffer += data[index:index + 1]
+            ends.append(find_head_end(buffer, start))
+        self.assertEqual(ends.index(len(data) - 4), len(data) - 5)
+        self.assertEqual(find_head_end(memoryview(data)), len(data) - 4)
+
+        client, server = socket.socketpair()
+        reader = SocketReader(server)
+
+        def send():
+            for part in (data[:20], data[20:49], data[49:51], data[51:]):
+                client.sendall(part)
+                time.sleep(0.01)
+
+        thread = threading.Thread(target=send)
+        thread.start()
+        self.assertEqual(reader.read_head(), data[:-4])
+        thread.join(5)
+        self.assertEqual(bytes(reader.buffer), b"rest")
+        client.sendall(b"x" * 20)
+        self.assertRaises(ValueError, reader.read_head, 16)
+        client.close()
+        server.close()
+
+class TestRewriterMethods(unittest.TestCase):
+
+    def test_sub(self):
+        """
+        Test that all replacements are applied in a single pass.
+        """
+        rewriter = Rewriter({b"smiley": b"trolly", b"trolly": b"smiley", b"(?<=[\\s])Alice": b"Bob", b"(\\d+) kr": b"\\1 SEK"})
+        self.assertEqual(rewriter.sub(b"smiley trolly Alice xAlice 100 kr"), b"trolly smiley Bob xAlice 100 SEK")
+
+    def test_backreference(self):
+        """
+        Test that patterns with backreferences are applied one after another.
+        """
+        rewriter = Rewriter({b"(a)\\1": b"b", b"bb": b"c"})
+        self.assertIsNone(rewriter.combined)
+        self.assertEqual(rewriter.sub(b"aaaa"), b"c")
+        stream = rewriter.stream()
+        self.assertEqual(stream.feed(b"aa") + stream.feed(b"aa", True), b"c")
+
+    def test_feed(self):
+        """
+        Test that matches across chunk borders are found when a body is rewritten in chunks.
+        """
+        body = b"Alice met Alice and " * 500
+        for size in (1, 7, 100, 4096):
+            rewriter = Rewriter({b"(?<= )Alice": b"Trolly", b"met": b"saw"}, 64).stream()
+            output = b"".join(rewriter.feed(body[index:index + size]) for index in range(0, len(body), size))
+            output += rewriter.feed(b"", True)
+            self.assertEqual(output, Rewriter({b"(?<= )Alice": b"Trolly", b"met": b"saw"}).sub(body))
+
+    def test_feed_empty_match(self):
+        """
+        Test that patterns that can match the empty string give the same output when a body is rewritten in chunks.
+        """
+        body = b"axxbxa bb xxx" * 50
+        for replacements in ({b"x*": b"-"}, {b"x*": b"-", b"a": b"A"}, {b"ab": b"-", b"b*": b"+"}):
+            for size in (1, 3, 10):
+                rewriter = Rewriter(replacements, 8).stream()
+                output = b"".join(rewriter.feed(body[index:index + size]) for index in range(0, len(body), size))
+                output += rewriter.feed(b"", True)
+                self.assertEqual(output, Rewriter(replacements).sub(body))
+
+class TestRuleMethods(unittest.TestCase):
+    def test_index(self):
+        """
+        Test that rules are only applied to their host and path.
+        """
+        rules = RuleSet([
+            Rule("smiley", "trolly", host="smiley.com"),
+            Rule("smiley", "happy", host="*.example.com"),
+            Rule("images", "pictures", path="/images/"),
+        ])
+        self.assertEqual(rules.apply("GET http://smiley.com/smiley HTTP/1.1", "smiley.com", "/smiley"), ("GET http://trolly.com/trolly HTTP/1.1", True))
+        self.assertEqual(rules.apply("GET http://www.example.com/smiley HTTP/1.1", "www.example.com:80", "/smiley")[0], "GET http://www.example.com/happy HTTP/1.1")
+        self.assertEqual(rules.apply("GET http://other.com/smiley HTTP/1.1", "other.com", "/smiley"), ("GET http://other.com/smiley HTTP/1.1", False))
+        self.assertEqual(rules.apply("GET http://other.com/images/ HTTP/1.1", "other.com", "/images/")[0], "GET http://other.com/pictures/ HTTP/1.1")
+        self.assertEqual(rules.apply("GET http://other.com/images HTTP/1.1", "other.com", "/images")[1], False)
+
+    def test_order(self):
+        """
+        Test that rules are applied by priority and that first_match stops after the first rule that changes the line.
+        """
+        rules = [Rule("a", "b"), Rule("b", "c"), Rule("c", "d", priority=-1)]
+        self.assertEqual(RuleSet(rules).apply("a c", "", "/")[0], "c d")
+        self.assertEqual(RuleSet(rules, first_match=True).apply("a c", "", "/")[0], "a d")
+        self.assertEqual(RuleSet(rules, first_match=True).apply("a", "", "/")[0], "b")
+
+    def test_literal_prefix(self):
+        """
+        Test that the literal prefix of a pattern only contains text that every match must contain.
+        """
+        self.assertEqual(literal_prefix("smiley.jpg"), "smiley")
+        self.assertEqual(literal_prefix("smileys?"), "smiley")
+        self.assertEqual(literal_prefix("smiley|trolly"), "")
+        self.assertEqual(literal_prefix("(?<= ).*jpg"), "")
+        self.assertEqual(request_path("http://smiley.com/images/a.jpg"), "/images/a.jpg")
+        self.assertEqual(request_path("http://smiley.com"), "/")
+
+    def test_reload(self):
+        """
+        Test that the proxy loads request rules from a file and loads them again when the file changes.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "rules.json")
+
+            def write(content, modified):
+                with open(path, "w") as file:
+                    file.write(content)
+                os.utime(path, ns=(modified, modified))
+
+            write(json.dumps({"rules": [{"match": "smiley", "replacement": "trolly", "host": "smiley.com"}]}), 1000000000)
+            proxy = Proxy("127.0.0.1", 0, 10)
+            rules = proxy.load_request_rules(path, interval=0)
+            proxy.add_request_replacement("trolly", "happy")
+            request = proxy.manipulate_request(Request(b"GET http://smiley.com/smiley.jpg HTTP/1.1\r\n\r\n"), 1)
+            self.assertEqual(request.line, "GET http://happy.com/happy.jpg HTTP/1.1")
+            self.assertEqual(request.host, "happy.com")
+
+            write(json.dumps({"rules": [{"match": "smiley", "replacement": "sad"}]}), 2000000000)
+            request = proxy.manipulate_request(Request(b"GET http://smiley.com/smiley.jpg HTTP/1.1\r\n\r\n"), 1)
+            self.assertEqual(request.line, "GET http://sad.com/sad.jpg HTTP/1.1")
+            self.assertEqual(rules.reloads, 1)
+
+            write("{incorrect", 3000000000)
+            request = proxy.manipulate_request(Request(b"GET http://smiley.com/smiley.jpg HTTP/1.1\r\n\r\n"), 1)
+            self.assertEqual(request.line, "GET http://sad.com/sad.jpg HTTP/1.1")
+            self.assertEqual(rules.reloads, 1)
+
 class TestTimeMethods(unittest.TestCase):
     
     def test_constructor(self):
@@ -179,7 +540,7 @@ class TestProxyMethods(unittest.TestCase):
         self.assertEqual(proxy.host, "127.0.0.1")
         self.assertEqual(proxy.port, 1234)
         self.assertEqual(proxy.max_queue, 10)
-        self.assertEqual(proxy.cache, {})
+        self.assertEqual(len(proxy.cache), 0)
         self.assertEqual(proxy.keep_alive, True)
         self.assertEqual(proxy.use_cache, False)
         self.assertEqual(proxy.request_replacements, {})
@@ -225,6 +586,27 @@ class TestProxyMethods(unittest.TestCase):
         response1 = proxy.manipulate_response(response1, 1)
         self.assertEqual(response1.body, b"This is Trolly")
 
+    def test_manipulate_without_body(self):
+        """
+        Test that the Content-Length of responses without a body is kept, for HEAD requests and 304 responses, with and without replacements.
+        """
+        port, _ = start_keep_alive_origin(b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nContent-Length: 1234\r\n\r\n")
+        proxy = local_proxy(Proxy, port)
+
+        def head():
+            client, server = socket.socketpair()
+            with client:
+                client.sendall(b"HEAD http://smiley.com/ HTTP/1.1\r\nConnection: close\r\n\r\n")
+                proxy.handle_request(server, ("127.0.0.1", 0))
+                return Response(SocketReader(client).read_head())
+
+        self.assertEqual(head().headers["Content-Length"], " 1234")
+        proxy.add_response_replacement("Smiley", "Trolly")
+        self.assertEqual(head().headers["Content-Length"], " 1234")
+        not_modified = Response(b"HTTP/1.1 304 Not Modified\r\nContent-Type: text/html\r\nContent-Length: 1234\r\n\r\n")
+        not_modified.manipulate({b"Smiley": b"Trolly"}, 1)
+        self.assertEqual(not_modified.headers["Content-Length"], " 1234")
+
     def test_cache(self):
         """
         Test that the proxy can cache responses.
@@ -245,6 +627,1789 @@ class TestProxyMethods(unittest.TestCase):
         
         
 
+class TestSocketReaderMethods(unittest.TestCase):
+
+    def reader(self, data):
+        """
+        Create a reader for a socket that has received the data and then been closed.
+        """
+        server, client = socket.socketpair()
+        server.sendall(data)
+        server.close()
+        return SocketReader(client, 16)
+
+    def test_read_head(self):
+        """
+        Test that the header block is read until the empty line and that the rest is kept in the buffer.
+        """
+        reader = self.reader(b"HTTP/1.1 200 OK\r\nContent-Length: 4\r\n\r\nbodyHTTP/1.1 204 No Content\r\n\r\n")
+        self.assertEqual(reader.read_head(), b"HTTP/1.1 200 OK\r\nContent-Length: 4\r\n\r\n")
+        self.assertEqual(b"".join(bytes(data) for data in reader.iter_body("length", 4)), b"body")
+        self.assertEqual(reader.read_head(), b"HTTP/1.1 204 No Content\r\n\r\n")
+        self.assertEqual(reader.read_head(), b"")
+
+    def test_chunked(self):
+        """
+        Test that chunked bodies are decoded.
+        """
+        reader = self.reader(b"5\r\nHello\r\n15;ext=1\r\n, this is a long body\r\n0\r\nTrailer: value\r\n\r\nnext")
+        self.assertEqual(b"".join(bytes(data) for data in reader.iter_body("chunked")), b"Hello, this is a long body")
+        self.assertEqual(bytes(reader.buffer), b"next")
+
+    def test_body_framing(self):
+        """
+        Test that the end of a body is found from the headers.
+        """
+        self.assertEqual(body_framing({"Content-Length": " 10"}, "GET", "200"), ("length", 10))
+        self.assertEqual(body_framing({"Transfer-Encoding": " chunked"}, "GET", "200"), ("chunked", None))
+        self.assertEqual(body_framing({"Content-Length": " 10"}, "HEAD", "200"), ("none", 0))
+        self.assertEqual(body_framing({}, "GET", "304"), ("none", 0))
+        self.assertEqual(body_framing({}, "GET", "200"), ("close", None))
+        self.assertEqual(body_framing({}, "GET"), ("none", 0))
+
+class TestConnectionPoolMethods(unittest.TestCase):
+
+    def test_reuse(self):
+        """
+        Test that the proxy reuses the connection to the server for several requests.
+        """
+        port, connections = start_keep_alive_origin(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n5\r\nHello\r\n0\r\n\r\n")
+        proxy = local_proxy(Proxy, port)
+        for _ in range(3):
+            request = proxy.manipulate_request(Request(b"GET http://smiley.com/ HTTP/1.1\r\n\r\n"), 1)
+            response = proxy.send_request(request, 1)
+            self.assertEqual(response.body, b"Hello")
+            self.assertEqual(response.headers["Content-Length"], " 5")
+            self.assertNotIn("Transfer-Encoding", response.headers)
+        self.assertEqual(connections, [3])
+        self.assertEqual(proxy.pool.created, 1)
+        self.assertEqual(proxy.pool.reused, 2)
+
+    def test_no_reuse_when_closed(self):
+        """
+        Test that connections are not reused when keep_alive is turned off.
+        """
+        port, connections = start_keep_alive_origin(b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n")
+        proxy = local_proxy(Proxy, port)
+        proxy.keep_alive = False
+        for _ in range(2):
+            proxy.send_request(proxy.manipulate_request(Request(b"GET http://smiley.com/ HTTP/1.1\r\n\r\n"), 1), 1)
+        self.assertEqual(proxy.pool.created, 2)
+
+    def test_health_check(self):
+        """
+        Test that idle connections closed by the server or idle for too long are not reused.
+        """
+        pool = ConnectionPool(max_size=2, idle_timeout=30)
+        port, _ = start_keep_alive_origin(b"")
+        connection = pool.acquire(("127.0.0.1", port))
+        self.assertTrue(pool.healthy(connection))
+        connection.last_used -= 60
+        self.assertFalse(pool.healthy(connection))
+
+        server, client = socket.socketpair()
+        connection.sock = client
+        connection.last_used += 60
+        server.close()
+        self.assertFalse(pool.healthy(connection))
+
+    def test_sweep(self):
+        """
+        Test that idle connections of all hosts are closed after idle_timeout, that hosts without idle connections are forgotten and that at most max_idle connections are kept.
+        """
+        pool = ConnectionPool(max_size=2, idle_timeout=30, max_idle=3)
+        ports = [start_keep_alive_origin(b"")[0] for _ in range(4)]
+        connections = [pool.acquire(("127.0.0.1", port)) for port in ports]
+        for connection in connections:
+            pool.release(connection)
+        # The connection that was idle longest was closed for the fourth one
+        self.assertEqual(pool.idle, 3)
+        self.assertNotIn(("127.0.0.1", ports[0]), pool.connections)
+        self.assertEqual(connections[0].sock.fileno(), -1)
+
+        connections[1].last_used -= 60
+        pool.sweep(True)
+        self.assertEqual(pool.idle, 2)
+        self.assertNotIn(("127.0.0.1", ports[1]), pool.connections)
+        self.assertEqual(connections[1].sock.fileno(), -1)
+
+        self.assertIs(pool.acquire(("127.0.0.1", ports[2])), connections[2])
+        self.assertNotIn(("127.0.0.1", ports[2]), pool.connections)
+        self.assertEqual(pool.idle, 1)
+
+    def test_truncated_body(self):
+        """
+        Test that responses whose body ends early are neither cached nor passed on.
+        """
+        for head in (b"HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nContent-Length: 100\r\n\r\nshort", b"HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nTransfer-Encoding: chunked\r\n\r\n"):
+            port, _ = start_origin(head)
+            proxy = local_proxy(Proxy, port)
+            proxy.use_cache = True
+            response = proxy.send_request(Request(b"GET http://smiley.com/ HTTP/1.1\r\nHost: smiley.com\r\n\r\n"), 1)
+            self.assertFalse(response.valid)
+            self.assertEqual(len(proxy.cache), 0)
+
+class TestCacheMethods(unittest.TestCase):
+
+    def test_eviction(self):
+        """
+        Test that the least recently used responses are evicted when the cache is full.
+        """
+        cache = Cache(max_size=300, max_entry_size=200)
+        for url in ("a", "b", "c"):
+            cache.store(Request(b"GET http://" + url.encode() + b"/ HTTP/1.1\r\n\r\n"), Response(b"HTTP/1.1 200 OK\r\n\r\n" + b"x" * 100))
+            cache.lookup(Request(b"GET http://a/ HTTP/1.1\r\n\r\n"))
+        self.assertIn("http://a/", cache)
+        self.assertNotIn("http://b/", cache)
+        self.assertIn("http://c/", cache)
+        self.assertEqual(cache.evictions, 1)
+        self.assertLessEqual(cache.size, 300)
+        self.assertFalse(cache.store(Request(b"GET http://d/ HTTP/1.1\r\n\r\n"), Response(b"HTTP/1.1 200 OK\r\n\r\n" + b"x" * 300)))
+
+    def test_cacheable(self):
+        """
+        Test that responses with no-store or private are not stored.
+        """
+        cache = Cache()
+        request = Request(b"GET http://a/ HTTP/1.1\r\n\r\n")
+        self.assertTrue(cache.cacheable(request, Response(b"HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\n\r\n")))
+        self.assertFalse(cache.cacheable(request, Response(b"HTTP/1.1 200 OK\r\nCache-Control: private, max-age=60\r\n\r\n")))
+        self.assertFalse(cache.cacheable(request, Response(b"HTTP/1.1 200 OK\r\nCache-Control: no-store\r\n\r\n")))
+        self.assertFalse(cache.cacheable(request, Response(b"HTTP/1.1 500 Internal Server Error\r\n\r\n")))
+        self.assertFalse(cache.cacheable(Request(b"GET http://a/ HTTP/1.1\r\nAuthorization: secret\r\n\r\n"), Response(b"HTTP/1.1 200 OK\r\n\r\n")))
+
+    def test_freshness(self):
+        """
+        Test that the time a response is fresh is read from Cache-Control or Expires.
+        """
+        self.assertEqual(freshness_lifetime(Response(b"HTTP/1.1 200 OK\r\nCache-Control: public, max-age=60\r\n\r\n")), 60)
+        self.assertEqual(freshness_lifetime(Response(b"HTTP/1.1 200 OK\r\nCache-Control: max-age=60, s-maxage=10\r\n\r\n")), 10)
+        self.assertEqual(freshness_lifetime(Response(b"HTTP/1.1 200 OK\r\nDate: Fri, 15 Jan 2021 11:35:43 GMT\r\nExpires: Fri, 15 Jan 2021 12:35:43 GMT\r\n\r\n")), 3600)
+        self.assertEqual(freshness_lifetime(Response(b"HTTP/1.1 200 OK\r\nCache-Control: no-cache, max-age=60\r\n\r\n")), 0)
+        self.assertEqual(freshness_lifetime(Response(b"HTTP/1.1 200 OK\r\n\r\n")), 0)
+
+    def test_vary(self):
+        """
+        Test that responses with a Vary header are stored separately for every value of the request header.
+        """
+        proxy = Proxy("127.0.0.1", 0, 10)
+        english = Request(b"GET http://a/ HTTP/1.1\r\nAccept-Language: en\r\n\r\n")
+        swedish = Request(b"GET http://a/ HTTP/1.1\r\nAccept-Language: sv\r\n\r\n")
+        proxy.cache.store(english, Response(b"HTTP/1.1 200 OK\r\nVary: Accept-Language\r\nCache-Control: max-age=60\r\n\r\nHello"))
+        self.assertEqual(proxy.query_cache(english, 1).body, b"Hello")
+        self.assertFalse(proxy.query_cache(swedish, 1))
+        self.assertEqual((proxy.cache.hits, proxy.cache.misses), (1, 1))
+
+    def test_vary_bounded(self):
+        """
+        Test that the Vary names of a url are counted in the size and removed with the last entry of the url, when it is evicted or removed.
+        """
+        cache = Cache(max_size=2000, max_entry_size=200)
+        for index in range(100):
+            request = Request(f"GET http://host/{index} HTTP/1.1\r\nAccept-Language: en\r\n\r\n".encode())
+            cache.store(request, Response(b"HTTP/1.1 200 OK\r\nVary: Accept-Language\r\n\r\n" + b"x" * 100))
+        self.assertEqual(len(cache.vary), len(cache))
+        self.assertLess(len(cache), 100)
+        self.assertEqual(cache.size, sum(entry.size for entry in cache.entries.values()) + sum(len(url) + len("Accept-Language") for url in cache.vary))
+        # A compressed variant shares the Vary names of its url
+        key = next(reversed(cache.entries))
+        cache.insert(key + ("gzip",), Response(b"HTTP/1.1 200 OK\r\n\r\nzip"))
+        self.assertEqual(cache.vary[key[0]], [("Accept-Language",), 2])
+        for key in list(cache.entries):
+            cache.remove(key)
+        self.assertEqual((cache.vary, cache.size), ({}, 0))
+
+class TestWireCacheMethods(unittest.TestCase):
+
+    def test_freeze(self):
+        """
+        Test that frozen responses are sent with their encoded heads and are not changed by sending them.
+        """
+        response = Response(b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nHello").freeze()
+        self.assertEqual(response.wire[True], b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\nConnection: keep-alive\r\n\r\n")
+        self.assertEqual(response.wire[False], b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\nConnection: close\r\n\r\n")
+        client, server = socket.socketpair()
+        proxy = Proxy("127.0.0.1", 0, 10)
+        self.assertTrue(proxy.send_response(server, response, True))
+        self.assertFalse(proxy.send_response(server, response, False))
+        server.close()
+        data = b""
+        while True:
+            received = client.recv(65536)
+            if not received:
+                break
+            data += received
+        client.close()
+        self.assertEqual(data, response.wire[True] + b"Hello" + response.wire[False] + b"Hello")
+        proxy.stop()
+
+    def test_send_buffers(self):
+        """
+        Test that large buffers are sent completely, also when sendmsg only sends a part of them.
+        """
+        client, server = socket.socketpair()
+        thread = threading.Thread(target=send_buffers, args=(server, (b"a" * 10, memoryview(b"b" * 1000000), b"", b"c")))
+        thread.start()
+        data = b""
+        while len(data) < 1000011:
+            data += client.recv(65536)
+        thread.join(5)
+        self.assertEqual(data, b"a" * 10 + b"b" * 1000000 + b"c")
+        client.close()
+        server.close()
+
+    def test_fingerprint(self):
+        """
+        Test that the cache stores responses after they are manipulated, and that they are not used anymore when the response replacements change.
+        """
+        port, connections = start_keep_alive_origin(b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nCache-Control: max-age=60\r\nContent-Length: 11\r\n\r\nHello World")
+        proxy = local_proxy(Proxy, port)
+        proxy.use_cache = True
+        proxy.add_response_replacement("Hello", "Bye")
+        request = b"GET http://smiley.com/ HTTP/1.1\r\n\r\n"
+        responses = handle_client(proxy, request * 2)
+        self.assertEqual([response.body for response in responses], [b"Bye World"] * 2)
+        self.assertEqual(proxy.cache["http://smiley.com/"].body, b"Bye World")
+        self.assertEqual(sum(connections), 1)
+
+        proxy.add_response_replacement("World", "Moon")
+        responses = handle_client(proxy, request)
+        self.assertEqual(responses[0].body, b"Bye Moon")
+        self.assertEqual(sum(connections), 2)
+
+    def test_request_rules_fingerprint(self):
+        """
+        Test that cached responses are not used anymore when the request rules change, since the request may be sent to another URL.
+        """
+        port, connections = start_keep_alive_origin(b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nCache-Control: max-age=60\r\nContent-Length: 11\r\n\r\nHello World")
+        proxy = local_proxy(Proxy, port)
+        proxy.use_cache = True
+        request = b"GET http://smiley.com/ HTTP/1.1\r\n\r\n"
+        handle_client(proxy, request * 2)
+        self.assertEqual(sum(connections), 1)
+        self.assertEqual(proxy.cache.fingerprint, "")
+
+        proxy.add_request_replacement("/ HTTP", "/new HTTP")
+        handle_client(proxy, request * 2)
+        self.assertEqual(sum(connections), 2)
+        fingerprint = proxy.cache.fingerprint
+        proxy.add_request_replacement("/ HTTP", "/other HTTP")
+        handle_client(proxy, request)
+        self.assertEqual(sum(connections), 3)
+        self.assertNotEqual(proxy.cache.fingerprint, fingerprint)
+
+class TestRevalidationMethods(unittest.TestCase):
+
+    def cached_proxy(self, responses, cache_control, proxy_class=Proxy):
+        """
+        Create a proxy with a stale response in the cache and an origin that answers with the responses.
+        """
+        port, received = start_scripted_origin(responses)
+        proxy = local_proxy(proxy_class, port)
+        proxy.use_cache = True
+        request = Request(b"GET http://smiley.com/ HTTP/1.1\r\n\r\n")
+        cached = Response(b"HTTP/1.1 200 OK\r\nETag: \"v1\"\r\nLast-Modified: Fri, 15 Jan 2021 11:35:43 GMT\r\nCache-Control: " + cache_control + b"\r\nContent-Length: 5\r\n\r\nHello")
+        proxy.cache.store(request, cached)
+        proxy.cache.lookup(request).expires -= 10
+        return proxy, received
+
+    def test_not_modified(self):
+        """
+        Test that a stale response is revalidated with a conditional request and refreshed when the server answers 304.
+        """
+        proxy, received = self.cached_proxy([b"HTTP/1.1 304 Not Modified\r\nCache-Control: max-age=60\r\n\r\n"], b"max-age=0")
+        responses = handle_client(proxy, b"GET http://smiley.com/ HTTP/1.1\r\n\r\n" * 2)
+        self.assertEqual([response.body for response in responses], [b"Hello"] * 2)
+        self.assertEqual(len(received), 1)
+        self.assertIn(b'If-None-Match: "v1"', received[0])
+        self.assertIn(b"If-Modified-Since: Fri, 15 Jan 2021 11:35:43 GMT", received[0])
+        self.assertTrue(proxy.cache.lookup(Request(b"GET http://smiley.com/ HTTP/1.1\r\n\r\n")).fresh())
+
+    def test_modified(self):
+        """
+        Test that a new response from the server replaces the stale response.
+        """
+        proxy, received = self.cached_proxy([b"HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nContent-Length: 3\r\n\r\nNew"], b"max-age=0")
+        responses = handle_client(proxy, b"GET http://smiley.com/ HTTP/1.1\r\n\r\n" * 2)
+        self.assertEqual([response.body for response in responses], [b"New"] * 2)
+        self.assertEqual(len(received), 1)
+
+    def test_stale_while_revalidate(self):
+        """
+        Test that a stale response within stale-while-revalidate is returned directly and revalidated in the background.
+        """
+        proxy, received = self.cached_proxy([b"HTTP/1.1 304 Not Modified\r\nCache-Control: max-age=60\r\n\r\n"], b"max-age=0, stale-while-revalidate=60")
+        request = Request(b"GET http://smiley.com/ HTTP/1.1\r\n\r\n")
+        self.assertEqual(proxy.query_cache(request, 1).body, b"Hello")
+        for _ in range(100):
+            if proxy.cache.lookup(request).fresh():
+                break
+            threading.Event().wait(0.01)
+        self.assertTrue(proxy.cache.lookup(request).fresh())
+        self.assertEqual(len(received), 1)
+
+    def test_stale_if_error(self):
+        """
+        Test that a stale response within stale-if-error is returned when the server answers with an error.
+        """
+        proxy, _ = self.cached_proxy([b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\n\r\n"], b"max-age=0, stale-if-error=60")
+        self.assertEqual(handle_client(proxy, b"GET http://smiley.com/ HTTP/1.1\r\n\r\n")[0].body, b"Hello")
+
+        proxy, _ = self.cached_proxy([b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\n\r\n"], b"max-age=0")
+        self.assertEqual(handle_client(proxy, b"GET http://smiley.com/ HTTP/1.1\r\n\r\n")[0].status_code, "503")
+
+    def test_async(self):
+        """
+        Test that the async proxy revalidates stale responses, in the background within stale-while-revalidate, and returns them when the server fails within stale-if-error.
+        """
+        request = Request(b"GET http://smiley.com/ HTTP/1.1\r\n\r\n")
+
+        def run(proxy, count):
+            async def clients():
+                server = asyncio.create_task(proxy.serve())
+                reader, writer = await asyncio.open_connection(*proxy.server.getsockname())
+                bodies = []
+                for _ in range(count):
+                    writer.write(b"GET http://smiley.com/ HTTP/1.1\r\n\r\n")
+                    response = Response(await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5))
+                    bodies.append(await reader.readexactly(int(response.headers["Content-Length"])))
+                for _ in range(100):
+                    if proxy.cache.lookup(request).fresh():
+                        break
+                    await asyncio.sleep(0.01)
+                writer.close()
+                server.cancel()
+                return bodies
+            return asyncio.run(clients())
+
+        proxy, received = self.cached_proxy([b"HTTP/1.1 304 Not Modified\r\nCache-Control: max-age=60\r\n\r\n"], b"max-age=0", AsyncProxy)
+        self.assertEqual(run(proxy, 2), [b"Hello"] * 2)
+        self.assertEqual(len(received), 1)
+        self.assertIn(b'If-None-Match: "v1"', received[0])
+
+        proxy, received = self.cached_proxy([b"HTTP/1.1 304 Not Modified\r\nCache-Control: max-age=60\r\n\r\n"], b"max-age=0, stale-while-revalidate=60", AsyncProxy)
+        self.assertEqual(run(proxy, 3), [b"Hello"] * 3)
+        self.assertTrue(proxy.cache.lookup(request).fresh())
+        self.assertEqual(len(received), 1)
+
+        proxy, _ = self.cached_proxy([b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\n\r\n"], b"max-age=0, stale-if-error=60", AsyncProxy)
+        self.assertEqual(run(proxy, 1), [b"Hello"])
+
+class TestCoalescingMethods(unittest.TestCase):
+
+    def concurrent(self, proxy, clients):
+        """
+        Send the same request from several clients at the same time and return the responses.
+        """
+        responses = [None] * clients
+
+        def client(index):
+            responses[index] = handle_client(proxy, b"GET http://smiley.com/ HTTP/1.1\r\n\r\n")[0]
+
+        threads = [threading.Thread(target=client, args=(index,)) for index in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        return responses
+
+    def test_coalesce(self):
+        """
+        Test that concurrent requests for the same page only cause one request to the server.
+        """
+        port, received = start_scripted_origin([b"HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nContent-Type: text/html\r\nContent-Length: 6\r\n\r\nSmiley"], 0.3)
+        proxy = local_proxy(Proxy, port)
+        proxy.use_cache = True
+        proxy.add_response_replacement("Smiley", "Trolly")
+        responses = self.concurrent(proxy, 5)
+        self.assertEqual([response.body for response in responses], [b"Trolly"] * 5)
+        self.assertEqual(len(received), 1)
+        self.assertEqual(proxy.flights.collapsed, 4)
+
+    def test_coalesce_async(self):
+        """
+        Test that the async proxy coalesces concurrent requests for the same page without blocking the event loop.
+        """
+        port, received = start_scripted_origin([b"HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nContent-Length: 6\r\n\r\nSmiley"], 0.3)
+        proxy = local_proxy(AsyncProxy, port)
+        proxy.use_cache = True
+
+        async def client():
+            reader, writer = await asyncio.open_connection(*proxy.server.getsockname())
+            writer.write(b"GET http://smiley.com/ HTTP/1.1\r\nConnection: close\r\n\r\n")
+            data = await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+            return data
+
+        async def run():
+            server = asyncio.create_task(proxy.serve())
+            await asyncio.sleep(0)
+            results = await asyncio.gather(*[client() for _ in range(5)])
+            server.cancel()
+            return results
+
+        self.assertTrue(all(data.endswith(b"\r\n\r\nSmiley") for data in asyncio.run(run())))
+        self.assertEqual(len(received), 1)
+        self.assertEqual(proxy.flights.collapsed, 4)
+
+    def test_fallback(self):
+        """
+        Test that waiting requests are forwarded themselves when the response can not be cached.
+        """
+        port, received = start_scripted_origin([b"HTTP/1.1 200 OK\r\nCache-Control: no-store\r\nContent-Length: 6\r\n\r\nSmiley"], 0.3)
+        proxy = local_proxy(Proxy, port)
+        proxy.use_cache = True
+        responses = self.concurrent(proxy, 3)
+        self.assertEqual([response.body for response in responses], [b"Smiley"] * 3)
+        self.assertEqual(len(received), 3)
+        self.assertEqual(proxy.flights.fallbacks, 2)
+
+    def test_fallback_early(self):
+        """
+        Test that waiting requests are forwarded as soon as the head shows that the response can not be cached, without waiting for the body.
+        """
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(("127.0.0.1", 0))
+        server.listen(10)
+        arrived = []
+
+        def handle(connection):
+            SocketReader(connection).read_head()
+            arrived.append(time.perf_counter())
+            connection.sendall(b"HTTP/1.1 200 OK\r\nCache-Control: no-store\r\nContent-Length: 6\r\n\r\n")
+            time.sleep(1)
+            connection.sendall(b"Smiley")
+            connection.close()
+
+        def serve():
+            while True:
+                connection, _ = server.accept()
+                threading.Thread(target=handle, args=(connection,), daemon=True).start()
+
+        threading.Thread(target=serve, daemon=True).start()
+        proxy = local_proxy(Proxy, server.getsockname()[1])
+        proxy.use_cache = True
+        responses = self.concurrent(proxy, 2)
+        self.assertEqual([response.body for response in responses], [b"Smiley"] * 2)
+        self.assertEqual(len(arrived), 2)
+        self.assertLess(arrived[1] - arrived[0], 0.5)
+
+    def test_do(self):
+        """
+        Test that the work is done once for concurrent callers and that callers do it themselves if the leader fails.
+        """
+        flights = SingleFlight()
+        calls = []
+        started = threading.Event()
+
+        def work():
+            calls.append(1)
+            started.set()
+            threading.Event().wait(0.2)
+            return "result"
+
+        leader = threading.Thread(target=flights.do, args=("key", work))
+        leader.start()
+        started.wait(5)
+        self.assertEqual(flights.do("key", work), "result")
+        leader.join(5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flights.collapsed, 1)
+
+        flight, _ = flights.begin("other")
+        flights.finish("other", flight, None)
+        self.assertIsNone(flights.wait(flight, 1))
+
+class TestDiskCacheMethods(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_restart(self):
+        """
+        Test that stored responses can be read after the disk cache has been opened again, and that an incomplete record is removed.
+        """
+        request = Request(b"GET http://a/ HTTP/1.1\r\nAccept-Language: sv\r\n\r\n")
+        cache = DiskCache(self.directory.name)
+        cache.store(request, Response(b"HTTP/1.1 200 OK\r\nVary: Accept-Language\r\nCache-Control: max-age=60\r\n\r\nHej"))
+        cache.store(Request(b"GET http://b/ HTTP/1.1\r\n\r\n"), Response(b"HTTP/1.1 200 OK\r\n\r\nb"))
+        cache.close()
+        path = cache.path(cache.active)
+        size = os.path.getsize(path)
+        with open(path, "r+b") as file:
+            file.truncate(size - 1)
+
+        cache = DiskCache(self.directory.name)
+        entry = cache.lookup(request)
+        self.assertTrue(entry.fresh())
+        self.assertEqual(bytes(entry.response.body), b"Hej")
+        self.assertEqual(entry.response.headers["Vary"], " Accept-Language")
+        self.assertIsNone(cache.lookup(Request(b"GET http://a/ HTTP/1.1\r\nAccept-Language: en\r\n\r\n")))
+        self.assertIsNone(cache.lookup(Request(b"GET http://b/ HTTP/1.1\r\n\r\n")))
+        self.assertEqual(len(cache), 1)
+        cache.close()
+
+    def test_fingerprint(self):
+        """
+        Test that responses are only found with the fingerprint they were stored with, also after a restart.
+        """
+        request = Request(b"GET http://a/ HTTP/1.1\r\n\r\n")
+        cache = DiskCache(self.directory.name)
+        cache.fingerprint = "rules1"
+        cache.store(request, Response(b"HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\n\r\nBye"))
+        cache.close()
+        cache = DiskCache(self.directory.name)
+        self.assertIsNone(cache.lookup(request))
+        cache.fingerprint = "rules1"
+        self.assertEqual(bytes(cache.lookup(request).response.body), b"Bye")
+        cache.close()
+
+    def test_eviction(self):
+        """
+        Test that the oldest segments are deleted when the disk cache is full.
+        """
+        cache = DiskCache(self.directory.name, max_size=3000, segment_size=1000)
+        for index in range(10):
+            cache.store(Request(b"GET http://%d/ HTTP/1.1\r\n\r\n" % index), Response(b"HTTP/1.1 200 OK\r\n\r\n" + b"x" * 500))
+        self.assertLessEqual(sum(cache.segments.values()), 3000)
+        self.assertIsNone(cache.lookup(Request(b"GET http://0/ HTTP/1.1\r\n\r\n")))
+        self.assertEqual(bytes(cache.lookup(Request(b"GET http://9/ HTTP/1.1\r\n\r\n")).response.body), b"x" * 500)
+        self.assertGreater(cache.evictions, 0)
+        cache.close()
+
+    def test_checksum(self):
+        """
+        Test that a record with a damaged body is removed when the disk cache is opened again.
+        """
+        cache = DiskCache(self.directory.name)
+        cache.store(Request(b"GET http://a/ HTTP/1.1\r\n\r\n"), Response(b"HTTP/1.1 200 OK\r\n\r\nHello"))
+        cache.close()
+        path = cache.path(cache.active)
+        with open(path, "r+b") as file:
+            file.seek(-1, os.SEEK_END)
+            file.write(b"!")
+        cache = DiskCache(self.directory.name)
+        self.assertIsNone(cache.lookup(Request(b"GET http://a/ HTTP/1.1\r\n\r\n")))
+        self.assertEqual(os.path.getsize(path), 0)
+        cache.close()
+
+    def test_store_later(self):
+        """
+        Test that queued responses are written by the background thread, also when several threads store responses at the same time and the segments are rotated.
+        """
+        cache = DiskCache(self.directory.name, segment_size=2000)
+        threads = [threading.Thread(target=cache.store, args=(Request(b"GET http://%d/ HTTP/1.1\r\n\r\n" % index), Response(b"HTTP/1.1 200 OK\r\n\r\n" + bytes([index]) * 500))) for index in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        for index in range(10, 20):
+            self.assertTrue(cache.store_later(Request(b"GET http://%d/ HTTP/1.1\r\n\r\n" % index), Response(b"HTTP/1.1 200 OK\r\n\r\n" + bytes([index]) * 500)))
+        cache.close()
+        cache = DiskCache(self.directory.name)
+        for index in range(20):
+            self.assertEqual(bytes(cache.lookup(Request(b"GET http://%d/ HTTP/1.1\r\n\r\n" % index)).response.body), bytes([index]) * 500)
+        self.assertGreater(len(cache.segments), 1)
+        cache.close()
+
+    def test_queued_size(self):
+        """
+        Test that responses are not queued for the background thread when their bodies do not fit in max_queued_size, and that the reserved bytes are given back when they have been written.
+        """
+        cache = DiskCache(self.directory.name, max_queued_size=1000)
+        self.assertTrue(cache.reserve(800))
+        self.assertFalse(cache.store_later(Request(b"GET http://a/ HTTP/1.1\r\n\r\n"), Response(b"HTTP/1.1 200 OK\r\n\r\n" + b"a" * 500)))
+        cache.release(800)
+        self.assertTrue(cache.store_later(Request(b"GET http://a/ HTTP/1.1\r\n\r\n"), Response(b"HTTP/1.1 200 OK\r\n\r\n" + b"a" * 500)))
+        cache.flush()
+        self.assertEqual(cache.queued, 0)
+        self.assertEqual(len(cache), 1)
+        cache.close()
+
+    def test_stream_queued_size(self):
+        """
+        Test that a streamed body that is too large for the memory cache is only collected for the disk cache while it fits in max_queued_size.
+        """
+        for size, stored in ((800, 1), (5000, 0)):
+            port, _ = start_keep_alive_origin(b"HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nContent-Length: %d\r\n\r\n" % size + b"x" * size)
+            proxy = local_proxy(Proxy, port)
+            proxy.use_cache = True
+            proxy.cache.max_entry_size = 100
+            proxy.disk_cache = DiskCache(os.path.join(self.directory.name, str(size)), max_queued_size=1000)
+            self.assertEqual(handle_client(proxy, b"GET http://smiley.com/ HTTP/1.1\r\n\r\n")[0].body, b"x" * size)
+            proxy.disk_cache.flush()
+            self.assertEqual(len(proxy.disk_cache), stored)
+            self.assertEqual(proxy.disk_cache.queued, 0)
+            proxy.disk_cache.close()
+
+    def test_proxy(self):
+        """
+        Test that the proxy answers from the disk cache when the memory cache is empty.
+        """
+        port, connections = start_keep_alive_origin(b"HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nContent-Length: 5\r\n\r\nHello")
+        proxy = local_proxy(Proxy, port)
+        proxy.use_cache = True
+        proxy.disk_cache = DiskCache(self.directory.name)
+        request = b"GET http://smiley.com/ HTTP/1.1\r\n\r\n"
+        handle_client(proxy, request)
+        proxy.disk_cache.flush()
+        proxy.cache.clear()
+        responses = handle_client(proxy, request)
+        self.assertEqual(responses[0].body, b"Hello")
+        self.assertEqual(connections, [1])
+        self.assertEqual(proxy.disk_cache.hits, 1)
+        proxy.disk_cache.close()
+
+class TestKeepAliveMethods(unittest.TestCase):
+
+    def test_pipelining(self):
+        """
+        Test that several pipelined requests on one connection are answered in order.
+        """
+        port, connections = start_keep_alive_origin(b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nContent-Length: 8\r\n\r\nSmiley!!")
+        proxy = local_proxy(Proxy, port)
+        proxy.add_response_replacement("Smiley", "Trolly's")
+        request = b"GET http://smiley.com/ HTTP/1.1\r\nHost: smiley.com\r\n\r\n"
+        responses = handle_client(proxy, request * 3)
+        self.assertEqual([response.body for response in responses], [b"Trolly's!!"] * 3)
+        self.assertEqual(responses[0].headers["Connection"], " keep-alive")
+        self.assertEqual(connections, [3])
+
+    def test_connection_close(self):
+        """
+        Test that the connection is closed when the client asks for it, for HTTP/1.0 and after max_requests_per_connection requests.
+        """
+        port, _ = start_keep_alive_origin(b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n")
+        proxy = local_proxy(Proxy, port)
+        request = b"GET http://smiley.com/ HTTP/1.1\r\n\r\n"
+        responses = handle_client(proxy, b"GET http://smiley.com/ HTTP/1.1\r\nConnection: close\r\n\r\n" + request)
+        self.assertEqual(len(responses), 1)
+        self.assertEqual(responses[0].headers["Connection"], " close")
+
+        self.assertEqual(len(handle_client(proxy, b"GET http://smiley.com/ HTTP/1.0\r\n\r\n" + request)), 1)
+
+        proxy.max_requests_per_connection = 2
+        self.assertEqual(len(handle_client(proxy, request * 3)), 2)
+
+    def test_request_body(self):
+        """
+        Test that request bodies are forwarded and that the next request on the connection is read after the body.
+        """
+        port, received = start_origin(b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n", 2)
+        proxy = local_proxy(Proxy, port)
+        proxy.keep_alive = False
+        responses = handle_client(proxy, b"POST http://smiley.com/ HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n4\r\nbody\r\n0\r\n\r\n")
+        self.assertEqual(len(responses), 1)
+        self.assertTrue(received[0].endswith(b"Content-Length: 4\r\n\r\nbody"))
+
+    def test_no_delay(self):
+        """
+        Test that sequential requests on a persistent connection are not delayed by Nagle's algorithm, which would add about 40 ms to every streamed response.
+        """
+        port, _ = start_keep_alive_origin(b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nContent-Length: 16384\r\n\r\n" + b"x" * 16384)
+        proxy = local_proxy(Proxy, port)
+        threading.Thread(target=proxy.run, daemon=True).start()
+        try:
+            with socket.create_connection(("127.0.0.1", proxy.server.getsockname()[1]), 5) as client:
+                reader = SocketReader(client)
+                started = time.perf_counter()
+                for _ in range(10):
+                    client.sendall(b"GET http://smiley.com/ HTTP/1.1\r\nHost: smiley.com\r\n\r\n")
+                    response = Response(reader.read_head())
+                    self.assertEqual(sum(len(data) for data in reader.iter_body(*body_framing(response.headers, "GET", response.status_code))), 16384)
+                self.assertLess(time.perf_counter() - started, 0.2)
+            connection = proxy.pool.acquire(("127.0.0.1", port))
+            self.assertEqual(connection.sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY), 1)
+            connection.close()
+        finally:
+            proxy.stop()
+
+class TestStreamingMethods(unittest.TestCase):
+
+    def test_head_first(self):
+        """
+        Test that the head of a streamed response is sent to the client right away, also when the body is rewritten and the server is slow to send it.
+        """
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(("127.0.0.1", 0))
+        server.listen(1)
+
+        def serve():
+            connection, _ = server.accept()
+            connection.recv(65536)
+            connection.sendall(b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nContent-Length: 11\r\n\r\n")
+            time.sleep(0.5)
+            connection.sendall(b"Hello World")
+            connection.close()
+            server.close()
+
+        threading.Thread(target=serve, daemon=True).start()
+        proxy = local_proxy(Proxy, server.getsockname()[1])
+        proxy.add_response_replacement("Hello", "Bye")
+        client, connection = socket.socketpair()
+        thread = threading.Thread(target=proxy.handle_request, args=(connection, ("127.0.0.1", 0)))
+        thread.start()
+        started = time.perf_counter()
+        client.sendall(b"GET http://smiley.com/ HTTP/1.1\r\nHost: smiley.com\r\nConnection: close\r\n\r\n")
+        reader = SocketReader(client)
+        response = Response(reader.read_head())
+        self.assertLess(time.perf_counter() - started, 0.4)
+        self.assertEqual(b"".join(bytes(data) for data in reader.iter_body(*body_framing(response.headers, "GET", response.status_code))), b"Bye World")
+        thread.join(5)
+        client.close()
+
+    def test_broken_upstream(self):
+        """
+        Test that the client connection is closed when the server sends a broken chunk size while the body is streamed, and that an invalid status line is answered with 502.
+        """
+        port, _ = start_origin(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\nzz\r\n")
+        proxy = local_proxy(Proxy, port)
+        client, server = socket.socketpair()
+        client.settimeout(5)
+        thread = threading.Thread(target=proxy.handle_request, args=(server, ("127.0.0.1", 0)))
+        thread.start()
+        client.sendall(b"GET http://smiley.com/ HTTP/1.1\r\nHost: smiley.com\r\n\r\n")
+        while client.recv(65536):
+            pass
+        thread.join(5)
+        client.close()
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(server.fileno(), -1)
+
+        port, _ = start_origin(b"HTTP/1.1 abc OK\r\nContent-Length: 0\r\n\r\n")
+        proxy = local_proxy(Proxy, port)
+        responses = handle_client(proxy, b"GET http://smiley.com/ HTTP/1.1\r\nHost: smiley.com\r\n\r\n")
+        self.assertEqual(responses[0].status_code, "502")
+
+    def test_server_close(self):
+        """
+        Test that a streamed response from a server that closes the connection is not given back to the pool, although the client connection is kept open.
+        """
+        port, _ = start_origin(b"HTTP/1.1 200 OK\r\nContent-Type: image/png\r\nContent-Length: 5\r\nConnection: close\r\n\r\nHello")
+        proxy = local_proxy(Proxy, port)
+        responses = handle_client(proxy, b"POST http://smiley.com/ HTTP/1.1\r\nContent-Length: 0\r\n\r\n")
+        self.assertEqual(responses[0].body, b"Hello")
+        self.assertEqual(responses[0].headers["Connection"], " keep-alive")
+        self.assertEqual(proxy.pool.idle, 0)
+
+    def test_stream_chunked(self):
+        """
+        Test that chunked responses are relayed with chunked encoding and stored in the cache when they are complete.
+        """
+        port, connections = start_keep_alive_origin(b"HTTP/1.1 200 OK\r\nContent-Type: image/png\r\nTransfer-Encoding: chunked\r\n\r\n5\r\nHello\r\n6\r\n World\r\n0\r\n\r\n")
+        proxy = local_proxy(Proxy, port)
+        proxy.use_cache = True
+        proxy.add_response_replacement("Hello", "Bye")
+        responses = handle_client(proxy, b"GET http://smiley.com/a.png HTTP/1.1\r\n\r\n" * 2)
+        self.assertEqual([response.body for response in responses], [b"Hello World"] * 2)
+        self.assertEqual(responses[0].headers["Transfer-Encoding"], " chunked")
+        self.assertEqual(connections, [2])
+        self.assertEqual(proxy.cache["http://smiley.com/a.png"].body, b"Hello World")
+        self.assertEqual(proxy.cache["http://smiley.com/a.png"].headers["Content-Length"], " 11")
+
+    def test_stream_until_close(self):
+        """
+        Test that bodies that end when the server closes the connection are chunked for HTTP/1.1 clients, and that HTTP/1.0 clients are disconnected after them.
+        """
+        port, _ = start_origin(b"HTTP/1.1 200 OK\r\n\r\n" + b"x" * 100000, 2)
+        proxy = local_proxy(Proxy, port)
+        responses = handle_client(proxy, b"GET http://smiley.com/ HTTP/1.1\r\n\r\n")
+        self.assertEqual(responses[0].body, b"x" * 100000)
+        self.assertEqual(responses[0].headers["Connection"], " keep-alive")
+
+        client, server = socket.socketpair()
+        thread = threading.Thread(target=proxy.handle_request, args=(server, ("127.0.0.1", 0)))
+        thread.start()
+        client.sendall(b"GET http://smiley.com/ HTTP/1.0\r\nConnection: keep-alive\r\n\r\n")
+        reader = SocketReader(client)
+        self.assertIn(b"Connection: close", reader.read_head())
+        self.assertEqual(b"".join(bytes(data) for data in reader.iter_body("close")), b"x" * 100000)
+        thread.join(5)
+        client.close()
+
+class TestEncodingMethods(unittest.TestCase):
+
+    def test_negotiate(self):
+        """
+        Test that the content coding is chosen by the Accept-Encoding header of the client and its q-values.
+        """
+        self.assertEqual(negotiate("gzip, deflate", ("gzip",)), "gzip")
+        self.assertEqual(negotiate("gzip;q=0, deflate", ("gzip",)), None)
+        self.assertEqual(negotiate("*", ("gzip",)), "gzip")
+        self.assertEqual(negotiate("", ("gzip",)), None)
+        self.assertEqual(negotiate("identity", ("br", "gzip")), None)
+        self.assertTrue(compressible("application/json"))
+        self.assertFalse(compressible("image/png"))
+        self.assertEqual(decompress("deflate", compress("deflate", b"Hello")), b"Hello")
+
+    def test_manipulate_gzip(self):
+        """
+        Test that gzip bodies are decompressed before the replacements and compressed again afterwards.
+        """
+        body = gzip.compress(b"Hello World")
+        response = Response(b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nContent-Encoding: gzip\r\nContent-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+        response.manipulate({b"Hello": b"Bye"}, 0)
+        self.assertEqual(gzip.decompress(response.body), b"Bye World")
+        self.assertEqual(response.headers["Content-Length"], f" {len(response.body)}")
+
+        response = Response(b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nContent-Encoding: compress\r\n\r\nHello")
+        response.manipulate({b"Hello": b"Bye"}, 0)
+        self.assertEqual(response.body, b"Hello")
+
+    def test_stream_gzip(self):
+        """
+        Test that streamed gzip bodies are rewritten piece by piece and sent to the client compressed.
+        """
+        body = gzip.compress(b"Hello World " * 1000)
+        port, _ = start_keep_alive_origin(b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nContent-Encoding: gzip\r\nContent-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+        proxy = local_proxy(Proxy, port)
+        proxy.add_response_replacement("Hello", "Bye")
+        response = handle_client(proxy, b"GET http://smiley.com/ HTTP/1.1\r\n\r\n")[0]
+        self.assertEqual(response.headers["Content-Encoding"], " gzip")
+        self.assertEqual(gzip.decompress(response.body), b"Bye World " * 1000)
+
+    def test_compression(self):
+        """
+        Test that responses are compressed for clients that accept gzip, that the cache keeps the uncompressed response and that the compressed copy is cached.
+        """
+        body = b"Hello World " * 1000
+        port, connections = start_keep_alive_origin(b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nCache-Control: max-age=60\r\nETag: \"1\"\r\nContent-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+        proxy = local_proxy(Proxy, port)
+        proxy.use_cache = True
+        proxy.compression = True
+        request = b"GET http://smiley.com/ HTTP/1.1\r\nAccept-Encoding: gzip, deflate\r\n\r\n"
+        responses = handle_client(proxy, request * 3 + b"GET http://smiley.com/ HTTP/1.1\r\n\r\n")
+        for response in responses[:3]:
+            self.assertEqual(response.headers["Content-Encoding"], " gzip")
+            self.assertEqual(response.headers["Vary"], " Accept-Encoding")
+            self.assertEqual(response.headers["ETag"], ' W/"1"')
+            self.assertEqual(gzip.decompress(response.body), body)
+        self.assertNotIn("Content-Encoding", responses[3].headers)
+        self.assertEqual(responses[3].body, body)
+        self.assertEqual(connections, [1])
+        self.assertEqual(proxy.cache["http://smiley.com/"].body, body)
+        self.assertEqual(len(proxy.cache), 2)
+
+    def test_compression_refresh(self):
+        """
+        Test that the compressed copy of a cached response gets the new headers when the response is refreshed by a 304 Not Modified.
+        """
+        body = b"Hello World " * 1000
+        port, _ = start_keep_alive_origin(b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nCache-Control: max-age=60\r\nContent-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+        proxy = local_proxy(Proxy, port)
+        proxy.use_cache = True
+        proxy.compression = True
+        request = b"GET http://smiley.com/ HTTP/1.1\r\nAccept-Encoding: gzip\r\n\r\n"
+        # The second response comes from the cache and its compressed copy is cached
+        for response in handle_client(proxy, request * 2):
+            self.assertEqual(response.headers["Cache-Control"], " max-age=60")
+        self.assertEqual(len(proxy.cache), 2)
+        cached = proxy.cache.lookup(Request(request))
+        proxy.refresh(Request(request), cached.response, Response(b"HTTP/1.1 304 Not Modified\r\nCache-Control: max-age=120\r\n\r\n"))
+        response = handle_client(proxy, request)[0]
+        self.assertEqual(response.headers["Cache-Control"], " max-age=120")
+        self.assertEqual(gzip.decompress(response.body), body)
+
+    def test_compression_version(self):
+        """
+        Test that the compressed copy of a response from the memory cache or the disk cache is found again by its version, and that the copy of a changed response is not used.
+        """
+        request = Request(b"GET http://smiley.com/ HTTP/1.1\r\nAccept-Encoding: gzip\r\n\r\n")
+        body = b"Hello World " * 1000
+        proxy = Proxy("127.0.0.1", 0, 10)
+        proxy.use_cache = True
+        proxy.compression = True
+        with tempfile.TemporaryDirectory() as directory:
+            proxy.disk_cache = DiskCache(directory)
+            for cache in (proxy.cache, proxy.disk_cache):
+                cache.store(request, Response(b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nCache-Control: max-age=60\r\nContent-Length: 12000\r\n\r\n" + body))
+                if cache is proxy.disk_cache:
+                    cache.flush()
+                first = proxy.compress_response(request, cache.lookup(request).response, 0)
+                self.assertIs(proxy.compress_response(request, cache.lookup(request).response, 0), first)
+                self.assertEqual(gzip.decompress(first.body), body)
+            changed = Response(b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nCache-Control: max-age=60\r\nContent-Length: 12000\r\n\r\n" + body.upper())
+            proxy.cache.store(request, changed)
+            self.assertEqual(gzip.decompress(proxy.compress_response(request, proxy.cache.lookup(request).response, 0).body), body.upper())
+            proxy.disk_cache.close()
+
+class TestResolverMethods(unittest.TestCase):
+
+    def test_split_host(self):
+        """
+        Test that the port is taken from the host and that IPv6 addresses are supported.
+        """
+        self.assertEqual(split_host("example.com"), ("example.com", 80))
+        self.assertEqual(split_host("example.com:8080"), ("example.com", 8080))
+        self.assertEqual(split_host("[::1]:8080"), ("::1", 8080))
+        self.assertEqual(split_host("[::1]", 443), ("::1", 443))
+        self.assertRaises(ValueError, split_host, "example.com:http")
+        self.assertEqual(interleave([(10, "a"), (10, "b"), (2, "c"), (10, "a")]), [(10, "a"), (2, "c"), (10, "b")])
+
+    def test_cache(self):
+        """
+        Test that names are only looked up once within the ttl, and that failed lookups are cached too.
+        """
+        resolver = Resolver()
+        with mock.patch("socket.getaddrinfo", return_value=[(socket.AF_INET, socket.SOCK_STREAM, 6, "", ("127.0.0.1", 80))]) as getaddrinfo:
+            self.assertEqual(resolver.resolve("Example.com", 80), [(socket.AF_INET, ("127.0.0.1", 80))])
+            self.assertEqual(resolver.resolve("example.com", 80), [(socket.AF_INET, ("127.0.0.1", 80))])
+            self.assertEqual(getaddrinfo.call_count, 1)
+        with mock.patch("socket.getaddrinfo", side_effect=socket.gaierror(-2, "Name or service not known")) as getaddrinfo:
+            self.assertRaises(socket.gaierror, resolver.resolve, "missing.example", 80)
+            self.assertRaises(socket.gaierror, resolver.resolve, "missing.example", 80)
+            self.assertEqual(getaddrinfo.call_count, 1)
+        self.assertEqual((resolver.hits, resolver.misses, resolver.failures), (2, 2, 1))
+
+        # Expired addresses are used while they are looked up again
+        resolver.entries[("example.com", 80)].expires = 0
+        resolver.stale_ttl = float("inf")
+        with mock.patch("socket.getaddrinfo", return_value=[(socket.AF_INET, socket.SOCK_STREAM, 6, "", ("127.0.0.2", 80))]):
+            self.assertEqual(resolver.resolve("example.com", 80), [(socket.AF_INET, ("127.0.0.1", 80))])
+            for _ in range(100):
+                if not resolver.refreshing:
+                    break
+                threading.Event().wait(0.01)
+        self.assertEqual(resolver.resolve("example.com", 80), [(socket.AF_INET, ("127.0.0.2", 80))])
+
+    def test_connect(self):
+        """
+        Test that the next address is tried when a connection is refused, with threads and with asyncio.
+        """
+        closed = socket.socket()
+        closed.bind(("127.0.0.1", 0))
+        refused = closed.getsockname()
+        closed.close()
+        server = socket.socket()
+        server.bind(("127.0.0.1", 0))
+        server.listen(2)
+        resolver = Resolver()
+        resolver.entries[("example.com", 80)] = ResolverEntry([(socket.AF_INET, refused), (socket.AF_INET, server.getsockname())], None, 60)
+
+        sock = resolver.connect(("example.com", 80), 5)
+        self.assertEqual(sock.getpeername(), server.getsockname())
+        self.assertEqual(sock.gettimeout(), 5)
+        sock.close()
+
+        sock = asyncio.run(resolver.connect_async(("example.com", 80)))
+        self.assertEqual(sock.getpeername(), server.getsockname())
+        sock.close()
+        server.close()
+
+        resolver.entries[("example.com", 80)] = ResolverEntry([(socket.AF_INET, refused)], None, 60)
+        self.assertRaises(OSError, resolver.connect, ("example.com", 80), 5)
+
+    def test_upstream_port(self):
+        """
+        Test that the proxy connects to the port given in the host of the request.
+        """
+        port, received = start_origin(b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nHello")
+        proxy = Proxy("127.0.0.1", 0, 10)
+        responses = handle_client(proxy, f"GET http://127.0.0.1:{port}/ HTTP/1.1\r\n\r\n".encode())
+        self.assertEqual(responses[0].body, b"Hello")
+        self.assertEqual(len(received), 1)
+        proxy.stop()
+
+class TestTunnelMethods(unittest.TestCase):
+
+    def test_connect_request(self):
+        """
+        Test that the host and port of CONNECT requests are parsed.
+        """
+        request = Request(b"CONNECT example.com:443 HTTP/1.1\r\nHost: example.com:443\r\n\r\n")
+        self.assertEqual(request.valid, True)
+        self.assertEqual(request.method, "CONNECT")
+        self.assertEqual(request.host, "example.com:443")
+        self.assertEqual(request.url, "example.com:443")
+
+    def test_relay(self):
+        """
+        Test that the tunnel relay relays the data in both directions, with and without os.splice, and passes on when one side closes its half of the connection.
+        """
+        relay = TunnelRelay(buffer_size=1024)
+        for splice in {False, SPLICE}:
+            client, client_side = socket.socketpair()
+            server_side, server = socket.socketpair()
+            tunnel = Tunnel(splice=splice)
+            finished = threading.Event()
+            relay.add(tunnel, client_side, server_side, lambda tunnel: finished.set())
+            client.sendall(b"x" * 100000)
+            client.shutdown(socket.SHUT_WR)
+            received = bytearray()
+            data = server.recv(65536)
+            while data:
+                received += data
+                data = server.recv(65536)
+            self.assertEqual(len(received), 100000)
+            server.sendall(b"Hello")
+            server.close()
+            self.assertEqual(client.recv(100), b"Hello")
+            self.assertEqual(client.recv(100), b"")
+            self.assertTrue(finished.wait(5))
+            client.close()
+            self.assertEqual((tunnel.upstream_bytes, tunnel.downstream_bytes), (100000, 5))
+            self.assertEqual(client_side.fileno(), -1)
+
+    def test_relay_many(self):
+        """
+        Test that the tunnel relay relays many tunnels at the same time in a single thread, with a receiver that is slower than the sender.
+        """
+        relay = TunnelRelay(buffer_size=4096)
+        pairs = []
+        for _ in range(20):
+            client, client_side = socket.socketpair()
+            server_side, server = socket.socketpair()
+            relay.add(Tunnel(splice=False), client_side, server_side)
+            pairs.append((client, server))
+        threads = [threading.Thread(target=client.sendall, args=(bytes([number]) * 200000,)) for number, (client, _) in enumerate(pairs)]
+        for thread in threads:
+            thread.start()
+        for number, (client, server) in enumerate(pairs):
+            received = bytearray()
+            while len(received) < 200000:
+                received += server.recv(65536)
+            self.assertEqual(received, bytes([number]) * 200000)
+            client.close()
+            server.close()
+        for thread in threads:
+            thread.join(5)
+
+    def test_idle_timeout(self):
+        """
+        Test that idle tunnels are closed.
+        """
+        client, client_side = socket.socketpair()
+        server_side, server = socket.socketpair()
+        relay = TunnelRelay()
+        finished = threading.Event()
+        relay.add(Tunnel(idle_timeout=0.2), client_side, server_side, lambda tunnel: finished.set())
+        self.assertTrue(finished.wait(5))
+        self.assertEqual(client.recv(100), b"")
+        client.close()
+        server.close()
+
+    def test_proxy(self):
+        """
+        Test that CONNECT requests are tunneled to the server, including data sent right after the request, and that other ports are refused.
+        """
+        port = start_echo_server()
+        proxy = Proxy("127.0.0.1", 0, 10)
+        proxy.tunnel_ports = (port,)
+        client, server = socket.socketpair()
+        thread = threading.Thread(target=proxy.handle_request, args=(server, ("127.0.0.1", 0)))
+        thread.start()
+        client.sendall(f"CONNECT 127.0.0.1:{port} HTTP/1.1\r\n\r\nHello".encode())
+        reader = SocketReader(client)
+        self.assertEqual(reader.read_head(), b"HTTP/1.1 200 Connection Established\r\n\r\n")
+        client.sendall(b" World")
+        client.shutdown(socket.SHUT_WR)
+        self.assertEqual(b"".join(bytes(data) for data in reader.iter_body("close")), b"Hello World")
+        thread.join(5)
+        client.close()
+        deadline = time.monotonic() + 5
+        while proxy.active_tunnels and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(proxy.tunnels.value, 1)
+        self.assertEqual(proxy.tunnel_bytes["upstream"].value, 11)
+
+        responses = handle_client(proxy, b"CONNECT 127.0.0.1:25 HTTP/1.1\r\n\r\n")
+        self.assertEqual(responses[0].status_code, "403")
+        proxy.stop()
+
+    def test_workers(self):
+        """
+        Test that open tunnels do not hold a thread of the worker pool, so other requests are still handled, and that CONNECT requests are refused with 503 when max_tunnels tunnels are open.
+        """
+        port, _ = start_origin(b"HTTP/1.1 200 OK\r\nContent-Length: 14\r\n\r\nThis is Smiley")
+        proxy = local_proxy(Proxy, port)
+        proxy.workers = WorkerPool(threads=1)
+        proxy.tunnel_ports = None
+        proxy.max_tunnels = 1
+        threading.Thread(target=proxy.run, daemon=True).start()
+        try:
+            tunnel = socket.create_connection(proxy.server.getsockname(), 5)
+            tunnel.sendall(f"CONNECT 127.0.0.1:{start_echo_server()} HTTP/1.1\r\n\r\n".encode())
+            self.assertEqual(SocketReader(tunnel).read_head(), b"HTTP/1.1 200 Connection Established\r\n\r\n")
+
+            with socket.create_connection(proxy.server.getsockname(), 5) as client:
+                client.sendall(b"CONNECT 127.0.0.1:25 HTTP/1.1\r\n\r\n")
+                self.assertTrue(SocketReader(client).read_head().startswith(b"HTTP/1.1 503 Service Unavailable\r\n"))
+
+            with socket.create_connection(proxy.server.getsockname(), 5) as client:
+                client.sendall(b"GET http://smiley.com/ HTTP/1.1\r\nHost: smiley.com\r\nConnection: close\r\n\r\n")
+                reader = SocketReader(client)
+                response = Response(reader.read_head())
+                self.assertEqual(b"".join(bytes(data) for data in reader.iter_body(*body_framing(response.headers, "GET", response.status_code))), b"This is Smiley")
+
+            tunnel.sendall(b"Hello")
+            self.assertEqual(tunnel.recv(100), b"Hello")
+            self.assertEqual(proxy.active_tunnels, 1)
+            tunnel.close()
+        finally:
+            proxy.stop()
+
+class TestUploadMethods(unittest.TestCase):
+
+    def test_stream_body(self):
+        """
+        Test that large request bodies are streamed to the server, with chunked encoding if the client used it.
+        """
+        port, received = start_upload_origin(2)
+        proxy = local_proxy(Proxy, port)
+        proxy.request_buffer_size = 1000
+        body = b"x" * 1000000
+        responses = handle_client(proxy, b"POST http://smiley.com/ HTTP/1.1\r\nContent-Length: 1000000\r\n\r\n" + body)
+        self.assertEqual(responses[0].body, b"1000000")
+        self.assertEqual(received[0][1], body)
+
+        chunks = b"".join(b"%x\r\n" % 500 + b"y" * 500 + b"\r\n" for _ in range(10)) + b"0\r\n\r\n"
+        responses = handle_client(proxy, b"PUT http://smiley.com/ HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n" + chunks)
+        self.assertEqual(responses[0].body, b"5000")
+        self.assertIn(b"Transfer-Encoding: chunked", received[1][0])
+        self.assertEqual(received[1][1], b"y" * 5000)
+
+    def test_limits(self):
+        """
+        Test that too large header blocks are refused with 431 and too large bodies with 413.
+        """
+        port, received = start_upload_origin()
+        proxy = local_proxy(Proxy, port)
+        proxy.max_header_size = 1000
+        proxy.max_body_size = 3000
+        proxy.request_buffer_size = 1000
+        responses = handle_client(proxy, b"GET http://smiley.com/ HTTP/1.1\r\nCookie: " + b"x" * 2000 + b"\r\n\r\n")
+        self.assertEqual(responses[0].status_code, "431")
+        responses = handle_client(proxy, b"POST http://smiley.com/ HTTP/1.1\r\nContent-Length: 5000\r\n\r\n")
+        self.assertEqual(responses[0].status_code, "413")
+        chunks = b"".join(b"%x\r\n" % 1000 + b"y" * 1000 + b"\r\n" for _ in range(5)) + b"0\r\n\r\n"
+        responses = handle_client(proxy, b"POST http://smiley.com/ HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n" + chunks)
+        self.assertEqual(responses[0].status_code, "413")
+        self.assertEqual(responses[0].headers["Connection"], " close")
+
+    def test_framing(self):
+        """
+        Test that a chunked body is forwarded without the Content-Length the client sent with it, and that an invalid Content-Length is answered with 400, by both proxies.
+        """
+        for proxy_class in (Proxy, AsyncProxy):
+            for body in (b"y" * 200, b"y" * 2000):
+                port, received = start_upload_origin()
+                proxy = local_proxy(proxy_class, port)
+                proxy.request_buffer_size = 1000
+                request = b"POST http://smiley.com/ HTTP/1.1\r\nContent-Length: 3\r\nTransfer-Encoding: chunked\r\n\r\n" + b"%x\r\n" % len(body) + body + b"\r\n0\r\n\r\n"
+                if proxy_class is Proxy:
+                    handle_client(proxy, request)
+                else:
+                    TestAsyncProxyMethods.exchange(self, proxy, request)
+                head = Request(received[0][0])
+                self.assertEqual(received[0][1], body)
+                self.assertEqual(head.headers.get_all("Content-Length"), [] if len(body) > 1000 else [f" {len(body)}"])
+
+            proxy = Proxy("127.0.0.1", 0, 10) if proxy_class is Proxy else AsyncProxy("127.0.0.1", 0, 10)
+            request = b"POST http://smiley.com/ HTTP/1.1\r\nContent-Length: -1\r\n\r\n"
+            if proxy_class is Proxy:
+                data = handle_client(proxy, request)[0].encode()
+            else:
+                data = TestAsyncProxyMethods.exchange(self, proxy, request)
+            self.assertTrue(data.startswith(b"HTTP/1.1 400 Bad Request\r\n"))
+        self.assertRaises(ValueError, body_framing, Headers([("Content-Length", " 1, 1")]), "POST")
+
+    def test_expect_continue(self):
+        """
+        Test that the proxy answers Expect: 100-continue itself before it reads the body.
+        """
+        port, received = start_upload_origin()
+        proxy = local_proxy(Proxy, port)
+        client, server = socket.socketpair()
+        thread = threading.Thread(target=proxy.handle_request, args=(server, ("127.0.0.1", 0)))
+        thread.start()
+        client.sendall(b"POST http://smiley.com/ HTTP/1.1\r\nContent-Length: 5\r\nExpect: 100-continue\r\n\r\n")
+        reader = SocketReader(client)
+        self.assertEqual(reader.read_head(), b"HTTP/1.1 100 Continue\r\n\r\n")
+        client.sendall(b"Hello")
+        client.shutdown(socket.SHUT_WR)
+        response = Response(reader.read_head())
+        self.assertEqual(response.status_code, "200")
+        thread.join(5)
+        client.close()
+        self.assertNotIn(b"Expect", received[0][0])
+        self.assertEqual(received[0][1], b"Hello")
+
+class TestAsyncProxyMethods(unittest.TestCase):
+
+    def exchange(self, proxy, request):
+        """
+        Send a request through the async proxy and return everything it answers.
+        """
+        async def run():
+            server = asyncio.create_task(proxy.serve())
+            reader, writer = await asyncio.open_connection(*proxy.server.getsockname())
+            writer.write(request)
+            writer.write_eof()
+            data = await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+            server.cancel()
+            return data
+        return asyncio.run(run())
+
+    def test_truncated_body(self):
+        """
+        Test that the async proxy answers responses whose body ends early with 502 and does not cache them.
+        """
+        for head in (b"HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nContent-Length: 100\r\n\r\nshort", b"HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nTransfer-Encoding: chunked\r\n\r\n"):
+            port, _ = start_origin(head)
+            proxy = local_proxy(AsyncProxy, port)
+            proxy.use_cache = True
+            data = self.exchange(proxy, b"GET http://smiley.com/ HTTP/1.1\r\nHost: smiley.com\r\n\r\n")
+            self.assertTrue(data.startswith(b"HTTP/1.1 502 Bad Gateway\r\n"))
+            self.assertEqual(len(proxy.cache), 0)
+
+    def test_slow_body(self):
+        """
+        Test that read_timeout limits every read of a response body and not the whole body, so a body that arrives slowly but steadily is received.
+        """
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(("127.0.0.1", 0))
+        server.listen(1)
+
+        def serve():
+            connection, _ = server.accept()
+            connection.recv(65536)
+            connection.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\n")
+            for data in b"Hello":
+                time.sleep(0.15)
+                connection.sendall(bytes([data]))
+            connection.close()
+            server.close()
+
+        threading.Thread(target=serve, daemon=True).start()
+        proxy = local_proxy(AsyncProxy, server.getsockname()[1])
+        proxy.read_timeout = 0.5
+        data = self.exchange(proxy, b"GET http://smiley.com/ HTTP/1.1\r\nHost: smiley.com\r\n\r\n")
+        self.assertTrue(data.startswith(b"HTTP/1.1 200 OK\r\n"))
+        self.assertTrue(data.endswith(b"\r\n\r\nHello"))
+
+    def test_stream_body(self):
+        """
+        Test that the async proxy streams large request bodies to the server.
+        """
+        port, received = start_upload_origin()
+        proxy = local_proxy(AsyncProxy, port)
+        proxy.request_buffer_size = 1000
+        data = self.exchange(proxy, b"POST http://smiley.com/ HTTP/1.1\r\nContent-Length: 100000\r\n\r\n" + b"x" * 100000)
+        self.assertTrue(data.endswith(b"\r\n\r\n100000"))
+        self.assertEqual(received[0][1], b"x" * 100000)
+
+    def test_tunnel(self):
+        """
+        Test that the async proxy tunnels CONNECT requests.
+        """
+        port = start_echo_server()
+        proxy = AsyncProxy("127.0.0.1", 0, 10)
+        proxy.tunnel_ports = None
+        data = self.exchange(proxy, f"CONNECT 127.0.0.1:{port} HTTP/1.1\r\n\r\nHello".encode())
+        self.assertEqual(data, b"HTTP/1.1 200 Connection Established\r\n\r\nHello")
+        self.assertEqual(proxy.tunnel_bytes["downstream"].value, 5)
+
+    def test_forward(self):
+        """
+        Test that the async proxy forwards requests and manipulates the responses.
+        """
+        port, received = start_origin(b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\n\r\nThis is Smiley")
+        proxy = local_proxy(AsyncProxy, port)
+        proxy.add_response_replacement("Smiley", "Trolly")
+        proxy.keep_alive = False
+        response = self.exchange(proxy, b"GET http://smiley.com/ HTTP/1.1\r\nHost: smiley.com\r\n\r\n")
+        self.assertTrue(response.endswith(b"\r\n\r\nThis is Trolly"))
+        self.assertIn(b"Connection: close", received[0])
+
+    def test_bad_request(self):
+        """
+        Test that the async proxy rejects requests that can not be parsed.
+        """
+        proxy = AsyncProxy("127.0.0.1", 0, 10)
+        self.assertEqual(self.exchange(proxy, b"incorrectdata"), b"HTTP/1.1 400 Bad Request\r\n\r\n")
+
+    def test_cache(self):
+        """
+        Test that the async proxy answers from the cache the same way as the threaded proxy.
+        """
+        proxy = AsyncProxy("127.0.0.1", 0, 10)
+        proxy.use_cache = True
+        proxy.cache["www.smiley.com"] = Response(b"HTTP/1.1 200 OK\r\nLast-Modified: Fri, 16 Jan 2021 11:35:43 GMT\r\n\r\nThis is Smiley")
+        response = self.exchange(proxy, b"GET www.smiley.com TEST\r\nIf-Modified-Since: Fri, 15 Jan 2021 11:35:43 GMT\r\n\r\n")
+        self.assertTrue(response.endswith(b"This is Smiley"))
+
+class TestOverloadMethods(unittest.TestCase):
+    def test_worker_pool(self):
+        """
+        Test that the worker pool runs the tasks on its threads and rejects tasks when the queue is full.
+        """
+        pool = WorkerPool(threads=1, queue_size=1)
+        started = threading.Event()
+        release = threading.Event()
+        results = []
+        self.assertTrue(pool.submit(lambda: (started.set(), release.wait(5))))
+        started.wait(5)
+        self.assertTrue(pool.submit(results.append, 1))
+        self.assertFalse(pool.submit(results.append, 2))
+        self.assertEqual(pool.rejected, 1)
+        self.assertEqual(pool.waiting(), 1)
+        release.set()
+        pool.shutdown(5)
+        self.assertEqual(results, [1])
+        self.assertEqual(pool.completed, 2)
+
+    def test_load_shedding(self):
+        """
+        Test that connections are rejected with 503 when max_connections connections are being handled.
+        """
+        proxy = Proxy("127.0.0.1", 0, 10)
+        proxy.max_connections = 0
+        thread = threading.Thread(target=proxy.run)
+        thread.start()
+        client = socket.create_connection(proxy.server.getsockname(), 5)
+        response = SocketReader(client).read_head()
+        client.close()
+        proxy.stop()
+        thread.join(5)
+        self.assertTrue(response.startswith(b"HTTP/1.1 503 Service Unavailable\r\n"))
+        self.assertEqual(proxy.rejected_connections, 1)
+        self.assertEqual(proxy.active_connections, 0)
+
+    def test_admitted_connections(self):
+        """
+        Test that admitted connections are handled by the worker pool and counted while they are open.
+        """
+        port, _ = start_origin(b"HTTP/1.1 200 OK\r\nContent-Length: 14\r\n\r\nThis is Smiley")
+        proxy = local_proxy(Proxy, port)
+        thread = threading.Thread(target=proxy.run)
+        thread.start()
+        client = socket.create_connection(proxy.server.getsockname(), 5)
+        client.sendall(b"GET http://smiley.com/ HTTP/1.1\r\nHost: smiley.com\r\nConnection: close\r\n\r\n")
+        reader = SocketReader(client)
+        response = Response(reader.read_head())
+        body = b"".join(bytes(data) for data in reader.iter_body(*body_framing(response.headers, "GET", response.status_code)))
+        client.close()
+        proxy.stop()
+        thread.join(5)
+        self.assertEqual(body, b"This is Smiley")
+        self.assertEqual(proxy.workers.completed, 1)
+        self.assertEqual(proxy.active_connections, 0)
+
+    def test_slow_headers(self):
+        """
+        Test that a client that does not send a complete header block within client_idle_timeout seconds is disconnected.
+        """
+        proxy = Proxy("127.0.0.1", 0, 10)
+        proxy.client_idle_timeout = 0.3
+        client, server = socket.socketpair()
+        thread = threading.Thread(target=proxy.handle_request, args=(server, ("127.0.0.1", 0)))
+        thread.start()
+        for data in (b"GET http://smiley.com/ HTTP/1.1\r\n", b"Host: smiley.com\r\n", b"X-Slow: 1\r\n"):
+            try:
+                client.sendall(data)
+            except OSError:
+                break
+            threading.Event().wait(0.15)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        client.close()
+
+    def test_read_timeout(self):
+        """
+        Test that the client gets 502 Bad Gateway if the server does not answer within read_timeout seconds.
+        """
+        port, _ = start_scripted_origin([b"HTTP/1.1 200 OK\r\nContent-Length: 14\r\n\r\nThis is Smiley"], delay=1)
+        proxy = local_proxy(Proxy, port)
+        proxy.read_timeout = 0.2
+        responses = handle_client(proxy, b"GET http://smiley.com/ HTTP/1.1\r\nHost: smiley.com\r\n\r\n")
+        self.assertEqual(responses[0].status_code, "502")
+
+class TestMetricsMethods(unittest.TestCase):
+    def test_histogram(self):
+        """
+        Test that a histogram counts values in the right buckets and estimates quantiles from them.
+        """
+        histogram = Histogram((0.1, 1))
+        self.assertIsNone(histogram.quantile(0.5))
+        for value in (0.05, 0.1, 0.5, 5):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [2, 1, 1])
+        self.assertEqual(histogram.count, 4)
+        self.assertEqual(histogram.quantile(0.5), 0.1)
+        self.assertEqual(histogram.quantile(0.99), float("inf"))
+
+    def test_render(self):
+        """
+        Test that metrics are rendered in the Prometheus text format.
+        """
+        metrics = Metrics()
+        metrics.counter("requests_total", "Requests.").inc(3)
+        metrics.histogram("phase_seconds", "Phases.", (0.1, 1), phase="parse").observe(0.5)
+        text = metrics.render([("active", "Active connections.", "gauge", 2)])
+        self.assertIn("# TYPE requests_total counter\nrequests_total 3\n", text)
+        self.assertIn('phase_seconds_bucket{phase="parse",le="0.1"} 0\n', text)
+        self.assertIn('phase_seconds_bucket{phase="parse",le="1"} 1\n', text)
+        self.assertIn('phase_seconds_bucket{phase="parse",le="+Inf"} 1\n', text)
+        self.assertIn('phase_seconds_count{phase="parse"} 1\n', text)
+        self.assertIn("# TYPE active gauge\nactive 2\n", text)
+        with self.assertRaises(ValueError):
+            metrics.histogram("requests_total", "Requests.")
+
+    def test_phases(self):
+        """
+        Test that the proxy measures the phases of a request and serves the metrics on the admin server.
+        """
+        port, _ = start_origin(b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nContent-Length: 14\r\n\r\nThis is Smiley")
+        proxy = local_proxy(Proxy, port)
+        proxy.add_response_replacement("Smiley", "Trolly")
+        proxy.use_cache = True
+        handle_client(proxy, b"GET http://smiley.com/ HTTP/1.1\r\nHost: smiley.com\r\n\r\n")
+        for phase in ("client_read", "parse", "cache_lookup", "upstream_connect", "upstream_ttfb", "body_transfer", "manipulation", "client_write"):
+            self.assertGreater(proxy.phases[phase].count, 0, phase)
+        self.assertEqual(proxy.requests.value, 1)
+        self.assertEqual(proxy.request_duration.count, 1)
+
+        admin = proxy.start_admin(0)
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{admin.port}/metrics", timeout=5) as page:
+                self.assertTrue(page.headers["Content-Type"].startswith("text/plain"))
+                text = page.read().decode("utf-8")
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen(f"http://127.0.0.1:{admin.port}/missing", timeout=5)
+        finally:
+            admin.stop()
+        self.assertIn('proxy_phase_duration_seconds_count{phase="upstream_ttfb"} 1\n', text)
+        self.assertIn("proxy_requests_total 1\n", text)
+        self.assertIn("proxy_cache_misses_total 1\n", text)
+        self.assertIn("proxy_cache_entries 1\n", text)
+
+class TestTracingMethods(unittest.TestCase):
+    def test_hooks(self):
+        """
+        Test that hook points are None without hooks, call the hooks in order and keep working when a hook fails.
+        """
+        hooks = Hooks()
+        for point in HOOK_POINTS:
+            self.assertIsNone(getattr(hooks, point))
+        calls = []
+
+        def failing(request_id, request, response):
+            raise RuntimeError("Broken hook")
+
+        def first(request_id, request, response):
+            calls.append(("first", request_id))
+
+        hooks.add("pre_send", first)
+        hooks.add("pre_send", failing)
+        hooks.add("pre_send", lambda request_id, request, response: calls.append(("last", request_id)))
+        hooks.pre_send("1.1", None, None)
+        self.assertEqual(calls, [("first", "1.1"), ("last", "1.1")])
+        hooks.remove("pre_send", first)
+        hooks.remove("pre_send", failing)
+        self.assertEqual(len(hooks.registered["pre_send"]), 1)
+        with self.assertRaises(ValueError):
+            hooks.add("missing", first)
+        with self.assertRaises(ValueError):
+            hooks.remove("pre_send", first)
+
+    def test_unique_ids(self):
+        """
+        Test that connections that are handled at the same time get different ids.
+        """
+        proxy = Proxy("127.0.0.1", 0, 10)
+        ids = []
+        proxy.hooks.add("pre_parse", lambda request_id, request, response: ids.append(request_id))
+        threads = [threading.Thread(target=handle_client, args=(proxy, b"BROKEN\r\n\r\n")) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(sorted(ids, key=lambda request_id: int(request_id.split(".")[0])), [f"{number}.1" for number in range(1, 21)])
+        proxy.stop()
+
+    def test_trace(self):
+        """
+        Test that the tracer records the hook points and phases of every request on a connection, and that disabling it removes all hooks.
+        """
+        port, _ = start_keep_alive_origin(b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nCache-Control: max-age=60\r\nContent-Length: 14\r\n\r\nThis is Smiley")
+        proxy = local_proxy(Proxy, port)
+        proxy.use_cache = True
+        tracer = proxy.enable_tracing()
+        self.assertIs(proxy.enable_tracing(), tracer)
+        request = b"GET http://smiley.com/ HTTP/1.1\r\nHost: smiley.com\r\n\r\n"
+        handle_client(proxy, request + request + b"BROKEN\r\n\r\n")
+        traces = tracer.recent()
+        self.assertEqual([trace["id"] for trace in traces], ["1.1", "1.2", "1.3"])
+        self.assertEqual([trace["status"] for trace in traces], [200, 200, 400])
+        self.assertEqual(list(traces[0]["points_ms"]), ["post_parse", "pre_upstream", "post_upstream", "pre_send", "post_send"])
+        # The second request is answered from the cache
+        self.assertEqual(list(traces[1]["points_ms"]), ["post_parse", "pre_send", "post_send"])
+        self.assertIn("upstream_ttfb", traces[0]["phases_ms"])
+        self.assertEqual(traces[0]["url"], "http://smiley.com/")
+        self.assertEqual(tracer.open, {})
+        proxy.disable_tracing()
+        self.assertIsNone(proxy.tracer)
+        for point in HOOK_POINTS:
+            self.assertIsNone(getattr(proxy.hooks, point))
+
+    def test_min_duration(self):
+        """
+        Test that only traces of requests that took at least min_duration are kept, and that no more than max_traces are kept.
+        """
+        tracer = Tracer(max_traces=2, min_duration=0.01)
+        request = Request(b"GET http://smiley.com/ HTTP/1.1\r\n\r\n")
+        for index in range(4):
+            tracer.mark("pre_parse", index, b"", None)
+            if index:
+                time.sleep(0.02)
+            tracer.mark("post_send", index, request, None)
+        self.assertEqual([trace["id"] for trace in tracer.recent()], [2, 3])
+        self.assertEqual(tracer.recent(1)[0]["id"], 3)
+
+    def test_profiler(self):
+        """
+        Test that the sampling profiler returns the folded stacks of the other threads.
+        """
+        stop = threading.Event()
+
+        def busy_function():
+            while not stop.is_set():
+                sum(range(1000))
+
+        thread = threading.Thread(target=busy_function)
+        thread.start()
+        profiler = SamplingProfiler(0.001)
+        try:
+            folded = profiler.profile(0.1)
+        finally:
+            stop.set()
+            thread.join()
+        lines = [line.rsplit(" ", 1) for line in folded.splitlines()]
+        self.assertTrue(lines)
+        self.assertTrue(all(int(count) > 0 for _, count in lines))
+        self.assertTrue(any(stack.split(";")[-1].startswith("busy_function (unit_test.py:") for stack, _ in lines))
+        self.assertFalse(any("test_profiler" in stack for stack, _ in lines))
+
+    def test_admin(self):
+        """
+        Test that tracing can be enabled and read on the admin server, and that the profile is served as folded stacks.
+        """
+        proxy = Proxy("127.0.0.1", 0, 10)
+        admin = proxy.start_admin(0)
+        base = f"http://127.0.0.1:{admin.port}"
+        try:
+            with urllib.request.urlopen(base + "/traces", timeout=5) as page:
+                self.assertEqual(json.loads(page.read()), {"enabled": False, "traces": []})
+            with urllib.request.urlopen(base + "/traces?enable=1", timeout=5) as page:
+                self.assertTrue(json.loads(page.read())["enabled"])
+            self.assertIsNotNone(proxy.hooks.pre_parse)
+            with urllib.request.urlopen(base + "/traces?enable=0", timeout=5) as page:
+                self.assertFalse(json.loads(page.read())["enabled"])
+            self.assertIsNone(proxy.hooks.pre_parse)
+            with urllib.request.urlopen(base + "/profile?seconds=0.05&interval=0.01", timeout=5) as page:
+                self.assertTrue(page.headers["Content-Type"].startswith("text/plain"))
+                self.assertIn(b"serve_forever", page.read())
+            for query in ("/profile?seconds=1000", "/profile?seconds=abc", "/traces?enable=yes"):
+                with self.assertRaises(urllib.error.HTTPError) as context:
+                    urllib.request.urlopen(base + query, timeout=5)
+                self.assertEqual(context.exception.code, 400)
+        finally:
+            admin.stop()
+            proxy.server.close()
+
+class TestLoggerMethods(unittest.TestCase):
+    def test_levels(self):
+        """
+        Test that messages below the level are dropped without being formatted and that the others are written by flush.
+        """
+        class Expensive:
+            def __str__(self):
+                raise AssertionError("Formatted a dropped message")
+
+        stream = io.StringIO()
+        logger = Logger(stream, level=WARNING, colors=False)
+        logger.info("Not written %s", Expensive())
+        logger.debug("Not written %s", Expensive())
+        self.assertEqual(len(logger.records), 0)
+        logger.warning("[CONNECTION #%s] Written", 7)
+        logger.flush()
+        self.assertTrue(stream.getvalue().endswith(" WARNING [CONNECTION #7] Written\n"))
+        self.assertFalse(logger.enabled(INFO))
+
+    def test_background_writer(self):
+        """
+        Test that the background thread writes the queued records in order.
+        """
+        stream = io.StringIO()
+        logger = Logger(stream, flush_interval=0.05, colors=False)
+        for index in range(10):
+            logger.info("Message %d", index)
+        for _ in range(100):
+            if stream.getvalue().count("\n") == 10:
+                break
+            threading.Event().wait(0.02)
+        lines = stream.getvalue().splitlines()
+        self.assertEqual([line.split(" ", 2)[2] for line in lines], [f"Message {index}" for index in range(10)])
+
+    def test_bounded_queue(self):
+        """
+        Test that records are dropped and counted when the queue is full.
+        """
+        logger = Logger(io.StringIO(), queue_size=2, flush_interval=60)
+        for index in range(5):
+            logger.info("Message %d", index)
+        self.assertEqual(logger.dropped, 3)
+
+    def test_sampling(self):
+        """
+        Test that access log lines are only written for the sampled part of the requests.
+        """
+        logger = Logger(io.StringIO(), sample_rate=0)
+        self.assertFalse(any(logger.sampled() for _ in range(100)))
+        logger.sample_rate = 1
+        self.assertTrue(logger.sampled())
+        logger.access_log = False
+        self.assertFalse(logger.sampled())
+
+    def test_access_log(self):
+        """
+        Test that the proxy writes one access log line in JSON with the timings of every request.
+        """
+        port, _ = start_keep_alive_origin(b"HTTP/1.1 200 OK\r\nContent-Length: 14\r\n\r\nThis is Smiley")
+        proxy = local_proxy(Proxy, port)
+        proxy.use_cache = True
+        stream = io.StringIO()
+        old_stream, old_level = log.stream, log.level
+        log.flush()
+        log.stream, log.level = stream, WARNING
+        try:
+            handle_client(proxy, b"GET http://smiley.com/ HTTP/1.1\r\nHost: smiley.com\r\n\r\nincorrectdata\r\n\r\n")
+            log.flush()
+        finally:
+            log.stream, log.level = old_stream, old_level
+        lines = [json.loads(line) for line in stream.getvalue().splitlines() if line.startswith("{")]
+        self.assertEqual(len(lines), 2)
+        self.assertEqual((lines[0]["method"], lines[0]["url"], lines[0]["status"], lines[0]["cache"]), ("GET", "http://smiley.com/", 200, "miss"))
+        self.assertIn("upstream_ttfb_ms", lines[0])
+        self.assertGreaterEqual(lines[0]["duration_ms"], lines[0]["upstream_ttfb_ms"])
+        self.assertEqual(lines[1]["status"], 400)
+
+@unittest.skipUnless(hasattr(os, "fork"), "Supervisor requires fork")
+class TestBenchmarkMethods(unittest.TestCase):
+    def test_origin(self):
+        """
+        Test that the origin of the benchmarks answers several requests on one connection in every mode.
+        """
+        for mode in ("static", "chunked", "large", "slow"):
+            origin = Origin(mode, body_size=5000, large_size=100000, delay=0.01).start()
+            try:
+                with socket.create_connection(("127.0.0.1", origin.port), 5) as client:
+                    reader = SocketReader(client)
+                    for _ in range(2):
+                        status, size = fetch(client, reader, b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n")
+                        self.assertEqual(status, "200")
+                        self.assertEqual(size, 100000 if mode == "large" else 5000)
+                self.assertEqual(origin.requests, 2)
+            finally:
+                origin.stop()
+
+    def test_percentile(self):
+        """
+        Test that percentiles are interpolated between the sorted values.
+        """
+        values = [1, 2, 3, 4, 5]
+        self.assertEqual(percentile(values, 0.5), 3)
+        self.assertEqual(percentile(values, 1.0), 5)
+        self.assertEqual(percentile(values, 0.875), 4.5)
+        self.assertIsNone(percentile([], 0.5))
+
+    def test_micro(self):
+        """
+        Test that the micro-benchmarks report the time per call.
+        """
+        results = run_micro(["time_compare"], repeat=1, min_time=0.01)
+        self.assertEqual(list(results), ["time_compare"])
+        self.assertGreater(results["time_compare"]["ns_per_op"], 0)
+
+    def test_load(self):
+        """
+        Test that a load test through the proxy process reports every measurement and that reports can be compared.
+        """
+        result = benchmark_load("static", "cached", "thread", concurrency=2, requests=20, warmup=2)
+        self.assertEqual(result["requests"], 20)
+        self.assertEqual(result["errors"], 0)
+        self.assertGreater(result["requests_per_second"], 0)
+        self.assertLessEqual(result["latency_ms"]["p50"], result["latency_ms"]["p99"])
+        self.assertIsNotNone(result["cpu_ms_per_request"])
+        self.assertGreater(result["peak_rss_mb"], 0)
+        faster = dict(result, requests_per_second=result["requests_per_second"] * 2)
+        lines = compare({"load": [faster]}, {"load": [result]})
+        self.assertTrue(lines[0].endswith("(+100.0%)"))
+
+class TestSupervisorMethods(unittest.TestCase):
+    def fetch(self, port):
+        client = socket.create_connection(("127.0.0.1", port), 5)
+        client.sendall(b"GET http://smiley.com/ HTTP/1.1\r\nHost: smiley.com\r\nConnection: close\r\n\r\n")
+        reader = SocketReader(client)
+        response = Response(reader.read_head())
+        response.body = b"".join(bytes(data) for data in reader.iter_body(*body_framing(response.headers, "GET", response.status_code)))
+        client.close()
+        return response
+
+    def supervise(self, reuse_port):
+        port, _ = start_keep_alive_origin(b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nContent-Length: 14\r\n\r\nThis is Smiley")
+        proxy = local_proxy(Proxy, port)
+        proxy.add_response_replacement("Smiley", "Trolly")
+        proxy_port = proxy.server.getsockname()[1]
+        supervisor = Supervisor(proxy, workers=2, reuse_port=reuse_port, shutdown_timeout=2)
+        thread = threading.Thread(target=supervisor.run)
+        thread.start()
+        try:
+            for _ in range(100):
+                if len(supervisor.pids) == 2:
+                    break
+                threading.Event().wait(0.05)
+            for _ in range(100):
+                try:
+                    response = self.fetch(proxy_port)
+                    break
+                except OSError:
+                    threading.Event().wait(0.05)
+            self.assertEqual(response.body, b"This is Trolly")
+
+            # A worker that dies is replaced by a new one
+            pid = next(iter(supervisor.pids))
+            worker = supervisor.pids[pid]
+            os.kill(pid, signal.SIGKILL)
+            for _ in range(100):
+                if supervisor.restarts[worker] == 1 and len(supervisor.pids) == 2:
+                    break
+                threading.Event().wait(0.05)
+            self.assertEqual(supervisor.restarts[worker], 1)
+            self.assertNotIn(pid, supervisor.pids)
+            self.assertEqual(self.fetch(proxy_port).body, b"This is Trolly")
+            self.assertEqual([stats["worker"] for stats in supervisor.stats()], [0, 1])
+        finally:
+            supervisor.stop()
+            thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(supervisor.pids, {})
+
+    def test_shared_socket(self):
+        """
+        Test that the workers serve requests on the shared socket of the proxy and that crashed workers are restarted.
+        """
+        self.supervise(False)
+
+    def test_reuse_port(self):
+        """
+        Test that the workers serve requests on their own SO_REUSEPORT sockets.
+        """
+        self.supervise(True)
 
 if __name__ == "__main__":
     unittest.main()
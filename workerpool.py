@@ -0,0 +1,86 @@
+import queue
+import threading
+from logger import log
+
+class WorkerPool:
+    """
+    This class runs tasks on a fixed number of threads instead of starting a new thread for every task. Tasks that arrive while all threads are busy wait in a queue, at most queue_size tasks can wait. The threads are started when the first task is submitted.
+    """
+    def __init__(self, threads=64, queue_size=128):
+        self.threads = threads
+        self.queue_size = queue_size
+        self.queue = None
+        self.workers = []
+        self.lock = threading.Lock()
+        self.active = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def start(self):
+        """
+        This function starts the threads of the pool.
+        """
+        with self.lock:
+            if self.queue is not None:
+                return
+            self.queue = queue.Queue(max(1, self.queue_size))
+            for _ in range(self.threads):
+                worker = threading.Thread(target=self.work, args=(self.queue,), daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+    def submit(self, function, *args):
+        """
+        This function adds a task to the queue. Returns False if the queue is full, the task is then not run.
+        """
+        self.start()
+        tasks = self.queue
+        try:
+            if tasks is None:
+                raise queue.Full
+            tasks.put_nowait((function, args))
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            return False
+        return True
+
+    def work(self, tasks):
+        """
+        This function is run by every thread of the pool. It runs tasks from the queue until it gets None.
+        """
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            function, args = task
+            with self.lock:
+                self.active += 1
+            try:
+                function(*args)
+            except Exception as error:
+                log.error("[WORKER POOL] A task failed: %r", error)
+            finally:
+                with self.lock:
+                    self.active -= 1
+                    self.completed += 1
+
+    def waiting(self):
+        """
+        This function returns the number of tasks that wait for a free thread.
+        """
+        return self.queue.qsize() if self.queue is not None else 0
+
+    def shutdown(self, timeout=None):
+        """
+        This function stops the threads after they have run the tasks that are already in the queue. It waits at most timeout seconds for them.
+        """
+        with self.lock:
+            workers, self.workers = self.workers, []
+            tasks, self.queue = self.queue, None
+        if tasks is None:
+            return
+        for _ in workers:
+            tasks.put(None)
+        for worker in workers:
+            worker.join(timeout)